@@ -0,0 +1,174 @@
+"""
+answer_cache.py
+
+Cache of generated answers for the Gemini step.
+
+Entries are keyed on (normalized query, hash of the joined context string,
+model name), so a cached answer is only reused when the model would have
+seen exactly the same prompt material. With semantic matching enabled, a
+miss on the exact key falls back to the most similar earlier question that
+was answered from the same context and model, using a sentence-transformers
+embedding.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+
+from cache import LRUCache, normalize_query
+
+DEFAULT_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+
+@dataclass
+class CachedAnswer:
+    answer: str
+    query: str
+    latency: float          # seconds the original generation took
+    similarity: float = 1.0  # 1.0 for exact hits
+
+
+@dataclass
+class AnswerCacheStats:
+    exact_hits: int = 0
+    semantic_hits: int = 0
+    misses: int = 0
+    saved_seconds: float = 0.0
+    lookup_seconds: float = 0.0
+
+    @property
+    def saved_calls(self) -> int:
+        return self.exact_hits + self.semantic_hits
+
+    def as_dict(self) -> dict[str, float]:
+        lookups = self.saved_calls + self.misses
+        return {
+            **asdict(self),
+            "saved_calls": self.saved_calls,
+            "hit_rate": self.saved_calls / lookups if lookups else 0.0,
+            "avg_lookup_ms": 1000 * self.lookup_seconds / lookups if lookups else 0.0,
+        }
+
+
+class SentenceTransformerEmbedder:
+    """Normalized sentence embeddings; the model is loaded on first use."""
+
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str) -> list[float]:
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import SentenceTransformer
+
+                self._model = SentenceTransformer(self.model_name)
+        return self._model.encode(text, normalize_embeddings=True).tolist()
+
+
+class AnswerCache:
+    """Bounded answer cache with optional near-duplicate question matching.
+
+    `semantic_threshold` is a cosine similarity in [0, 1]; `None` disables
+    semantic matching (and never loads an embedding model). `embedder` maps
+    text to a unit-length vector and defaults to `SentenceTransformerEmbedder`.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 512,
+        ttl: float | None = 3600.0,
+        semantic_threshold: float | None = None,
+        embedder: Callable[[str], list[float]] | None = None,
+    ):
+        self.semantic_threshold = semantic_threshold
+        self.embedder = embedder or (SentenceTransformerEmbedder() if semantic_threshold is not None else None)
+        self.stats = AnswerCacheStats()
+        self._lock = threading.Lock()
+        # (context hash, model) -> {entry key: query embedding}
+        self._vectors: dict[tuple[str, str], dict[str, list[float]]] = {}
+        self._entries = LRUCache(max_entries, ttl, on_evict=self._forget)
+        self._embeddings = LRUCache(max_entries, ttl=None)
+
+    @staticmethod
+    def context_hash(contexts: str) -> str:
+        return hashlib.sha256(contexts.encode("utf-8")).hexdigest()
+
+    def _key(self, query: str, context_hash: str, model_name: str) -> str:
+        return json.dumps([normalize_query(query), context_hash, model_name])
+
+    def _embed(self, query: str) -> list[float]:
+        normalized = normalize_query(query)
+        vector = self._embeddings.get(normalized)
+        if vector is None:
+            vector = self.embedder(normalized)
+            self._embeddings.set(normalized, vector)
+        return vector
+
+    def _forget(self, key: str, _value: CachedAnswer) -> None:
+        _, context_hash, model_name = json.loads(key)
+        with self._lock:
+            group = self._vectors.get((context_hash, model_name))
+            if group is not None:
+                group.pop(key, None)
+                if not group:
+                    del self._vectors[(context_hash, model_name)]
+
+    def _nearest(self, query: str, group_key: tuple[str, str]) -> tuple[str, float] | None:
+        with self._lock:
+            candidates = list(self._vectors.get(group_key, {}).items())
+        if not candidates:
+            return None
+        vector = self._embed(query)
+        best_key, best_score = None, -1.0
+        for key, other in candidates:
+            score = sum(a * b for a, b in zip(vector, other))
+            if score > best_score:
+                best_key, best_score = key, score
+        return best_key, best_score
+
+    def lookup(self, query: str, contexts: str, model_name: str) -> CachedAnswer | None:
+        """Return a cached answer for this prompt material, or `None`."""
+        start = time.perf_counter()
+        context_hash = self.context_hash(contexts)
+        hit = self._entries.get(self._key(query, context_hash, model_name))
+        if hit is None and self.semantic_threshold is not None:
+            nearest = self._nearest(query, (context_hash, model_name))
+            if nearest is not None and nearest[1] >= self.semantic_threshold:
+                cached = self._entries.get(nearest[0])
+                if cached is not None:
+                    hit = CachedAnswer(cached.answer, cached.query, cached.latency, similarity=nearest[1])
+
+        with self._lock:
+            self.stats.lookup_seconds += time.perf_counter() - start
+            if hit is None:
+                self.stats.misses += 1
+            else:
+                if hit.similarity < 1.0:
+                    self.stats.semantic_hits += 1
+                else:
+                    self.stats.exact_hits += 1
+                self.stats.saved_seconds += hit.latency
+        return hit
+
+    def store(self, query: str, contexts: str, model_name: str, answer: str, latency: float) -> None:
+        """Remember `answer`, produced in `latency` seconds, for this prompt material."""
+        context_hash = self.context_hash(contexts)
+        key = self._key(query, context_hash, model_name)
+        self._entries.set(key, CachedAnswer(answer, query, latency))
+        if self.semantic_threshold is not None:
+            vector = self._embed(query)
+            with self._lock:
+                self._vectors.setdefault((context_hash, model_name), {})[key] = vector
+
+    def clear(self) -> None:
+        self._entries.clear()
+        with self._lock:
+            self._vectors.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
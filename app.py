@@ -2,42 +2,103 @@ import os
 # Disable Streamlit’s file watcher to avoid torch errors
 os.environ["STREAMLIT_SERVER_FILEWATCHER_TYPE"] = "none"
 
+import time
+_script_started = time.perf_counter()
+
 import nest_asyncio
 nest_asyncio.apply()
 
 import streamlit as st
 import asyncio
 import logging
+import threading
+import uuid
 
-# Attempt to import Google Generative AI SDK
-try:
-    import google.generativeai as genai
-except ImportError:
-    st.error("`google.generativeai` module not found. Run `pip install google-generativeai`")
-    raise
-
-# Load Gemini API key from Streamlit secrets
-gemini_key = st.secrets.get("GEMINI_API_KEY", "")
-if not gemini_key:
-    st.error("GEMINI_API_KEY missing in secrets.toml.")
-    st.stop()
-
-# Configure Gemini
-os.environ["GEMINI_API_KEY"] = gemini_key
-genai.configure(api_key=gemini_key)
-gemini_model = genai.GenerativeModel("gemini-2.0-flash")
+from telemetry import start_trace
 
-from fed_rag.knowledge_stores.no_encode import MCPKnowledgeStore, MCPStdioKnowledgeSource
-from fed_rag.data_structures import KnowledgeNode
-from mcp import StdioServerParameters
+# Heavy dependencies (google.generativeai, fed_rag -> torch, mcp) are imported
+# inside the cached factories below, so the page renders before they load.
+# `python import_report.py` shows what each of them costs.
+DEFERRED_IMPORTS = ["google.generativeai", "rag_engine", "chat"]
 
 # Logging configuration
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+@st.cache_resource
+def startup_timings() -> dict[str, float]:
+    """Seconds spent on each startup step, recorded once per server process."""
+    return {}
+
+@st.cache_resource
+def warm_imports() -> threading.Thread:
+    """Import the heavy modules on a background thread while the user reads the page."""
+    def load():
+        import importlib
+        start = time.perf_counter()
+        for module in DEFERRED_IMPORTS:
+            importlib.import_module(module)
+        startup_timings()["background_imports"] = time.perf_counter() - start
+        logger.info(f"Deferred imports loaded in {time.perf_counter() - start:.2f}s")
+
+    thread = threading.Thread(target=load, name="warm-imports", daemon=True)
+    thread.start()
+    return thread
+
+@st.cache_resource(show_spinner="Configuring Gemini…")
+def get_generator():
+    """Gemini client (or the fake one with GENERATOR = "fake"), configured once per server process."""
+    start = time.perf_counter()
+    from rag_engine import make_generator
+
+    os.environ["GEMINI_API_KEY"] = st.secrets.get("GEMINI_API_KEY", "")
+    try:
+        generator = make_generator(st.secrets.get)
+    except ImportError:
+        st.error("`google.generativeai` module not found. Run `pip install google-generativeai`")
+        raise
+    startup_timings()["gemini_client"] = time.perf_counter() - start
+    return generator
+
+@st.cache_resource(show_spinner="Starting MCP knowledge sources…")
+def get_engine():
+    """Pools, caches and generator shared across reruns and users."""
+    start = time.perf_counter()
+    from rag_engine import RAGEngine
+
+    engine = RAGEngine.from_settings(st.secrets.get, generator=get_generator())
+    # The first question would otherwise wait for server processes to start
+    asyncio.get_event_loop().run_until_complete(engine.warm_up())
+    startup_timings()["engine"] = time.perf_counter() - start
+    return engine
+
+@st.cache_resource
+def get_prefetcher():
+    """Background retrieval of questions as they are entered, shared across sessions."""
+    from prefetch import Prefetcher
+
+    return Prefetcher.from_settings(get_engine(), st.secrets.get)
+
+def prefetch_query(use_cache: bool):
+    """`st.text_input` callback: runs when a question is committed (Enter or leaving the box)."""
+    session = st.session_state.setdefault("prefetch_id", uuid.uuid4().hex)
+    get_prefetcher().submit(session, st.session_state["query_text"], use_cache=use_cache)
+
+@st.cache_resource
+def get_chat_store():
+    """Chat sessions for every browser tab, capped and expired per `CHAT_*` secrets."""
+    from chat import ChatStore
+
+    return ChatStore.from_settings(st.secrets.get)
+
 def main():
     st.title("NoEncode RAG + Gemini 2.0 Flash Demo")
 
+    if st.secrets.get("GENERATOR", "gemini") != "fake" and not st.secrets.get("GEMINI_API_KEY", ""):
+        st.error("GEMINI_API_KEY missing in secrets.toml.")
+        st.stop()
+    warm_imports()
+
     # Sidebar with app description and requirements
     st.sidebar.title("NoEncode RAG + Gemini 2.0 Flash Demo")
     st.sidebar.markdown(
@@ -52,13 +113,29 @@ def main():
         "- google-generativeai\n"
         "- torch"
     )
+    stream_answer = st.sidebar.checkbox("Stream answer", value=True, help="Render the answer as Gemini generates it.")
+    bypass_cache = st.sidebar.checkbox(
+        "Bypass caches", value=False,
+        help="Always call the MCP tools and Gemini; fresh results still refresh the caches.",
+    )
+    show_timings = st.sidebar.checkbox(
+        "Show timing breakdown", value=False,
+        help="Per-stage spans of the last run: session acquire, tool call, parsing, prompt build, generation.",
+    )
+    prefetch = st.sidebar.checkbox(
+        "Prefetch while typing", value=bool(st.secrets.get("PREFETCH", False)),
+        help="Start retrieving as soon as you press Enter or leave the question box, before you click Retrieve.",
+    )
 
-    # Two tabs: Demo and Explanation
-    demo_tab, explain_tab = st.tabs(["🚀 Demo", "📖 How it works"])
+    # Three tabs: Demo, Chat and Explanation
+    demo_tab, chat_tab, explain_tab = st.tabs(["🚀 Demo", "💬 Chat", "📖 How it works"])
 
     with demo_tab:
         st.header("Run NoEncode RAG Pipeline")
-        query_text = st.text_input("Enter your question:", value="What is MCP?")
+        query_text = st.text_input(
+            "Enter your question:", value="What is MCP?", key="query_text",
+            on_change=prefetch_query if prefetch else None, args=(not bypass_cache,),
+        )
         log_container = st.empty()
         log_msgs = []
         def log(msg: str):
@@ -67,64 +144,169 @@ def main():
             logger.info(msg)
 
         if st.button("Retrieve", key="run_demo"):
-            # Fixed MCP server parameters
-            command = "python" # python3 kalau run locally
-            args = ["my_awesome_mcp_server.py"]
-            tool_name = "KnowledgeTool"
-            query_param = "query"
-
             async def pipeline():
-                log("📦 Setting up MCP parameters...")
-                params = StdioServerParameters(command=command, args=args)
-                log(f"⚙️ Command: {command} {' '.join(args)}")
-
-                log("🔧 Creating MCPStdioKnowledgeSource...")
-                source = MCPStdioKnowledgeSource(
-                    name="mcp", server_params=params,
-                    tool_name=tool_name, query_param_name=query_param
-                )
-
-                log("📚 Building knowledge store...")
-                store = MCPKnowledgeStore().add_source(source)
-
-                log("⏳ Retrieving contexts...")
-                nodes = await store.retrieve(query_text)
-
-                # Combine context texts
-                contexts = "\n---\n".join(
-                    (item[1].text_content if isinstance(item, tuple) else item.text_content)
-                    for item in nodes
-                )
-
-                log("🚀 Generating answer with Gemini Flash...")
-                prompt_text = f"Context:\n{contexts}\n\nQuestion: {query_text}"
-                gen = gemini_model.generate_content(prompt_text)
-                return nodes, gen.text
-
+                log("📚 Connecting knowledge sources...")
+                engine = get_engine()
+                log(f"⚙️ Sources: {', '.join(engine.retriever.sources)}")
+
+                prefetched = None
+                if prefetch and "prefetch_id" in st.session_state:
+                    prefetched, early = await get_prefetcher().take(
+                        st.session_state["prefetch_id"], query_text, use_cache=not bypass_cache
+                    )
+                    if prefetched is not None and early >= 0:
+                        log(f"⚡ Contexts were prefetched {early * 1000:.0f} ms before the click")
+                    elif prefetched is not None:
+                        log(f"⚡ Waited {-early * 1000:.0f} ms for the prefetch already under way")
+                if prefetched is None:
+                    log("⏳ Retrieving contexts...")
+                parts = []
+                final = None
+                with start_trace("streamlit") as trace:
+                    async for event in engine.answer_stream(query_text, use_cache=not bypass_cache, retrieval=prefetched):
+                        if event.type == "retrieval":
+                            result = event.retrieval
+                            if len(result.subqueries) > 1:
+                                log(f"🧩 Split into {len(result.subqueries)} sub-queries: " + " | ".join(result.subqueries))
+                            for name, seconds in result.latencies.items():
+                                hit = " (cached)" if name in result.cached else ""
+                                log(f"   • {name}: {seconds * 1000:.0f} ms{hit}")
+                            for name in result.timed_out:
+                                log(f"⚠️ {name} missed its deadline; continuing with partial results")
+                            for name, error in result.failed.items():
+                                log(f"⚠️ {name} failed: {error}")
+                            for name in result.stale:
+                                log(f"🕰️ {name} is unavailable; using its last known-good result")
+                            log("🚀 Generating answer with Gemini Flash...")
+                            answer_section.subheader("Generated Answer")
+                            answer_placeholder = answer_section.empty()
+                        elif event.type == "chunk":
+                            parts.append(event.text)
+                            if stream_answer:
+                                answer_placeholder.markdown("".join(parts) + "▌")
+                        else:
+                            final = event.answer
+
+                packed = final.context
+                if packed is not None and (packed.dropped_tokens or packed.duplicates):
+                    log(
+                        f"✂️ Context: {packed.tokens} tokens from {len(packed.nodes)} nodes; "
+                        f"dropped {packed.dropped_tokens} tokens ({packed.dropped_nodes} nodes, "
+                        f"{packed.truncated_nodes} truncated, {packed.duplicates} near-duplicates)"
+                    )
+                if final.cached:
+                    log(f"♻️ Answer cache hit (similarity {final.similarity:.2f}); skipped Gemini call.")
+                answer_placeholder.markdown(final.answer)
+                return final.nodes, final.answer, final.stats, trace
+
+            answer_section = st.container()
+            request_timeout = float(st.secrets.get("REQUEST_TIMEOUT", 60))
             try:
                 with st.spinner("Running pipeline…"):
                     loop = asyncio.get_event_loop()
-                    nodes, answer = loop.run_until_complete(pipeline())
+                    # A hung source or generator must not hang the page with it
+                    nodes, answer, stats, trace = loop.run_until_complete(
+                        asyncio.wait_for(pipeline(), request_timeout if request_timeout > 0 else None)
+                    )
 
                 log(f"✅ Retrieved {len(nodes)} contexts and generated answer.")
-
-                st.subheader("Generated Answer")
-                st.write(answer)
+                with st.sidebar.expander("📊 Pool & cache stats"):
+                    st.json(get_engine().stats())
+                    if prefetch:
+                        st.json({"prefetch": get_prefetcher().stats()})
+                ttft = stats.time_to_first_token
+                answer_section.caption(
+                    f"⏱️ First token {ttft:.2f}s · {stats.tokens} tokens in {stats.total_time:.2f}s "
+                    f"({stats.tokens_per_sec:.1f} tokens/s)" if ttft is not None else "⏱️ No tokens generated"
+                )
+                if show_timings:
+                    with answer_section.expander("⏱️ Timing breakdown", expanded=True):
+                        st.dataframe(trace.breakdown(), use_container_width=True)
+                        st.caption(" · ".join(f"{stage} {ms:.1f} ms" for stage, ms in trace.totals().items()))
 
                 if nodes:
                     st.subheader("Retrieved Contexts")
                     for i, item in enumerate(nodes, start=1):
                         node = item[1] if isinstance(item, tuple) else item
                         score = item[0] if isinstance(item, tuple) else getattr(item, 'score', 'N/A')
-                        st.markdown(f"**Context {i}** (Score: {score})")
+                        sources = ", ".join(node.metadata.get("sources", []))
+                        st.markdown(f"**Context {i}** (Score: {score:.3g} · {sources})" if isinstance(score, float) else f"**Context {i}** (Score: {score})")
                         st.write(node.text_content)
                 else:
                     st.info("No contexts retrieved.")
 
+            except asyncio.TimeoutError:
+                log(f"❌ Pipeline timed out after {request_timeout:.0f}s")
+                st.error(f"No answer within {request_timeout:.0f}s; the knowledge sources or Gemini may be down. Try again shortly.")
             except Exception as e:
                 log(f"❌ Pipeline error: {e}")
                 st.error(f"An error occurred: {e}")
 
+    with chat_tab:
+        st.header("Chat with your knowledge sources")
+        st.caption("Follow-up questions reuse the contexts already retrieved and only look up what is new.")
+        messages = st.session_state.setdefault("chat_messages", [])
+        if messages and st.button("New conversation", key="reset_chat"):
+            get_chat_store().delete(st.session_state.pop("chat_id", ""))
+            messages.clear()
+        history = st.container()
+        for message in messages:
+            with history.chat_message(message["role"]):
+                st.markdown(message["content"])
+                if message.get("note"):
+                    st.caption(message["note"])
+
+        question = st.chat_input("Ask a question or a follow-up…")
+        if question:
+            # The engine first: importing `chat` pulls in `rag_engine` and fed_rag
+            engine = get_engine()
+            from chat import chat_stream
+
+            session = get_chat_store().get(st.session_state.get("chat_id"))
+            st.session_state["chat_id"] = session.id
+            messages.append({"role": "user", "content": question})
+            with history.chat_message("user"):
+                st.markdown(question)
+
+            async def chat_turn(placeholder):
+                parts = []
+                retrieval_query = None
+                final = None
+                async for event in chat_stream(engine, session, question, use_cache=not bypass_cache):
+                    if event.type == "plan":
+                        retrieval_query = event.text or None
+                    elif event.type == "chunk":
+                        parts.append(event.text)
+                        if stream_answer:
+                            placeholder.markdown("".join(parts) + "▌")
+                    elif event.type == "done":
+                        final = event.answer
+                placeholder.markdown(final.answer)
+                return final, retrieval_query
+
+            with history.chat_message("assistant"):
+                placeholder = st.empty()
+                request_timeout = float(st.secrets.get("REQUEST_TIMEOUT", 60))
+                try:
+                    loop = asyncio.get_event_loop()
+                    final, retrieval_query = loop.run_until_complete(
+                        asyncio.wait_for(chat_turn(placeholder), request_timeout if request_timeout > 0 else None)
+                    )
+                except asyncio.TimeoutError:
+                    st.error(f"No answer within {request_timeout:.0f}s; the knowledge sources or Gemini may be down. Try again shortly.")
+                    messages.pop()
+                except Exception as e:
+                    logger.info(f"❌ Chat error: {e}")
+                    st.error(f"An error occurred: {e}")
+                    messages.pop()
+                else:
+                    if retrieval_query is None:
+                        note = f"♻️ Reused {len(final.nodes)} contexts from earlier turns"
+                    else:
+                        note = f"🔎 Retrieved for “{retrieval_query}” · {len(final.nodes)} contexts"
+                    st.caption(note)
+                    messages.append({"role": "assistant", "content": final.answer, "note": note})
+
     with explain_tab:
         st.header("How NoEncode RAG Works")
         st.markdown(
@@ -135,7 +317,7 @@ def main():
 3. **NoEncodeKnowledgeStore**: Abstracts one or more MCP sources so you don’t need embeddings or retrievers; retrieval works on natural queries.
 4. **Generator LLM**: Passes retrieved contexts plus the query to an LLM (Gemini 2.0 Flash) for final answer generation.
 
-**Demo Limitation:** The provided `my_awesome_mcp_server.py` only handles the `what is mcp` query and returns a fixed definition. You can only ask this specific question unless you extend the server logic.
+**Knowledge Server:** The provided `my_awesome_mcp_server.py` answers any query from the documents in `docs/` using a BM25 index (`knowledge_index.py`) that is built once, saved to `.index/` and memory-mapped on start-up. Add files to `docs/` to extend what you can ask about; changes are picked up the next time the server starts.
 
 **Dummy Server Example (only supports `what is mcp`):**
 ```python
@@ -185,5 +367,11 @@ if __name__ == '__main__':
 ```"""
         )
 
+    # Only the first run of a fresh process sets this, before any query ran
+    timings = startup_timings()
+    timings.setdefault("first_render", time.perf_counter() - _script_started)
+    with st.sidebar.expander("🚀 Startup timings"):
+        st.json({step: f"{seconds:.2f}s" for step, seconds in timings.items()})
+
 if __name__ == '__main__':
     main()
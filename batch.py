@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""
+batch.py
+
+Answer a file of questions through the NoEncode pipeline.
+
+    python batch.py questions.jsonl answers.jsonl --concurrency 8 --rate 5
+
+Input is JSONL (`{"id": ..., "question": ...}` per line; `query` is accepted
+too) or CSV with the same columns. Rows without an id are numbered by line;
+lines that are not JSON objects are recorded as errors under their line number.
+Questions are streamed from disk, answered by at most `--concurrency`
+workers, throttled to `--rate` questions per second, and each result is
+appended to the output file as soon as it is ready, so memory stays flat.
+Re-running with the same output file skips ids that already have a result,
+which resumes a crashed run.
+
+Settings come from the environment, as for `service.py`.
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+from collections.abc import AsyncIterator, Iterator
+from pathlib import Path
+from typing import Any
+
+from rag_engine import RAGEngine
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Token bucket: at most `rate` acquisitions per second, bursting to `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def _jsonl_rows(lines: Iterator[str]) -> Iterator[dict[str, Any] | str]:
+    """Parsed JSONL objects, or an error message in place of a malformed line."""
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield f"invalid JSON: {e}"
+            continue
+        yield row if isinstance(row, dict) else f"expected a JSON object, got {type(row).__name__}"
+
+
+def read_questions(path: str | Path) -> Iterator[dict[str, str]]:
+    """Yield `{"id", "question"}` rows from a JSONL or CSV file, one at a time.
+
+    Malformed lines are logged and yielded as `{"id", "error"}` rows, so they
+    show up in the results instead of stopping the run.
+    """
+    path = Path(path)
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.suffix.lower() == ".csv":
+            rows: Iterator[dict[str, Any] | str] = csv.DictReader(f)
+        else:
+            rows = _jsonl_rows(f)
+        for line_no, row in enumerate(rows, start=1):
+            if isinstance(row, str):
+                logger.warning(f"{path}:{line_no}: {row}")
+                yield {"id": str(line_no), "error": row}
+                continue
+            question = row.get("question") or row.get("query")
+            if not question:
+                logger.warning(f"{path}:{line_no}: no question, skipped")
+                continue
+            yield {"id": str(row.get("id") or line_no), "question": question}
+
+
+def completed_ids(path: str | Path) -> set[str]:
+    """Ids already answered in an existing output file (a torn last line is ignored)."""
+    done: set[str] = set()
+    if not Path(path).exists():
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if "error" not in record:
+                done.add(str(record["id"]))
+    return done
+
+
+async def answer_questions(
+    engine: RAGEngine,
+    questions: Iterator[dict[str, str]],
+    concurrency: int = 4,
+    rate: float | None = None,
+    use_cache: bool = True,
+) -> AsyncIterator[dict[str, Any]]:
+    """Answer questions with bounded concurrency, yielding results as they finish.
+
+    At most `2 * concurrency` questions are in memory at any time. Rows that
+    already carry an `error` are passed through unanswered; an error raised by
+    `questions` itself is re-raised once the workers have drained.
+    """
+    limiter = RateLimiter(rate, burst=max(1, concurrency)) if rate else None
+    pending: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    results: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    done = object()
+    feed_errors: list[Exception] = []
+
+    async def feed():
+        try:
+            for row in questions:
+                await pending.put(row)
+        except Exception as e:
+            feed_errors.append(e)
+        # Always release the workers, or they would wait on `pending` forever
+        for _ in range(concurrency):
+            await pending.put(done)
+
+    async def work():
+        while (row := await pending.get()) is not done:
+            if "error" in row:
+                await results.put(row)
+                continue
+            if limiter:
+                await limiter.acquire()
+            start = time.perf_counter()
+            try:
+                answer = await engine.answer(row["question"], use_cache=use_cache)
+                record = {
+                    **row,
+                    "answer": answer.answer,
+                    "contexts": [node.text_content for _, node in answer.nodes],
+                    "cached": answer.cached,
+                }
+            except Exception as e:
+                record = {**row, "error": f"{type(e).__name__}: {e}"}
+            record["latency"] = time.perf_counter() - start
+            await results.put(record)
+        await results.put(done)
+
+    tasks = [asyncio.create_task(feed())] + [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        finished = 0
+        while finished < concurrency:
+            record = await results.get()
+            if record is done:
+                finished += 1
+            else:
+                yield record
+        if feed_errors:
+            raise feed_errors[0]
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+async def run_batch(
+    engine: RAGEngine,
+    input_path: str | Path,
+    output_path: str | Path,
+    concurrency: int = 4,
+    rate: float | None = None,
+    use_cache: bool = True,
+) -> dict[str, Any]:
+    """Answer every not-yet-answered question in `input_path`, appending to `output_path`."""
+    skip = completed_ids(output_path)
+    counts = {"answered": 0, "failed": 0, "skipped": 0}
+
+    def unanswered() -> Iterator[dict[str, str]]:
+        for row in read_questions(input_path):
+            if row["id"] in skip:
+                counts["skipped"] += 1
+            else:
+                yield row
+
+    questions = unanswered()
+    start = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as out:
+        async for record in answer_questions(engine, questions, concurrency, rate, use_cache):
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            counts["failed" if "error" in record else "answered"] += 1
+            if (counts["answered"] + counts["failed"]) % 100 == 0:
+                logger.info(f"Progress: {counts}")
+    elapsed = time.perf_counter() - start
+    processed = counts["answered"] + counts["failed"]
+    return {**counts, "seconds": elapsed, "questions_per_sec": processed / elapsed if elapsed else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="questions file (.jsonl or .csv)")
+    parser.add_argument("output", help="answers file (.jsonl); existing results are kept and skipped")
+    parser.add_argument("--concurrency", type=int, default=4, help="questions in flight at once")
+    parser.add_argument("--rate", type=float, default=None, help="max questions started per second")
+    parser.add_argument("--no-cache", action="store_true", help="bypass retrieval and answer caches")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    engine = RAGEngine.from_settings(os.environ.get)
+    try:
+        summary = asyncio.run(
+            run_batch(engine, args.input, args.output, args.concurrency, args.rate, use_cache=not args.no_cache)
+        )
+    finally:
+        engine.close()
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
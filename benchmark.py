@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+benchmark.py
+
+End-to-end latency benchmark for the NoEncode pipeline.
+
+Drives the real knowledge server (`my_awesome_mcp_server.py`) over a
+synthetic corpus and `FakeGenerator`, so runs are offline and reproducible,
+and times each stage separately:
+
+    spawn       start the server process (cold path only)
+    handshake   MCP initialize, including server start-up and index open (cold path only)
+    tool_call   KnowledgeTool round trip on a warm pooled session
+    parse       CallToolResult -> KnowledgeNodes, merge and rank
+    join        context string and prompt assembly
+    generation  fake LLM generation
+    total       tool_call through generation
+
+for every combination of corpus size, context count (server top-k) and
+concurrency, reporting p50/p95/p99 and throughput. Results are written as
+JSON; `--compare` checks them against an earlier file and exits non-zero on
+regressions.
+
+    python benchmark.py --corpus-sizes 100,10000 --top-k 1,5 --concurrency 1,8 \\
+        --output bench_results/today.json --compare bench_results/baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import AsyncExitStack
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+
+from generation import FakeGenerator
+from mcp_pool import MCPPooledKnowledgeSource, MCPSessionPool, PoolConfig
+from rag_engine import build_prompt
+from retrieval import MultiSourceRetriever
+
+SERVER = Path(__file__).with_name("my_awesome_mcp_server.py")
+STAGES = ["tool_call", "parse", "join", "generation", "total"]
+
+
+def summarize(samples: list[float]) -> dict[str, float]:
+    """Latency percentiles in milliseconds."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pct(p: float) -> float:
+        return 1000 * ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+    return {
+        "count": len(ordered),
+        "mean": 1000 * statistics.fmean(ordered),
+        "p50": pct(50),
+        "p95": pct(95),
+        "p99": pct(99),
+        "max": 1000 * ordered[-1],
+    }
+
+
+def make_corpus(path: Path, num_docs: int, words_per_doc: int = 120, vocab_size: int = 20_000, seed: int = 0) -> list[str]:
+    """Write `num_docs` synthetic documents; returns the vocabulary for query generation."""
+    rng = random.Random(seed)
+    vocab = [f"term{i}" for i in range(vocab_size)]
+    # Zipf-like word frequencies so posting lists have realistic skew
+    weights = [1 / (rank + 1) for rank in range(vocab_size)]
+    path.mkdir(parents=True, exist_ok=True)
+    for i in range(num_docs):
+        words = rng.choices(vocab, weights=weights, k=words_per_doc)
+        (path / f"doc{i:07d}.txt").write_text(" ".join(words), encoding="utf-8")
+    return vocab
+
+
+def make_queries(vocab: list[str], count: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    head = vocab[: max(10, len(vocab) // 20)]
+    return [" ".join(rng.sample(head, rng.randint(1, 4))) for _ in range(count)]
+
+
+def server_params(docs_dir: Path, index_dir: Path, top_k: int) -> StdioServerParameters:
+    return StdioServerParameters(
+        command=sys.executable,
+        args=[str(SERVER), "--docs-dir", str(docs_dir), "--index-dir", str(index_dir), "--top-k", str(top_k)],
+    )
+
+
+async def measure_cold_start(params: StdioServerParameters, runs: int) -> dict[str, dict[str, float]]:
+    """Time process spawn and the initialize handshake on fresh sessions."""
+    spawn, handshake = [], []
+    for _ in range(runs):
+        async with AsyncExitStack() as stack:
+            start = time.perf_counter()
+            read, write = await stack.enter_async_context(stdio_client(params))
+            spawned = time.perf_counter()
+            session = await stack.enter_async_context(ClientSession(read, write))
+            await session.initialize()
+            spawn.append(spawned - start)
+            handshake.append(time.perf_counter() - spawned)
+    return {"spawn": summarize(spawn), "handshake": summarize(handshake)}
+
+
+async def run_once(source: MCPPooledKnowledgeSource, retriever: MultiSourceRetriever, generator: FakeGenerator, query: str) -> dict[str, float]:
+    timings = {}
+    start = time.perf_counter()
+    result = await source.retrieve(query)
+    t = time.perf_counter()
+    timings["tool_call"] = t - start
+
+    nodes = retriever.merge({source.name: source.call_tool_result_to_knowledge_nodes_list(result)})
+    timings["parse"] = time.perf_counter() - t
+    t = time.perf_counter()
+
+    _, prompt = build_prompt(query, nodes)
+    timings["join"] = time.perf_counter() - t
+    t = time.perf_counter()
+
+    await generator.generate(prompt)
+    timings["generation"] = time.perf_counter() - t
+    timings["total"] = time.perf_counter() - start
+    return timings
+
+
+async def measure_pipeline(
+    source: MCPPooledKnowledgeSource,
+    generator: FakeGenerator,
+    queries: list[str],
+    concurrency: int,
+) -> dict[str, Any]:
+    """Run every query with `concurrency` in flight; per-stage percentiles and throughput."""
+    retriever = MultiSourceRetriever([source])
+    samples: dict[str, list[float]] = {stage: [] for stage in STAGES}
+    todo = iter(queries)
+
+    async def worker():
+        for query in todo:
+            for stage, seconds in (await run_once(source, retriever, generator, query)).items():
+                samples[stage].append(seconds)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    return {
+        "throughput_rps": len(queries) / elapsed,
+        "stages": {stage: summarize(values) for stage, values in samples.items()},
+    }
+
+
+async def benchmark(args: argparse.Namespace, workdir: Path) -> dict[str, Any]:
+    generator = FakeGenerator(first_chunk_delay=args.gen_first_chunk_delay, chunk_delay=args.gen_chunk_delay)
+    report: dict[str, Any] = {"cold_start": {}, "runs": []}
+    for corpus_size in args.corpus_sizes:
+        docs_dir = workdir / f"corpus-{corpus_size}"
+        index_dir = workdir / f"index-{corpus_size}"
+        print(f"Building corpus of {corpus_size} documents…", file=sys.stderr)
+        vocab = make_corpus(docs_dir, corpus_size, seed=args.seed)
+        queries = make_queries(vocab, args.requests, seed=args.seed + 1)
+
+        for top_k in args.top_k:
+            params = server_params(docs_dir, index_dir, top_k)
+            if top_k == args.top_k[0]:
+                # First spawn builds the index; only time warm index opens
+                await measure_cold_start(params, 1)
+                report["cold_start"][str(corpus_size)] = await measure_cold_start(params, args.cold_runs)
+
+            pool = MCPSessionPool(params, PoolConfig(size=max(args.concurrency), min_idle=max(args.concurrency)))
+            try:
+                source = MCPPooledKnowledgeSource(pool, name="bench", tool_name="KnowledgeTool", query_param_name="query")
+                await measure_pipeline(source, generator, queries[: max(args.concurrency)], max(args.concurrency))  # warm-up
+                for concurrency in args.concurrency:
+                    run = await measure_pipeline(source, generator, queries, concurrency)
+                    run.update(corpus_size=corpus_size, top_k=top_k, concurrency=concurrency, requests=len(queries))
+                    report["runs"].append(run)
+                    total = run["stages"]["total"]
+                    print(
+                        f"corpus={corpus_size:>7} top_k={top_k:>2} concurrency={concurrency:>3}  "
+                        f"p50={total['p50']:7.2f}ms p95={total['p95']:7.2f}ms p99={total['p99']:7.2f}ms  "
+                        f"{run['throughput_rps']:8.1f} req/s",
+                        file=sys.stderr,
+                    )
+            finally:
+                pool.close()
+    return report
+
+
+def run_key(run: dict[str, Any]) -> tuple[int, int, int]:
+    return run["corpus_size"], run["top_k"], run["concurrency"]
+
+
+def compare(current: dict[str, Any], baseline: dict[str, Any], threshold: float) -> list[str]:
+    """Describe every stage p95 or throughput that got worse by more than `threshold` (fraction)."""
+    previous = {run_key(run): run for run in baseline.get("runs", [])}
+    regressions = []
+    for run in current["runs"]:
+        old = previous.get(run_key(run))
+        if old is None:
+            continue
+        label = "corpus={} top_k={} concurrency={}".format(*run_key(run))
+        for stage in STAGES:
+            new_p95 = run["stages"][stage].get("p95")
+            old_p95 = old["stages"].get(stage, {}).get("p95")
+            # Ignore sub-millisecond stages: noise dominates
+            if new_p95 and old_p95 and max(new_p95, old_p95) >= 1.0 and new_p95 > old_p95 * (1 + threshold):
+                regressions.append(f"{label}: {stage} p95 {old_p95:.2f}ms -> {new_p95:.2f}ms")
+        if run["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+            regressions.append(f"{label}: throughput {old['throughput_rps']:.1f} -> {run['throughput_rps']:.1f} req/s")
+    return regressions
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True, cwd=SERVER.parent
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def int_list(value: str) -> list[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--corpus-sizes", type=int_list, default=[100, 1_000, 10_000])
+    parser.add_argument("--top-k", type=int_list, default=[1, 3, 10], help="contexts returned per query")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=200, help="queries per configuration")
+    parser.add_argument("--cold-runs", type=int, default=3, help="fresh sessions timed per corpus")
+    parser.add_argument("--gen-first-chunk-delay", type=float, default=0.0)
+    parser.add_argument("--gen-chunk-delay", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workdir", help="keep corpora and indexes here instead of a temp dir")
+    parser.add_argument("--output", default=None, help="results JSON (default: bench_results/<timestamp>.json)")
+    parser.add_argument("--compare", help="earlier results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown before flagging, as a fraction")
+    args = parser.parse_args()
+
+    started = datetime.now(timezone.utc)
+    if args.workdir:
+        report = asyncio.run(benchmark(args, Path(args.workdir)))
+    else:
+        with tempfile.TemporaryDirectory(prefix="noencode-bench-") as tmp:
+            report = asyncio.run(benchmark(args, Path(tmp)))
+    report["meta"] = {
+        "started": started.isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "args": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+    }
+
+    output = Path(args.output or f"bench_results/{started:%Y%m%dT%H%M%SZ}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=2), encoding="utf-8")
+    print(f"Results written to {output}", file=sys.stderr)
+
+    if args.compare:
+        baseline = json.loads(Path(args.compare).read_text(encoding="utf-8"))
+        regressions = compare(report, baseline, args.threshold)
+        for line in regressions:
+            print(f"REGRESSION {line}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+"""
+cache.py
+
+Two-tier TTL cache for retrieval results.
+
+- `LRUCache`: in-process, size-bounded, least-recently-used eviction
+- `SQLiteCache`: optional on-disk tier that survives app restarts
+- `TieredCache`: memory first, then disk (promoting disk hits into memory)
+
+`RetrievalCache` keys entries on (normalized query, source name, tool name,
+hash of the tool call's extra arguments) and stores the `KnowledgeNode`s a source returned.
+"""
+
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+
+from fed_rag.data_structures import KnowledgeNode
+
+
+def normalize_query(query: str) -> str:
+    """Case-fold, collapse whitespace and drop surrounding punctuation."""
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.strip(" ?!.,;:")
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    expirations: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def as_dict(self) -> dict[str, float]:
+        return {**asdict(self), "hit_rate": self.hit_rate}
+
+
+class LRUCache:
+    """Thread-safe in-memory cache with a TTL and an entry limit."""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float | None = 300.0,
+        on_evict: Callable[[str, Any], None] | None = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self.stats = CacheStats()
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            expires, value = entry
+            if expires >= time.time():
+                self._data.move_to_end(key)
+                self.stats.hits += 1
+                return value
+            del self._data[key]
+            self.stats.expirations += 1
+            self.stats.misses += 1
+        if self.on_evict:
+            self.on_evict(key, value)
+        return None
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl is not None else float("inf")
+        evicted = []
+        with self._lock:
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                old_key, (_, old_value) = self._data.popitem(last=False)
+                evicted.append((old_key, old_value))
+                self.stats.evictions += 1
+        if self.on_evict:
+            for old_key, old_value in evicted:
+                self.on_evict(old_key, old_value)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        if entry is not None and self.on_evict:
+            self.on_evict(key, entry[1])
+
+    def clear(self) -> None:
+        with self._lock:
+            entries = list(self._data.items())
+            self._data.clear()
+        if self.on_evict:
+            for key, (_, value) in entries:
+                self.on_evict(key, value)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """On-disk cache of string values with TTL and least-recently-used eviction."""
+
+    def __init__(self, path: str | Path, max_entries: int = 100_000, ttl: float | None = 86_400.0):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.stats = CacheStats()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)")
+
+    def get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats.misses += 1
+                return None
+            value, expires = row
+            if expires < now:
+                self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return None
+            self._conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            self.stats.hits += 1
+            return value
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        now = time.time()
+        ttl = ttl if ttl is not None else self.ttl
+        expires = now + ttl if ttl is not None else float("inf")
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, expires, accessed) VALUES (?, ?, ?, ?)",
+                (key, value, expires, now),
+            )
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()
+            overflow = count - self.max_entries
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed LIMIT ?)", (overflow,)
+                )
+                self.stats.evictions += overflow
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM cache")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+class TieredCache:
+    """Memory tier in front of an optional disk tier.
+
+    The memory tier holds live objects; the disk tier holds `dumps(value)`
+    strings and is read back through `loads`.
+    """
+
+    def __init__(
+        self,
+        memory: LRUCache,
+        disk: SQLiteCache | None = None,
+        dumps: Callable[[Any], str] = json.dumps,
+        loads: Callable[[str], Any] = json.loads,
+    ):
+        self.memory = memory
+        self.disk = disk
+        self.dumps = dumps
+        self.loads = loads
+
+    def get(self, key: str) -> Any | None:
+        value = self.memory.get(key)
+        if value is not None or self.disk is None:
+            return value
+        raw = self.disk.get(key)
+        if raw is None:
+            return None
+        value = self.loads(raw)
+        self.memory.set(key, value)
+        return value
+
+    def set(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        if self.disk is not None:
+            self.disk.set(key, self.dumps(value))
+
+    def clear(self) -> None:
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        stats = {"memory": self.memory.stats.as_dict()}
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats.as_dict()
+        return stats
+
+
+def _dump_nodes(nodes: list[KnowledgeNode]) -> str:
+    return json.dumps([node.model_dump(mode="json") for node in nodes])
+
+
+def _load_nodes(raw: str) -> list[KnowledgeNode]:
+    return [KnowledgeNode.model_validate(entry) for entry in json.loads(raw)]
+
+
+class RetrievalCache:
+    """Per-source retrieval results keyed on (normalized query, source, tool, tool call kwargs)."""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float | None = 300.0,
+        disk_path: str | Path | None = None,
+        disk_max_entries: int = 100_000,
+        disk_ttl: float | None = 86_400.0,
+    ):
+        disk = SQLiteCache(disk_path, max_entries=disk_max_entries, ttl=disk_ttl) if disk_path else None
+        self.cache = TieredCache(LRUCache(max_entries, ttl), disk, dumps=_dump_nodes, loads=_load_nodes)
+
+    @staticmethod
+    def key(query: str, source: str, tool_name: str | None, tool_call_kwargs: dict[str, Any] | None = None) -> str:
+        # Arguments such as a limit or filter change what the tool returns
+        kwargs = json.dumps(tool_call_kwargs or {}, sort_keys=True, default=str)
+        kwargs_hash = hashlib.blake2b(kwargs.encode("utf-8"), digest_size=8).hexdigest()
+        return json.dumps([normalize_query(query), source, tool_name or "", kwargs_hash])
+
+    def get(
+        self, query: str, source: str, tool_name: str | None, tool_call_kwargs: dict[str, Any] | None = None
+    ) -> list[KnowledgeNode] | None:
+        return self.cache.get(self.key(query, source, tool_name, tool_call_kwargs))
+
+    def set(
+        self,
+        query: str,
+        source: str,
+        tool_name: str | None,
+        nodes: list[KnowledgeNode],
+        tool_call_kwargs: dict[str, Any] | None = None,
+    ) -> None:
+        self.cache.set(self.key(query, source, tool_name, tool_call_kwargs), nodes)
+
+    def clear(self) -> None:
+        self.cache.clear()
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        return self.cache.stats()
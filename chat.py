@@ -0,0 +1,329 @@
+"""
+chat.py
+
+Multi-turn chat sessions on top of `RAGEngine`.
+
+A `ChatSession` keeps its recent turns and the nodes retrieved for them, so a
+follow-up question only goes back to the knowledge sources for what is new:
+- content words of the follow-up that neither an earlier question nor a
+  retained node mentions are the "novel" part; with none, the retained
+  nodes are reused and retrieval is skipped altogether
+- otherwise the novel words plus the conversation's topic words (from recent
+  questions) are retrieved, and the new nodes are merged into the retained
+  ones before context assembly
+
+Retained nodes lose `node_decay` of their score per turn and are dropped
+after `max_node_age` turns or beyond `max_nodes`; only the last `max_turns`
+turns are kept, and the prompt carries at most `history_tokens` of them.
+`ChatStore` holds sessions in an LRU with an idle timeout.
+"""
+
+import logging
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field, replace
+from typing import Any
+
+from fed_rag.data_structures import KnowledgeNode
+
+from context_builder import ScoredNodes
+from generation import GenerationStats, estimate_tokens
+from knowledge_index import tokenize
+from rag_engine import Answer, PipelineEvent, RAGEngine, Settings, build_prompt
+from retrieval import RetrievalResult, text_fingerprint
+from telemetry import metrics, span
+
+logger = logging.getLogger(__name__)
+
+# Conversational words that say nothing about what to retrieve
+FILLER_WORDS = frozenset("about again also else explain further me more much other please same so tell".split())
+
+CHAT_PROMPT = "Conversation so far:\n{history}\n\nContext:\n{contexts}\n\nQuestion: {question}"
+
+
+@dataclass
+class ChatTurn:
+    question: str
+    answer: str
+    retrieval_query: str | None  # None when the session's nodes were reused
+    nodes: ScoredNodes
+    stats: GenerationStats
+    asked_at: float = field(default_factory=time.time)
+
+    @property
+    def reused_context(self) -> bool:
+        return self.retrieval_query is None
+
+
+@dataclass
+class _RetainedNode:
+    score: float
+    node: KnowledgeNode
+    terms: frozenset[str]
+    turn: int
+
+
+class ChatSession:
+    """Turns and retrieved nodes of one conversation."""
+
+    def __init__(
+        self,
+        session_id: str,
+        max_turns: int = 8,
+        max_nodes: int = 24,
+        max_node_age: int = 4,
+        node_decay: float = 0.8,
+        history_tokens: int = 600,
+        topic_terms: int = 3,
+    ):
+        self.id = session_id
+        self.max_nodes = max_nodes
+        self.max_node_age = max_node_age
+        self.node_decay = node_decay
+        self.history_tokens = history_tokens
+        self.topic_terms = topic_terms
+        self.turns: deque[ChatTurn] = deque(maxlen=max_turns)
+        self.turn_count = 0
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+        self._nodes: dict[str, _RetainedNode] = {}
+
+    # ------------------------------------------------------------------
+    # Follow-up planning
+    # ------------------------------------------------------------------
+    @staticmethod
+    def terms(text: str) -> list[str]:
+        return [t for t in dict.fromkeys(tokenize(text)) if t not in FILLER_WORDS]
+
+    def known_terms(self) -> set[str]:
+        known = {t for turn in self.turns for t in self.terms(turn.question)}
+        for retained in self._nodes.values():
+            known |= retained.terms
+        return known
+
+    def topic(self) -> list[str]:
+        """Words of recent questions that the retained nodes also contain, most recent first."""
+        grounded = set().union(*(r.terms for r in self._nodes.values()))
+        words: list[str] = []
+        for turn in reversed(self.turns):
+            words.extend(t for t in self.terms(turn.question) if t in grounded and t not in words)
+        return words[: self.topic_terms]
+
+    def followup_query(self, question: str) -> str | None:
+        """What to retrieve for `question`, or None when the retained nodes already cover it."""
+        terms = self.terms(question)
+        if not self.turns or not self._nodes:
+            return question
+        known = self.known_terms()
+        novel = [t for t in terms if t not in known]
+        if not novel:
+            # Also covers stopword-only follow-ups ("and then?"): stay on the topic
+            return None
+        return " ".join(dict.fromkeys([*novel, *self.topic()]))
+
+    # ------------------------------------------------------------------
+    # Retained nodes
+    # ------------------------------------------------------------------
+    def candidates(self, fresh: ScoredNodes | None = None) -> ScoredNodes:
+        """Retained nodes (decayed by age) merged with freshly retrieved ones, best first."""
+        merged: dict[str, tuple[float, KnowledgeNode]] = {}
+        for key, retained in self._nodes.items():
+            age = self.turn_count - retained.turn
+            merged[key] = (retained.score * self.node_decay ** age, retained.node)
+        for score, node in fresh or []:
+            key = text_fingerprint(node.text_content or "")
+            if key not in merged or score > merged[key][0]:
+                merged[key] = (score, node)
+        return sorted(merged.values(), key=lambda item: item[0], reverse=True)
+
+    def retain(self, fresh: ScoredNodes, used: ScoredNodes) -> None:
+        """Keep `fresh` nodes and refresh the age of `used` ones, then apply the caps."""
+        for score, node in fresh:
+            key = text_fingerprint(node.text_content or "")
+            if key not in self._nodes or score >= self._nodes[key].score:
+                self._nodes[key] = _RetainedNode(score, node, frozenset(tokenize(node.text_content or "")), self.turn_count)
+        for _, node in used:
+            retained = self._nodes.get(text_fingerprint(node.text_content or ""))
+            if retained is not None:
+                retained.turn = self.turn_count
+        # 1) Drop nodes unused for too many turns
+        for key in [k for k, r in self._nodes.items() if self.turn_count - r.turn > self.max_node_age]:
+            del self._nodes[key]
+        # 2) Keep the best `max_nodes` by decayed score
+        if len(self._nodes) > self.max_nodes:
+            ranked = sorted(
+                self._nodes.items(),
+                key=lambda item: item[1].score * self.node_decay ** (self.turn_count - item[1].turn),
+                reverse=True,
+            )
+            self._nodes = dict(ranked[: self.max_nodes])
+
+    # ------------------------------------------------------------------
+    # History
+    # ------------------------------------------------------------------
+    def history(self) -> str:
+        """Most recent turns that fit in `history_tokens`, oldest first."""
+        lines: list[str] = []
+        used = 0
+        for turn in reversed(self.turns):
+            entry = f"User: {turn.question}\nAssistant: {turn.answer}"
+            cost = estimate_tokens(entry)
+            if used + cost > self.history_tokens:
+                break
+            lines.append(entry)
+            used += cost
+        return "\n".join(reversed(lines))
+
+    def record(self, turn: ChatTurn) -> None:
+        self.turns.append(turn)
+        self.turn_count += 1
+        self.last_active = time.monotonic()
+
+    def memory_chars(self) -> int:
+        """Characters held by retained nodes and turns, a proxy for the session's memory."""
+        nodes = sum(len(r.node.text_content or "") for r in self._nodes.values())
+        turns = sum(len(t.question) + len(t.answer) for t in self.turns)
+        return nodes + turns
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "session_id": self.id,
+            "turns": self.turn_count,
+            "kept_turns": len(self.turns),
+            "retained_nodes": len(self._nodes),
+            "memory_chars": self.memory_chars(),
+            "reused_turns": sum(turn.reused_context for turn in self.turns),
+        }
+
+
+class ChatStore:
+    """Sessions by id, least recently used first out, expiring after `idle_ttl` seconds."""
+
+    def __init__(self, max_sessions: int = 1000, idle_ttl: float = 3600.0, **session_options: Any):
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.session_options = session_options
+        self._sessions: OrderedDict[str, ChatSession] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    @classmethod
+    def from_settings(cls, get: Settings) -> "ChatStore":
+        return cls(
+            max_sessions=int(get("CHAT_MAX_SESSIONS", 1000)),
+            idle_ttl=float(get("CHAT_SESSION_TTL", 3600)),
+            max_turns=int(get("CHAT_MAX_TURNS", 8)),
+            max_nodes=int(get("CHAT_MAX_NODES", 24)),
+            history_tokens=int(get("CHAT_HISTORY_TOKENS", 600)),
+        )
+
+    def get(self, session_id: str | None = None) -> ChatSession:
+        """The session with `session_id`, or a new one (with a fresh id when none is given)."""
+        now = time.monotonic()
+        with self._lock:
+            for key in [k for k, s in self._sessions.items() if now - s.last_active > self.idle_ttl]:
+                del self._sessions[key]
+                self.evicted += 1
+            session = self._sessions.get(session_id) if session_id else None
+            if session is None:
+                session = ChatSession(session_id or uuid.uuid4().hex, **self.session_options)
+                self._sessions[session.id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+                    self.evicted += 1
+            self._sessions.move_to_end(session.id)
+            session.last_active = now
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            "sessions": len(sessions),
+            "evicted": self.evicted,
+            "memory_chars": sum(s.memory_chars() for s in sessions),
+        }
+
+
+def used_candidates(candidates: ScoredNodes, used: ScoredNodes) -> ScoredNodes:
+    """The candidates behind the context's `used` nodes.
+
+    The context builder truncates nodes that overflow its budget into copies
+    holding a prefix of the text, so those are matched back on that prefix.
+    """
+    by_id = {id(node): (score, node) for score, node in candidates}
+    originals: ScoredNodes = []
+    for _, node in used:
+        if id(node) in by_id:
+            originals.append(by_id[id(node)])
+            continue
+        prefix = _normalize(node.text_content or "").removesuffix(" …")
+        match = next((item for item in candidates if _normalize(item[1].text_content or "").startswith(prefix)), None)
+        if match is not None:
+            originals.append(match)
+    return originals
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+async def chat_stream(
+    engine: RAGEngine, session: ChatSession, question: str, use_cache: bool = True
+) -> AsyncIterator[PipelineEvent]:
+    """One chat turn: "plan" (text is the retrieval query, empty when reusing), "retrieval", "chunk"s, "done".
+
+    The answer cache is not consulted: the prompt depends on the history,
+    which the cache key does not cover.
+    """
+    with session.lock:
+        query = session.followup_query(question)
+    yield PipelineEvent("plan", text=query or "")
+
+    if query is None:
+        logger.debug(f"Chat {session.id}: follow-up covered by retained nodes, skipping retrieval")
+        retrieval = RetrievalResult(nodes=[])
+    else:
+        retrieval = await engine.retrieve(query, use_cache=use_cache)
+    with session.lock:
+        candidates = session.candidates(retrieval.nodes)
+        history = session.history()
+    outcome = replace(retrieval, nodes=candidates)
+    yield PipelineEvent("retrieval", retrieval=outcome)
+
+    with span("prompt_build", contexts=len(candidates), history_chars=len(history)) as attrs:
+        # Topic words keep reranking on subject for terse follow-ups ("and its cost?")
+        focus = " ".join([question, *session.topic()])
+        context = engine.context_builder.build(focus, candidates)
+        contexts, prompt = build_prompt(question, context.nodes)
+        if history:
+            prompt = CHAT_PROMPT.format(history=history, contexts=contexts, question=question)
+        attrs.update(context.as_dict(), reused=query is None)
+    if context.dropped_tokens:
+        metrics.inc("noencode_context_dropped_tokens_total", context.dropped_tokens)
+
+    stats = GenerationStats()
+    parts = []
+    with span("generation", model=engine.generator.model_name) as attrs:
+        async for chunk in engine.generator.stream(prompt, stats):
+            parts.append(chunk)
+            yield PipelineEvent("chunk", text=chunk)
+        attrs.update(tokens=stats.tokens, ttft_ms=round(1000 * (stats.time_to_first_token or 0), 2))
+    text = "".join(parts)
+
+    with session.lock:
+        session.retain(retrieval.nodes, used_candidates(candidates, context.nodes))
+        session.record(ChatTurn(question, text, query, context.nodes, stats))
+    answer = Answer(question, text, outcome, stats, context=context)
+    yield PipelineEvent("done", answer=answer)
@@ -0,0 +1,50 @@
+"""
+compact_results.py
+
+Client side of the knowledge server's "KnowledgeToolRefs" result format.
+
+Instead of every passage being read out of the index, JSON-encoded, piped
+over stdio, decoded and wrapped, the server sends ids, scores and byte ranges
+into its memory-mapped docs.bin (about 80 bytes per hit). The client maps the
+same file once (`knowledge_index.DocumentStore`) and decodes each passage
+straight from the shared pages, so the only other copy left is the final
+prompt join.
+
+Nodes carry `metadata["doc_ref"]` ("path@offset"), which
+`MultiSourceRetriever.merge` uses as the duplicate key instead of hashing the
+passage text.
+
+This needs the client to see the server's index directory, so it suits stdio
+servers on the same machine; sources opt in with `"compact": true`.
+"""
+
+import json
+from typing import Any
+
+from fed_rag.data_structures import KnowledgeNode
+from mcp.types import CallToolResult, TextContent
+
+from knowledge_index import DocumentStore
+
+REFS_TOOL = "KnowledgeToolRefs"
+
+
+def doc_refs_converter(result: CallToolResult, metadata: dict[str, Any] | None = None) -> list[KnowledgeNode]:
+    """Nodes for a `KnowledgeToolRefs` result, reading referenced passages from the shared docs.bin."""
+    text = "".join(c.text for c in result.content if isinstance(c, TextContent))
+    if result.isError:
+        raise RuntimeError(f"{REFS_TOOL} failed: {text}")
+    payload = json.loads(text)
+    info = payload.get("store")
+    store = DocumentStore.open(info["path"], info["inode"], info["size"]) if info else None
+
+    nodes = []
+    for hit in payload["hits"]:
+        extra = {"score": hit["score"], "doc_id": hit["doc_id"]}
+        if "offset" in hit:
+            passage = store.text(hit["offset"], hit["length"])
+            extra["doc_ref"] = f"{store.path}@{hit['offset']}"
+        else:
+            passage = hit["text"]
+        nodes.append(KnowledgeNode(node_type="text", text_content=passage, metadata={**(metadata or {}), **extra}))
+    return nodes
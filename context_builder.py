@@ -0,0 +1,262 @@
+"""
+context_builder.py
+
+Context assembly between retrieval and generation.
+
+Retrieved nodes are not pasted into the prompt as-is. `ContextBuilder`:
+1. drops near-duplicates (word-shingle Jaccard similarity above a threshold),
+2. reranks what is left (`LexicalReranker`, or `CrossEncoderReranker` with a
+   local sentence-transformers model),
+3. packs nodes best-first into a token budget, cutting the node that does not
+   fit at a sentence boundary rather than mid-word,
+and reports how many tokens and nodes were left out.
+"""
+
+import math
+import re
+import threading
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from fed_rag.data_structures import KnowledgeNode
+
+from generation import estimate_tokens
+from knowledge_index import tokenize
+
+DEFAULT_CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+CONTEXT_SEPARATOR = "\n---\n"
+
+SENTENCE_END_RE = re.compile(r"(?<=[.!?])\s+|\n{2,}")
+
+ScoredNodes = list[tuple[float, KnowledgeNode]]
+
+
+def shingles(text: str, size: int = 3) -> set[tuple[str, ...]]:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i : i + size]) for i in range(len(words) - size + 1)}
+
+
+def jaccard(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def dedupe(nodes: ScoredNodes, threshold: float = 0.85) -> tuple[ScoredNodes, int]:
+    """Keep the first (best-scored) of each group of near-identical nodes; returns kept nodes and the number dropped."""
+    kept: ScoredNodes = []
+    seen: list[set] = []
+    for score, node in nodes:
+        sig = shingles(node.text_content or "")
+        if any(jaccard(sig, other) >= threshold for other in seen):
+            continue
+        kept.append((score, node))
+        seen.append(sig)
+    return kept, len(nodes) - len(kept)
+
+
+def truncate_to_budget(text: str, max_tokens: int, count_tokens: Callable[[str], int] = estimate_tokens) -> str:
+    """Longest prefix of whole sentences within `max_tokens`; falls back to whole words."""
+    if count_tokens(text) <= max_tokens:
+        return text
+    kept = ""
+    for sentence in SENTENCE_END_RE.split(text):
+        candidate = f"{kept} {sentence}" if kept else sentence
+        if count_tokens(candidate) > max_tokens:
+            break
+        kept = candidate
+    if kept:
+        return kept
+    # First sentence alone is over budget: cut on a word boundary
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if count_tokens(" ".join(words[:mid]) + " …") <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return " ".join(words[:lo]) + " …" if lo else ""
+
+
+class BaseReranker:
+    """Reorders scored nodes for a query; returned scores replace the retrieval scores."""
+
+    def rerank(self, query: str, nodes: ScoredNodes) -> ScoredNodes:
+        raise NotImplementedError
+
+
+class LexicalReranker(BaseReranker):
+    """BM25-style query-term overlap blended with the retrieval score.
+
+    Document frequencies come from the candidate set itself, so no index is
+    needed. Both signals are scaled to [0, 1]; `retrieval_weight` sets the
+    share of the original score in the result.
+    """
+
+    def __init__(self, retrieval_weight: float = 0.5, k1: float = 1.2, b: float = 0.75):
+        self.retrieval_weight = retrieval_weight
+        self.k1 = k1
+        self.b = b
+
+    def rerank(self, query: str, nodes: ScoredNodes) -> ScoredNodes:
+        terms = set(tokenize(query))
+        if not nodes or not terms:
+            return list(nodes)
+        docs = [Counter(tokenize(node.text_content or "")) for _, node in nodes]
+        avg_len = sum(sum(d.values()) for d in docs) / len(docs) or 1.0
+        df = {t: sum(1 for d in docs if t in d) for t in terms}
+
+        lexical = []
+        for doc in docs:
+            length = sum(doc.values())
+            score = 0.0
+            for t in terms:
+                tf = doc.get(t, 0)
+                if tf:
+                    idf = math.log(1 + (len(docs) - df[t] + 0.5) / (df[t] + 0.5))
+                    score += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * length / avg_len))
+            lexical.append(score)
+
+        top_lexical = max(lexical) or 1.0
+        top_retrieval = max(score for score, _ in nodes) or 1.0
+        w = self.retrieval_weight
+        rescored = [
+            (w * score / top_retrieval + (1 - w) * lex / top_lexical, node)
+            for (score, node), lex in zip(nodes, lexical)
+        ]
+        return sorted(rescored, key=lambda item: item[0], reverse=True)
+
+
+class CrossEncoderReranker(BaseReranker):
+    """Scores (query, passage) pairs with a local cross-encoder; the model is loaded on first use."""
+
+    def __init__(self, model_name: str = DEFAULT_CROSS_ENCODER_MODEL, max_candidates: int = 32):
+        self.model_name = model_name
+        self.max_candidates = max_candidates
+        self._model = None
+        self._lock = threading.Lock()
+
+    def rerank(self, query: str, nodes: ScoredNodes) -> ScoredNodes:
+        if not nodes:
+            return []
+        with self._lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+
+                self._model = CrossEncoder(self.model_name)
+        # Only the head is worth a forward pass; the tail keeps its order below it
+        head, tail = nodes[: self.max_candidates], nodes[self.max_candidates :]
+        scores = self._model.predict([(query, node.text_content or "") for _, node in head])
+        floor = min(float(s) for s in scores)
+        rescored = sorted(((float(s), node) for s, (_, node) in zip(scores, head)), key=lambda item: item[0], reverse=True)
+        return rescored + [(floor - 1 - i, node) for i, (_, node) in enumerate(tail)]
+
+
+def make_reranker(name: str | None, model_name: str | None = None) -> BaseReranker | None:
+    """"lexical", "cross-encoder" or ""/"none" (keep retrieval order)."""
+    if not name or name == "none":
+        return None
+    if name == "lexical":
+        return LexicalReranker()
+    if name == "cross-encoder":
+        return CrossEncoderReranker(model_name or DEFAULT_CROSS_ENCODER_MODEL)
+    raise ValueError(f"Unknown reranker: {name!r}")
+
+
+@dataclass
+class AssembledContext:
+    """What went into the prompt and what was left out."""
+
+    nodes: ScoredNodes
+    contexts: str
+    tokens: int
+    dropped_tokens: int = 0
+    dropped_nodes: int = 0
+    truncated_nodes: int = 0
+    duplicates: int = 0
+
+    def as_dict(self) -> dict[str, int]:
+        return {
+            "nodes": len(self.nodes),
+            "tokens": self.tokens,
+            "dropped_tokens": self.dropped_tokens,
+            "dropped_nodes": self.dropped_nodes,
+            "truncated_nodes": self.truncated_nodes,
+            "duplicates": self.duplicates,
+        }
+
+
+class ContextBuilder:
+    """Dedupe, rerank and pack retrieved nodes into `max_tokens` of context.
+
+    `max_tokens=None` disables the budget. A node that does not fit whole is
+    truncated when at least `min_chunk_tokens` of budget remain, otherwise
+    skipped; later, shorter nodes may still fit. `count_tokens` defaults to
+    the same ~4 characters per token estimate used for generation stats.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int | None = 2000,
+        reranker: BaseReranker | None = None,
+        dedupe_threshold: float | None = 0.85,
+        min_chunk_tokens: int = 32,
+        separator: str = CONTEXT_SEPARATOR,
+        count_tokens: Callable[[str], int] = estimate_tokens,
+    ):
+        self.max_tokens = max_tokens
+        self.reranker = reranker
+        self.dedupe_threshold = dedupe_threshold
+        self.min_chunk_tokens = min_chunk_tokens
+        self.separator = separator
+        self.count_tokens = count_tokens
+
+    def build(self, query: str, nodes: ScoredNodes) -> AssembledContext:
+        # 1) Near-duplicate removal (exact duplicates are already merged by the retriever)
+        duplicates = 0
+        if self.dedupe_threshold is not None:
+            nodes, duplicates = dedupe(nodes, self.dedupe_threshold)
+
+        # 2) Rerank
+        if self.reranker is not None:
+            nodes = self.reranker.rerank(query, nodes)
+
+        # 3) Pack best-first into the budget
+        packed: ScoredNodes = []
+        used = dropped_tokens = dropped_nodes = truncated = 0
+        separator_tokens = self.count_tokens(self.separator)
+        for score, node in nodes:
+            text = node.text_content or ""
+            tokens = self.count_tokens(text)
+            cost = tokens + (separator_tokens if packed else 0)
+            if self.max_tokens is None or used + cost <= self.max_tokens:
+                packed.append((score, node))
+                used += cost
+                continue
+            room = self.max_tokens - used - (separator_tokens if packed else 0)
+            cut = truncate_to_budget(text, room, self.count_tokens) if room >= self.min_chunk_tokens else ""
+            if cut:
+                kept_tokens = self.count_tokens(cut)
+                node = node.model_copy(update={"text_content": cut, "metadata": {**(node.metadata or {}), "truncated": True}})
+                packed.append((score, node))
+                used += kept_tokens + (separator_tokens if len(packed) > 1 else 0)
+                dropped_tokens += tokens - kept_tokens
+                truncated += 1
+            else:
+                dropped_tokens += tokens
+                dropped_nodes += 1
+
+        contexts = self.separator.join(node.text_content or "" for _, node in packed)
+        return AssembledContext(
+            nodes=packed,
+            contexts=contexts,
+            tokens=used,
+            dropped_tokens=dropped_tokens,
+            dropped_nodes=dropped_nodes,
+            truncated_nodes=truncated,
+            duplicates=duplicates,
+        )
@@ -0,0 +1,182 @@
+"""
+generation.py
+
+Answer generators for the NoEncode pipeline.
+
+Both generators expose the same two coroutines:
+- `stream(prompt, stats)` yields text chunks as they arrive
+- `generate(prompt, stats)` returns the full answer
+
+`GeminiGenerator` wraps a `google.generativeai.GenerativeModel`;
+`FakeGenerator` emits canned chunks with configurable delays so the pipeline
+can be exercised offline.
+"""
+
+import asyncio
+import threading
+import time
+from collections.abc import AsyncIterator, Iterable
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token for English text)."""
+    return max(1, (len(text) + 3) // 4) if text else 0
+
+
+class GenerationStats:
+    """Timing for one generation: time-to-first-token and throughput."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.first_chunk_at: float | None = None
+        self.finished_at: float | None = None
+        self.chunks = 0
+        self.tokens = 0
+
+    def add_chunk(self, text: str) -> None:
+        if self.first_chunk_at is None:
+            self.first_chunk_at = time.perf_counter()
+        self.chunks += 1
+        self.tokens += estimate_tokens(text)
+
+    def finish(self, tokens: int | None = None) -> None:
+        """Mark the end of generation; `tokens` overrides the estimate when the backend reports usage."""
+        self.finished_at = time.perf_counter()
+        if tokens:
+            self.tokens = tokens
+
+    @property
+    def time_to_first_token(self) -> float | None:
+        if self.first_chunk_at is None:
+            return None
+        return self.first_chunk_at - self.started
+
+    @property
+    def total_time(self) -> float:
+        end = self.finished_at if self.finished_at is not None else time.perf_counter()
+        return end - self.started
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.tokens / self.total_time if self.total_time > 0 else 0.0
+
+    def as_dict(self) -> dict[str, float | int | None]:
+        return {
+            "time_to_first_token": self.time_to_first_token,
+            "total_time": self.total_time,
+            "chunks": self.chunks,
+            "tokens": self.tokens,
+            "tokens_per_sec": self.tokens_per_sec,
+        }
+
+
+class BaseGenerator:
+    """Common `generate()` built on top of a subclass's `stream()`."""
+
+    model_name: str = "unknown"
+
+    async def stream(self, prompt: str, stats: GenerationStats | None = None) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield  # pragma: no cover
+
+    async def generate(self, prompt: str, stats: GenerationStats | None = None) -> str:
+        parts = [chunk async for chunk in self.stream(prompt, stats)]
+        return "".join(parts)
+
+
+class GeminiGenerator(BaseGenerator):
+    """Streams from a Gemini `GenerativeModel`.
+
+    The SDK's async client is bound to the loop it was first used on, so the
+    blocking `stream=True` iterator is drained on a worker thread instead and
+    chunks are handed back to whichever loop is awaiting them. A consumer
+    that stops early (cancelled, timed out, disconnected) does not wait for
+    that thread: it is told to stop at the next chunk and left to wind down.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.model_name = model.model_name
+
+    async def stream(self, prompt: str, stats: GenerationStats | None = None) -> AsyncIterator[str]:
+        stats = stats or GenerationStats()
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+        done = object()
+        usage: dict[str, int] = {}
+        stop = threading.Event()
+
+        def put(item) -> None:
+            if not stop.is_set():
+                try:
+                    loop.call_soon_threadsafe(queue.put_nowait, item)
+                except RuntimeError:  # the consumer's loop is already closed
+                    stop.set()
+
+        def produce():
+            try:
+                for chunk in self.model.generate_content(prompt, stream=True):
+                    if stop.is_set():
+                        break
+                    metadata = getattr(chunk, "usage_metadata", None)
+                    if metadata is not None and getattr(metadata, "candidates_token_count", 0):
+                        usage["tokens"] = metadata.candidates_token_count
+                    put(chunk.text)
+            except Exception as e:
+                put(e)
+            finally:
+                put(done)
+
+        producer = loop.run_in_executor(None, produce)
+        finished = False
+        try:
+            while (item := await queue.get()) is not done:
+                if isinstance(item, Exception):
+                    raise item
+                if item:
+                    stats.add_chunk(item)
+                    yield item
+            finished = True
+        finally:
+            if finished:
+                await producer
+            else:
+                # Blocking on the thread here would hold up cancellation until Gemini answers
+                stop.set()
+                producer.add_done_callback(lambda f: f.cancelled() or f.exception())
+            stats.finish(usage.get("tokens"))
+
+
+class FakeGenerator(BaseGenerator):
+    """Offline stand-in for Gemini that emits chunks with configurable delays.
+
+    With no `chunks`, the answer echoes the question found in the prompt.
+    """
+
+    def __init__(
+        self,
+        chunks: Iterable[str] | None = None,
+        first_chunk_delay: float = 0.0,
+        chunk_delay: float = 0.0,
+        model_name: str = "fake",
+    ):
+        self.chunks = list(chunks) if chunks is not None else None
+        self.first_chunk_delay = first_chunk_delay
+        self.chunk_delay = chunk_delay
+        self.model_name = model_name
+
+    def _chunks_for(self, prompt: str) -> list[str]:
+        if self.chunks is not None:
+            return self.chunks
+        question = prompt.rsplit("Question:", 1)[-1].strip()
+        return [f"{word} " for word in f"Fake answer to: {question}".split()]
+
+    async def stream(self, prompt: str, stats: GenerationStats | None = None) -> AsyncIterator[str]:
+        stats = stats or GenerationStats()
+        try:
+            for i, chunk in enumerate(self._chunks_for(prompt)):
+                await asyncio.sleep(self.first_chunk_delay if i == 0 else self.chunk_delay)
+                stats.add_chunk(chunk)
+                yield chunk
+        finally:
+            stats.finish()
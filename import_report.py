@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+import_report.py
+
+Import-time report for the app's dependencies.
+
+Each module is imported in a fresh interpreter, so the numbers are cold,
+first-import costs and do not hide behind modules an earlier import already
+loaded. `--breakdown` adds the slowest nested imports from
+`python -X importtime`.
+
+    python import_report.py
+    python import_report.py fed_rag torch --breakdown 10 --json import_times.json
+"""
+
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent
+
+# What app.py loads before the first render, then what it defers
+EAGER_MODULES = ["streamlit", "nest_asyncio", "telemetry"]
+DEFERRED_MODULES = ["google.generativeai", "mcp", "fed_rag", "torch", "rag_engine"]
+
+
+def import_seconds(module: str, runs: int = 1) -> float:
+    """Best-of-`runs` wall time to import `module` in a clean interpreter."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    best = float("inf")
+    for _ in range(runs):
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, cwd=ROOT)
+        if out.returncode != 0:
+            raise RuntimeError(f"import {module} failed: {out.stderr.strip().splitlines()[-1:]}")
+        best = min(best, float(out.stdout.strip().splitlines()[-1]))
+    return best
+
+
+def import_breakdown(module: str, top: int = 10) -> list[tuple[str, float]]:
+    """Slowest nested imports of `module` by cumulative seconds, from `-X importtime`."""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, cwd=ROOT
+    )
+    rows = []
+    for line in out.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        rows.append((name.strip(), int(cumulative) / 1e6))
+    return sorted(rows, key=lambda row: row[1], reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", help="modules to time (default: the app's eager and deferred imports)")
+    parser.add_argument("--runs", type=int, default=3, help="fresh interpreters per module; the best time is kept")
+    parser.add_argument("--breakdown", type=int, default=0, metavar="N", help="also list the N slowest nested imports")
+    parser.add_argument("--json", help="write the report to this file")
+    args = parser.parse_args()
+
+    groups = {"modules": args.modules} if args.modules else {"eager": EAGER_MODULES, "deferred": DEFERRED_MODULES}
+    report: dict[str, dict[str, float]] = {}
+    for group, modules in groups.items():
+        report[group] = {}
+        print(f"{group}:")
+        for module in modules:
+            try:
+                seconds = import_seconds(module, args.runs)
+            except RuntimeError as e:
+                print(f"  {module:<24} {e}")
+                continue
+            report[group][module] = seconds
+            print(f"  {module:<24} {seconds * 1000:8.0f} ms")
+            for name, cumulative in import_breakdown(module, args.breakdown) if args.breakdown else []:
+                print(f"      {name:<30} {cumulative * 1000:8.0f} ms")
+    if "eager" in report:
+        # Modules overlap (rag_engine imports fed_rag, ...), so the largest single import is the floor
+        print(f"before first render: ~{sum(report['eager'].values()) * 1000:.0f} ms; "
+              f"deferred until first query: >= {max(report['deferred'].values(), default=0) * 1000:.0f} ms")
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
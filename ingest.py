@@ -0,0 +1,332 @@
+"""
+ingest.py
+
+Incremental, streaming ingestion of a document directory into a `BM25Index`.
+
+Files are split into chunks of about `chunk_chars` characters (on paragraph,
+then sentence boundaries), indexed as `<relative path>#<n>`. A manifest next
+to the index records each file's size, mtime and chunk hashes, so a run:
+- skips files whose size and mtime are unchanged, without reading them
+- re-chunks changed files and re-indexes only the chunks whose hash changed
+- deletes the chunks of removed files, and trailing chunks of shrunk ones
+
+Files are read one at a time and pending changes are folded into the base
+segment every `save_every` chunks, so memory does not grow with corpus text
+(the manifest holds only sizes, mtimes and 16-byte hashes); the reported peak
+RSS also counts the memory-mapped index pages, which do grow with the corpus
+but belong to the page cache. Each save rewrites the base segment, so a larger
+`save_every` trades memory for fewer rewrites. `BM25Index.save()` writes
+outside the index lock, so a running server keeps answering queries while
+`Ingestor.start()` re-ingests on a background thread.
+
+    python ingest.py --docs-dir docs --index-dir .index
+    python ingest.py --docs-dir docs --index-dir .index --watch 10
+
+`knowledge_index.open_index` refreshes an index that has a manifest through
+`Ingestor.from_manifest`, so the server's default start-up keeps the chunk ids.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections.abc import Iterator
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any
+
+from knowledge_index import BM25Index, Shard, index_lock, iter_document_paths, shard_index_dir
+
+try:
+    import resource
+except ImportError:  # Windows: no peak RSS in reports
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+MANIFEST_VERSION = 1
+PARAGRAPH_RE = re.compile(r"\n\s*\n")
+SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def chunk_text(text: str, chunk_chars: int = 1500) -> list[str]:
+    """Split `text` into chunks of at most about `chunk_chars`, packing whole paragraphs.
+
+    Paragraphs longer than `chunk_chars` are split at sentence ends, and
+    sentences longer than that at whitespace.
+    """
+    pieces: list[str] = []
+    for paragraph in PARAGRAPH_RE.split(text):
+        paragraph = paragraph.strip()
+        if len(paragraph) <= chunk_chars:
+            pieces.append(paragraph)
+            continue
+        for sentence in SENTENCE_RE.split(paragraph):
+            while len(sentence) > chunk_chars:
+                cut = sentence.rfind(" ", 0, chunk_chars)
+                cut = cut if cut > 0 else chunk_chars
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            pieces.append(sentence)
+
+    chunks: list[str] = []
+    current = ""
+    for piece in filter(None, pieces):
+        if current and len(current) + 2 + len(piece) > chunk_chars:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_hash(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def chunk_id(doc_id: str, n: int) -> str:
+    return f"{doc_id}#{n}"
+
+
+def manifest_path(index_dir: str | Path) -> Path:
+    """Beside the index directory, which `save()` replaces wholesale."""
+    index_dir = Path(index_dir)
+    return index_dir.with_name(f"{index_dir.name}.manifest.json")
+
+
+@dataclass
+class IngestReport:
+    files: int = 0
+    changed_files: int = 0
+    deleted_files: int = 0
+    added_chunks: int = 0
+    updated_chunks: int = 0
+    deleted_chunks: int = 0
+    unchanged_chunks: int = 0
+    saves: int = 0
+    seconds: float = 0.0
+    peak_rss_mb: float = 0.0
+
+    @property
+    def docs_per_sec(self) -> float:
+        """Added or changed files ingested per second (unchanged files cost only a stat)."""
+        return self.changed_files / self.seconds if self.seconds else 0.0
+
+    @property
+    def changes(self) -> int:
+        return self.added_chunks + self.updated_chunks + self.deleted_chunks
+
+    def as_dict(self) -> dict[str, Any]:
+        return {**asdict(self), "docs_per_sec": round(self.docs_per_sec, 1), "seconds": round(self.seconds, 3)}
+
+    def summary(self) -> str:
+        return (
+            f"{self.files} files scanned, {self.changed_files} ingested ({self.docs_per_sec:.0f} docs/s), "
+            f"{self.deleted_files} removed in {self.seconds:.2f}s; chunks +{self.added_chunks} ~{self.updated_chunks} "
+            f"-{self.deleted_chunks} ={self.unchanged_chunks}; {self.saves} saves, peak RSS {self.peak_rss_mb:.0f} MB"
+        )
+
+
+class Ingestor:
+    """Keeps `index` in line with `docs_dir`, chunk by chunk, from a manifest of chunk hashes."""
+
+    def __init__(
+        self,
+        index: BM25Index,
+        docs_dir: str | Path,
+        shard: Shard | None = None,
+        chunk_chars: int = 1500,
+        save_every: int = 2000,
+    ):
+        if index.path is None:
+            raise ValueError("Ingestion needs an index with a path to save to.")
+        self.index = index
+        self.docs_dir = Path(docs_dir)
+        self.shard = shard
+        self.chunk_chars = chunk_chars
+        self.save_every = save_every
+        self.manifest_path = manifest_path(index.path)
+        self.manifest = self._load_manifest()
+        self.last_report: IngestReport | None = None
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+
+    @classmethod
+    def from_manifest(cls, index: BM25Index, docs_dir: str | Path, shard: Shard | None = None) -> "Ingestor | None":
+        """An ingestor with the chunk settings of `index`'s manifest, or None if it was never ingested into."""
+        try:
+            with open(manifest_path(index.path), encoding="utf-8") as f:
+                chunk_chars = json.load(f).get("chunk_chars")
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        return cls(index, docs_dir, shard, chunk_chars=chunk_chars) if chunk_chars else None
+
+    def _load_manifest(self) -> dict[str, dict[str, Any]]:
+        try:
+            with open(self.manifest_path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        # Chunking settings change every chunk boundary; start over
+        if data.get("version") != MANIFEST_VERSION or data.get("chunk_chars") != self.chunk_chars:
+            logger.info(f"Manifest {self.manifest_path} is for other chunk settings; re-ingesting everything")
+            return {}
+        return data["files"]
+
+    def _save(self, report: IngestReport) -> None:
+        """Persist the index, then the manifest describing it, so a crash leaves the two consistent."""
+        if self.index.pending_changes:
+            self.index.save()
+        tmp = self.manifest_path.with_suffix(".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"version": MANIFEST_VERSION, "chunk_chars": self.chunk_chars, "files": self.manifest}, f)
+        os.replace(tmp, self.manifest_path)
+        report.saves += 1
+
+    def _unchanged(self, doc_id: str, entry: dict[str, Any] | None, stat: os.stat_result) -> bool:
+        # The index can have been rebuilt without the manifest (e.g. by `open_index`)
+        return (
+            entry is not None
+            and entry["size"] == stat.st_size
+            and entry["mtime_ns"] == stat.st_mtime_ns
+            and (not entry["chunks"] or chunk_id(doc_id, 0) in self.index)
+        )
+
+    def _apply(self, doc_id: str, chunks: list[str], old_hashes: list[str], report: IngestReport) -> list[str]:
+        hashes = [chunk_hash(chunk) for chunk in chunks]
+        for n, (chunk, digest) in enumerate(zip(chunks, hashes)):
+            if n < len(old_hashes) and old_hashes[n] == digest and chunk_id(doc_id, n) in self.index:
+                report.unchanged_chunks += 1
+                continue
+            if n < len(old_hashes):
+                report.updated_chunks += 1
+            else:
+                report.added_chunks += 1
+            self.index.add(chunk_id(doc_id, n), chunk)
+        for n in range(len(chunks), len(old_hashes)):
+            self.index.delete(chunk_id(doc_id, n))
+            report.deleted_chunks += 1
+        return hashes
+
+    def _changed_files(self, report: IngestReport, seen: set[str]) -> Iterator[tuple[str, Path, os.stat_result]]:
+        for doc_id, file in iter_document_paths(self.docs_dir, self.shard):
+            seen.add(doc_id)
+            report.files += 1
+            try:
+                stat = file.stat()
+            except FileNotFoundError:
+                continue
+            if not self._unchanged(doc_id, self.manifest.get(doc_id), stat):
+                yield doc_id, file, stat
+
+    def run_once(self) -> IngestReport:
+        """One pass over `docs_dir`; saves whenever `save_every` chunk changes are pending, and at the end."""
+        report = IngestReport()
+        start = time.perf_counter()
+        seen: set[str] = set()
+        pending = 0
+
+        # 1) Added and changed files, one at a time
+        for doc_id, file, stat in self._changed_files(report, seen):
+            if self._stop.is_set():
+                break
+            try:
+                text = file.read_text(encoding="utf-8", errors="replace")
+            except FileNotFoundError:
+                continue
+            before = report.changes
+            old = self.manifest.get(doc_id, {}).get("chunks", [])
+            hashes = self._apply(doc_id, chunk_text(text, self.chunk_chars), old, report)
+            self.manifest[doc_id] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "chunks": hashes}
+            report.changed_files += 1
+            pending += report.changes - before
+            if pending >= self.save_every:
+                self._save(report)
+                pending = 0
+        else:
+            # 2) Removed files: in the manifest but no longer on disk (only after a complete walk)
+            for doc_id in [d for d in self.manifest if d not in seen]:
+                for n in range(len(self.manifest.pop(doc_id)["chunks"])):
+                    self.index.delete(chunk_id(doc_id, n))
+                    report.deleted_chunks += 1
+                report.deleted_files += 1
+            # 3) Documents no manifest entry accounts for, e.g. whole-file ids from `open_index`
+            live = {chunk_id(d, n) for d, entry in self.manifest.items() for n in range(len(entry["chunks"]))}
+            for stray in [d for d in self.index.doc_ids() if d not in live]:
+                self.index.delete(stray)
+                report.deleted_chunks += 1
+
+        if self.index.pending_changes or report.changed_files or report.deleted_files:
+            self._save(report)
+        report.seconds = time.perf_counter() - start
+        if resource is not None:
+            report.peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        self.last_report = report
+        return report
+
+    # ------------------------------------------------------------------
+    # Background ingestion
+    # ------------------------------------------------------------------
+    def start(self, interval: float) -> threading.Thread:
+        """Re-ingest every `interval` seconds on a daemon thread; queries are served meanwhile."""
+
+        def loop():
+            while not self._stop.is_set():
+                try:
+                    # Other processes may refresh the same directory (`open_index`, `python ingest.py`)
+                    with index_lock(self.index.path):
+                        report = self.run_once()
+                    if report.changes or report.deleted_files:
+                        logger.info(f"Ingested {self.docs_dir}: {report.summary()}")
+                except Exception as e:
+                    logger.exception(f"Ingestion of {self.docs_dir} failed: {e}")
+                self._stop.wait(interval)
+
+        self._thread = threading.Thread(target=loop, name="ingest", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Finish the current file, save, and end the background thread."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+
+def ingest_directory(
+    docs_dir: str | Path, index_dir: str | Path, shard: Shard | None = None, chunk_chars: int = 1500,
+    save_every: int = 2000,
+) -> IngestReport:
+    """One locked ingestion pass from the command line or a job."""
+    index_dir = shard_index_dir(index_dir, shard)
+    with index_lock(index_dir):
+        index = BM25Index(index_dir)
+        return Ingestor(index, docs_dir, shard, chunk_chars, save_every).run_once()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incrementally ingest a document directory into the BM25 index")
+    parser.add_argument("--docs-dir", default=os.environ.get("KNOWLEDGE_DOCS_DIR", "docs"))
+    parser.add_argument("--index-dir", default=os.environ.get("KNOWLEDGE_INDEX_DIR", ".index"))
+    parser.add_argument("--chunk-chars", type=int, default=1500, help="target chunk size in characters")
+    parser.add_argument("--save-every", type=int, default=2000, help="chunk changes held in memory between saves")
+    parser.add_argument("--shard", type=int, default=os.environ.get("KNOWLEDGE_SHARD"))
+    parser.add_argument("--num-shards", type=int, default=os.environ.get("KNOWLEDGE_NUM_SHARDS"))
+    parser.add_argument("--watch", type=float, default=0, help="re-ingest every N seconds until interrupted")
+    parser.add_argument("--json", action="store_true", help="print each report as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    this_shard = (args.shard, args.num_shards) if args.shard is not None and (args.num_shards or 0) > 1 else None
+
+    while True:
+        result = ingest_directory(args.docs_dir, args.index_dir, this_shard, args.chunk_chars, args.save_every)
+        print(json.dumps(result.as_dict()) if args.json else result.summary(), flush=True)
+        if args.watch <= 0:
+            break
+        time.sleep(args.watch)
@@ -0,0 +1,640 @@
+"""
+knowledge_index.py
+
+BM25 inverted index behind the MCP `KnowledgeTool`.
+
+Lexical retrieval only: no embedding model is loaded. The index has two parts:
+- a base segment persisted to a directory and memory-mapped on open, so
+  start-up cost does not grow with corpus text size
+- an in-memory delta segment for documents added or replaced since the last
+  `save()`, plus tombstones for deleted base documents
+
+`save()` folds the delta into a new base segment (written to a temporary
+directory and swapped in), so the index can be updated incrementally.
+
+A corpus too large for one server can be split into shards by a hash of the
+document id (`shard_of`); each shard keeps its own index directory.
+
+On-disk layout of an index directory:
+    meta.json      format version, BM25 parameters, corpus statistics
+    lexicon.json   term -> [first posting, posting count]
+    postings.bin   uint32 (doc, term frequency) pairs, grouped by term
+    doc_ids.json   external document ids, by internal doc number
+    lengths.bin    uint32 token count per doc
+    offsets.bin    uint64 byte offsets into docs.bin (num_docs + 1 entries)
+    docs.bin       UTF-8 document text, concatenated
+
+`search(..., with_text=False)` returns offsets into docs.bin instead of text,
+so a client on the same machine can read passages through its own mapping
+(`DocumentStore`) rather than receive copies.
+"""
+
+import hashlib
+import heapq
+import json
+import logging
+import math
+import mmap
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+from collections.abc import Iterable, Iterator
+from contextlib import contextmanager
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process locking
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+TEXT_SUFFIXES = {".txt", ".md", ".rst", ".html", ".htm", ".csv", ".json"}
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in into is it its of on or "
+    "that the their then there these this to was were what when where which who why will with you your".split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    """Lower-cased alphanumeric tokens with English stopwords removed."""
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+@dataclass
+class SearchHit:
+    """One result; `offset`/`length` locate a base-segment document's bytes in docs.bin."""
+
+    doc_id: str
+    score: float
+    text: str
+    offset: int | None = None
+    length: int | None = None
+
+
+def _map_array(path: Path, dtype) -> np.ndarray:
+    """Read-only, zero-copy view of a binary file (empty files cannot be mapped)."""
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return np.frombuffer(mm, dtype=dtype)
+
+
+class _BaseSegment:
+    """The persisted, immutable part of the index."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        with open(path / "lexicon.json", encoding="utf-8") as f:
+            self.lexicon: dict[str, list[int]] = json.load(f)
+        with open(path / "doc_ids.json", encoding="utf-8") as f:
+            self.doc_ids: list[str] = json.load(f)
+        self.doc_index = {doc_id: i for i, doc_id in enumerate(self.doc_ids)}
+        self.postings = _map_array(path / "postings.bin", np.uint32).reshape(-1, 2)
+        self.lengths = _map_array(path / "lengths.bin", np.uint32)
+        self.offsets = _map_array(path / "offsets.bin", np.uint64)
+        with open(path / "docs.bin", "rb") as f:
+            # Identifies the mapped file even after `save()` swaps in a new one
+            self.docs_stat = os.fstat(f.fileno())
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.docs_stat.st_size else b""
+        self.docs = np.frombuffer(mm, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def term_postings(self, term: str) -> tuple[np.ndarray, np.ndarray] | None:
+        entry = self.lexicon.get(term)
+        if entry is None:
+            return None
+        start, count = entry
+        block = self.postings[start:start + count]
+        return block[:, 0], block[:, 1]
+
+    def span(self, i: int) -> tuple[int, int]:
+        """Byte offset and length of document `i` in docs.bin."""
+        start = int(self.offsets[i])
+        return start, int(self.offsets[i + 1]) - start
+
+    def raw_text(self, i: int) -> bytes:
+        return self.docs[int(self.offsets[i]):int(self.offsets[i + 1])].tobytes()
+
+    def text(self, i: int) -> str:
+        return self.raw_text(i).decode("utf-8")
+
+
+def _old_segment_path(path: Path) -> Path:
+    """Where `BM25Index.save()` moves the segment it replaces."""
+    return path.with_name(f".{path.name}.old")
+
+
+def _recover_interrupted_save(path: Path) -> None:
+    """Clear up after a save that died before removing the previous segment.
+
+    If it died between its two renames, `path` is gone and the `.old`
+    segment is the only complete one, so it is put back rather than deleted.
+    """
+    old = _old_segment_path(path)
+    if not old.exists():
+        return
+    if path.exists():
+        shutil.rmtree(old)
+    else:
+        logger.warning(f"Restoring {path} from {old}, left by an interrupted save")
+        os.replace(old, path)
+
+
+class BM25Index:
+    """Okapi BM25 over a memory-mapped base segment plus an in-memory delta."""
+
+    def __init__(self, path: str | Path | None = None, k1: float = 1.2, b: float = 0.75):
+        self.path = Path(path) if path else None
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._save_lock = threading.Lock()
+        # (doc_id, text, or None for a delete) for updates made while `save()` writes
+        self._journal: list[tuple[str, str | None]] | None = None
+        self._base: _BaseSegment | None = None
+        self._deleted: set[int] = set()
+        # doc_id -> (text, term frequencies, length)
+        self._delta_docs: dict[str, tuple[str, Counter, int]] = {}
+        self._delta_postings: dict[str, dict[str, int]] = {}
+        self._num_docs = 0
+        self._total_length = 0
+
+        if self.path:
+            _recover_interrupted_save(self.path)
+        if self.path and (self.path / "meta.json").exists():
+            self._load()
+
+    # ------------------------------------------------------------------
+    # Construction and persistence
+    # ------------------------------------------------------------------
+    @classmethod
+    def build(cls, documents: Iterable[tuple[str, str]], path: str | Path, k1: float = 1.2, b: float = 0.75) -> "BM25Index":
+        """Index `(doc_id, text)` pairs from scratch and persist them to `path`."""
+        index = cls(None, k1=k1, b=b)
+        for doc_id, text in documents:
+            index.add(doc_id, text)
+        index.save(path)
+        return index
+
+    def _load(self) -> None:
+        self._install(*self._read_segment(self.path))
+
+    @staticmethod
+    def _read_segment(path: Path) -> tuple[dict[str, Any], _BaseSegment]:
+        with open(path / "meta.json", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta["version"] != FORMAT_VERSION:
+            raise ValueError(f"Unsupported index format {meta['version']} in {path}")
+        return meta, _BaseSegment(path)
+
+    def _install(self, meta: dict[str, Any], base: _BaseSegment) -> None:
+        self.k1, self.b = meta["k1"], meta["b"]
+        self._base = base
+        self._deleted = set()
+        self._delta_docs.clear()
+        self._delta_postings.clear()
+        self._num_docs = meta["num_docs"]
+        self._total_length = meta["total_length"]
+        logger.info(f"Opened BM25 index at {self.path}: {self._num_docs} docs, {len(self._base.lexicon)} terms")
+
+    def save(self, path: str | Path | None = None) -> None:
+        """Fold pending changes into a new base segment on disk and reopen it.
+
+        The segment is written from a snapshot outside the lock, so searches
+        and updates carry on meanwhile; updates made during the write are
+        replayed onto the reopened index.
+        """
+        target = Path(path) if path else self.path
+        if target is None:
+            raise ValueError("No index path given.")
+        target.parent.mkdir(parents=True, exist_ok=True)
+        with self._save_lock:
+            with self._lock:
+                base, deleted, delta_docs = self._base, frozenset(self._deleted), dict(self._delta_docs)
+                self._journal = []
+            tmp = Path(tempfile.mkdtemp(prefix=f".{target.name}-", dir=target.parent))
+            try:
+                self._write_segment(tmp, base, deleted, delta_docs)
+                old = _old_segment_path(target)
+                # os.replace cannot overwrite a leftover `.old`
+                _recover_interrupted_save(target)
+                # Searches still hold the old segment's mappings, which survive the rename
+                if target.exists():
+                    os.replace(target, old)
+                os.replace(tmp, target)
+                segment = self._read_segment(target)
+                with self._lock:
+                    self.path = target
+                    journal, self._journal = self._journal, None
+                    self._install(*segment)
+                    for doc_id, text in journal:
+                        if text is None:
+                            self.delete(doc_id)
+                        else:
+                            self.add(doc_id, text)
+            except BaseException:
+                with self._lock:
+                    self._journal = None
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            shutil.rmtree(old, ignore_errors=True)
+            if journal:
+                logger.debug(f"Replayed {len(journal)} updates made while saving {target}")
+
+    def _live_base_docs(self) -> Iterator[int]:
+        if self._base is None:
+            return
+        for i in range(len(self._base)):
+            if i not in self._deleted:
+                yield i
+
+    def _write_segment(
+        self, out: Path, base: _BaseSegment | None, deleted: frozenset[int], delta_docs: dict[str, tuple[str, Counter, int]]
+    ) -> None:
+        # 1) New doc numbering: surviving base docs first, then the delta
+        remap = np.full(len(base) if base else 0, -1, dtype=np.int64)
+        doc_ids: list[str] = []
+        lengths: list[int] = []
+        offsets = [0]
+        with open(out / "docs.bin", "wb") as docs:
+            for i in range(len(base) if base else 0):
+                if i in deleted:
+                    continue
+                remap[i] = len(doc_ids)
+                raw = base.raw_text(i)
+                docs.write(raw)
+                doc_ids.append(base.doc_ids[i])
+                lengths.append(int(base.lengths[i]))
+                offsets.append(offsets[-1] + len(raw))
+            delta_numbers = {}
+            for doc_id, (text, _, length) in delta_docs.items():
+                delta_numbers[doc_id] = len(doc_ids)
+                raw = text.encode("utf-8")
+                docs.write(raw)
+                doc_ids.append(doc_id)
+                lengths.append(length)
+                offsets.append(offsets[-1] + len(raw))
+
+        # 2) Postings, term by term: remapped base postings, then delta postings
+        delta_postings = self._group_postings(delta_docs, delta_numbers)
+        lexicon: dict[str, list[int]] = {}
+        written = 0
+        terms = set(base.lexicon) if base else set()
+        terms.update(delta_postings)
+        with open(out / "postings.bin", "wb") as postings:
+            for term in sorted(terms):
+                blocks = []
+                found = base.term_postings(term) if base else None
+                if found is not None:
+                    idx, tf = found
+                    new_idx = remap[idx]
+                    keep = new_idx >= 0
+                    blocks.append(np.column_stack((new_idx[keep], tf[keep])).astype(np.uint32))
+                delta = delta_postings.get(term)
+                if delta is not None:
+                    blocks.append(delta)
+                if not blocks:
+                    continue
+                block = np.concatenate(blocks) if len(blocks) > 1 else blocks[0]
+                if len(block) == 0:
+                    continue
+                postings.write(block.tobytes())
+                lexicon[term] = [written, len(block)]
+                written += len(block)
+
+        np.array(lengths, dtype=np.uint32).tofile(out / "lengths.bin")
+        np.array(offsets, dtype=np.uint64).tofile(out / "offsets.bin")
+        with open(out / "lexicon.json", "w", encoding="utf-8") as f:
+            json.dump(lexicon, f)
+        with open(out / "doc_ids.json", "w", encoding="utf-8") as f:
+            json.dump(doc_ids, f)
+        meta = {
+            "version": FORMAT_VERSION,
+            "k1": self.k1,
+            "b": self.b,
+            "num_docs": len(doc_ids),
+            "total_length": int(sum(lengths)),
+        }
+        with open(out / "meta.json", "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+
+    @staticmethod
+    def _group_postings(delta_docs: dict[str, tuple[str, Counter, int]], numbers: dict[str, int]) -> dict[str, np.ndarray]:
+        """(doc number, tf) rows per term for the snapshot's delta documents.
+
+        Built from the snapshot (the live delta may change while `save()`
+        writes) by sorting flat arrays, rather than per-posting Python work.
+        """
+        terms: list[str] = []
+        tfs: list[int] = []
+        docs: list[int] = []
+        for doc_id, (_, tf, _) in delta_docs.items():
+            terms.extend(tf)
+            tfs.extend(tf.values())
+            docs.extend([numbers[doc_id]] * len(tf))
+        if not terms:
+            return {}
+        unique, inverse = np.unique(np.array(terms), return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        rows = np.column_stack((np.array(docs, dtype=np.uint32)[order], np.array(tfs, dtype=np.uint32)[order]))
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+        return {str(term): rows[bounds[i]:bounds[i + 1]] for i, term in enumerate(unique)}
+
+    # ------------------------------------------------------------------
+    # Incremental updates
+    # ------------------------------------------------------------------
+    def add(self, doc_id: str, text: str) -> None:
+        """Add a document, replacing any existing one with the same id."""
+        tokens = tokenize(text)
+        tf = Counter(tokens)
+        with self._lock:
+            self.delete(doc_id)
+            if self._journal is not None:
+                self._journal.append((doc_id, text))
+            self._delta_docs[doc_id] = (text, tf, len(tokens))
+            for term, count in tf.items():
+                self._delta_postings.setdefault(term, {})[doc_id] = count
+            self._num_docs += 1
+            self._total_length += len(tokens)
+
+    def delete(self, doc_id: str) -> bool:
+        """Remove a document; returns whether it existed."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.append((doc_id, None))
+            if doc_id in self._delta_docs:
+                _, tf, length = self._delta_docs.pop(doc_id)
+                for term in tf:
+                    postings = self._delta_postings[term]
+                    del postings[doc_id]
+                    if not postings:
+                        del self._delta_postings[term]
+            elif self._base is not None and doc_id in self._base.doc_index:
+                i = self._base.doc_index[doc_id]
+                if i in self._deleted:
+                    return False
+                self._deleted.add(i)
+                length = int(self._base.lengths[i])
+            else:
+                return False
+            self._num_docs -= 1
+            self._total_length -= length
+            return True
+
+    def __contains__(self, doc_id: str) -> bool:
+        with self._lock:
+            if doc_id in self._delta_docs:
+                return True
+            return (
+                self._base is not None
+                and doc_id in self._base.doc_index
+                and self._base.doc_index[doc_id] not in self._deleted
+            )
+
+    def __len__(self) -> int:
+        return self._num_docs
+
+    @property
+    def pending_changes(self) -> int:
+        """Delta documents plus tombstones not yet folded in by `save()`."""
+        return len(self._delta_docs) + len(self._deleted)
+
+    def doc_ids(self) -> Iterator[str]:
+        """Ids of every live document."""
+        with self._lock:
+            ids = [self._base.doc_ids[i] for i in self._live_base_docs()] if self._base else []
+            ids.extend(self._delta_docs)
+        return iter(ids)
+
+    # ------------------------------------------------------------------
+    # Search
+    # ------------------------------------------------------------------
+    def search(self, query: str, top_k: int = 5, with_text: bool = True) -> list[SearchHit]:
+        """Top `top_k` documents by BM25 score (documents matching no term are skipped).
+
+        With `with_text=False`, base-segment hits carry only their `offset`
+        and `length` in docs.bin (see `document_store()`); hits on documents
+        not yet saved always carry their text.
+        """
+        terms = set(tokenize(query))
+        # Only the delta and tombstones change under us; the base segment is
+        # immutable, so its (dominant) numpy scoring runs outside the lock and
+        # concurrent searches from a thread pool overlap.
+        with self._lock:
+            if not terms or self._num_docs == 0:
+                return []
+            base, deleted = self._base, set(self._deleted)
+            n = self._num_docs
+            avgdl = self._total_length / n or 1.0
+            k1, b = self.k1, self.b
+
+            base_terms = []
+            delta_scores: Counter = Counter()
+            for term in terms:
+                found = base.term_postings(term) if base is not None else None
+                delta = self._delta_postings.get(term, {})
+                df = (len(found[0]) if found is not None else 0) + len(delta)
+                if df == 0:
+                    continue
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                if found is not None:
+                    base_terms.append((idf, found))
+                for doc_id, tf in delta.items():
+                    dl = self._delta_docs[doc_id][2]
+                    delta_scores[doc_id] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+            delta_hits = [(score, doc_id) for doc_id, score in delta_scores.items()]
+            delta_texts = {doc_id: self._delta_docs[doc_id][0] for _, doc_id in heapq.nlargest(top_k, delta_hits)}
+
+        base_scores = np.zeros(len(base), dtype=np.float32) if base is not None else None
+        for idf, (idx, tf) in base_terms:
+            tf = tf.astype(np.float32)
+            dl = base.lengths[idx].astype(np.float32)
+            base_scores[idx] += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+
+        candidates: list[SearchHit] = []
+        if base_scores is not None and len(base_scores):
+            if deleted:
+                base_scores[list(deleted)] = 0.0
+            matched = np.flatnonzero(base_scores > 0)
+            if len(matched) > top_k:
+                matched = matched[np.argpartition(-base_scores[matched], top_k)[:top_k]]
+            candidates.extend(
+                SearchHit(base.doc_ids[i], float(base_scores[i]), base.text(i) if with_text else "", *base.span(i))
+                for i in matched
+            )
+        candidates.extend(SearchHit(doc_id, score, delta_texts[doc_id]) for score, doc_id in delta_hits if doc_id in delta_texts)
+        return heapq.nlargest(top_k, candidates, key=lambda hit: hit.score)
+
+    def document_store(self) -> dict[str, Any] | None:
+        """Where base-segment text lives: docs.bin's absolute path, inode and size, for `DocumentStore.open`."""
+        with self._lock:
+            if self._base is None:
+                return None
+            stat = self._base.docs_stat
+            return {"path": str((self._base.path / "docs.bin").resolve()), "inode": stat.st_ino, "size": stat.st_size}
+
+
+class StaleDocumentStoreError(RuntimeError):
+    """The docs.bin a result points into has been replaced by a newer `save()`."""
+
+
+class DocumentStore:
+    """Read-only mapping of a server's docs.bin, for reading result text by offset.
+
+    Server and client map the same file, so passages are shared through the
+    page cache instead of being copied over the MCP transport; `text()`
+    decodes straight from the mapping. Only works where the client can open
+    the server's index directory (stdio servers, shared disks).
+    """
+
+    _open: OrderedDict[tuple[str, int], "DocumentStore"] = OrderedDict()
+    _open_lock = threading.Lock()
+    max_open = 8
+
+    def __init__(self, path: str, inode: int, size: int):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != inode or stat.st_size != size:
+                raise StaleDocumentStoreError(f"{path} was replaced since the server read it")
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self.path = path
+        self.inode = inode
+        self.size = size
+        self._view = memoryview(mm)
+
+    @classmethod
+    def open(cls, path: str, inode: int, size: int) -> "DocumentStore":
+        """Shared, cached mapping of `path`, checked against the inode and size the server reported."""
+        key = (path, inode)
+        with cls._open_lock:
+            store = cls._open.get(key)
+            if store is None:
+                store = cls._open[key] = cls(path, inode, size)
+                while len(cls._open) > cls.max_open:
+                    cls._open.popitem(last=False)
+            cls._open.move_to_end(key)
+            return store
+
+    def text(self, offset: int, length: int) -> str:
+        if offset < 0 or offset + length > self.size:
+            raise ValueError(f"Range {offset}+{length} is outside {self.path} ({self.size} bytes)")
+        return str(self._view[offset:offset + length], "utf-8")
+
+
+Shard = tuple[int, int]  # (shard number, shard count)
+
+
+def shard_of(doc_id: str, num_shards: int) -> int:
+    """Stable shard assignment by hash of the document id."""
+    return int.from_bytes(hashlib.sha1(doc_id.encode("utf-8")).digest()[:8], "big") % num_shards
+
+
+def shard_index_dir(index_dir: str | Path, shard: Shard | None) -> Path:
+    """Where a shard keeps its index: `index_dir/shard-<i>-of-<n>`."""
+    if shard is None:
+        return Path(index_dir)
+    return Path(index_dir) / f"shard-{shard[0]}-of-{shard[1]}"
+
+
+def iter_document_paths(docs_dir: str | Path, shard: Shard | None = None) -> Iterator[tuple[str, Path]]:
+    """Yield `(relative path, path)` for every text file under `docs_dir` (in `shard`, if given)."""
+    root = Path(docs_dir)
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        for name in sorted(filenames):
+            file = Path(dirpath) / name
+            if file.suffix.lower() in TEXT_SUFFIXES:
+                doc_id = file.relative_to(root).as_posix()
+                if shard is None or shard_of(doc_id, shard[1]) == shard[0]:
+                    yield doc_id, file
+
+
+def iter_documents(docs_dir: str | Path, shard: Shard | None = None) -> Iterator[tuple[str, str]]:
+    """Yield `(relative path, text)` for every text file under `docs_dir` (in `shard`, if given)."""
+    for doc_id, file in iter_document_paths(docs_dir, shard):
+        yield doc_id, file.read_text(encoding="utf-8", errors="replace")
+
+
+def sync_directory(index: BM25Index, docs_dir: str | Path, shard: Shard | None = None) -> int:
+    """Bring `index` in line with `docs_dir` by file modification time; returns changes made.
+
+    Files modified after the index was last saved are (re)indexed and ids
+    whose files are gone are deleted. With `shard`, only that shard's
+    documents are considered. Call `save()` afterwards to persist.
+    """
+    meta = index.path / "meta.json" if index.path else None
+    saved_at = meta.stat().st_mtime if meta and meta.exists() else 0.0
+    seen = set()
+    changes = 0
+    for doc_id, file in iter_document_paths(docs_dir, shard):
+        seen.add(doc_id)
+        if doc_id not in index or file.stat().st_mtime > saved_at:
+            index.add(doc_id, file.read_text(encoding="utf-8", errors="replace"))
+            changes += 1
+    for doc_id in list(index.doc_ids()):
+        if doc_id not in seen:
+            index.delete(doc_id)
+            changes += 1
+    return changes
+
+
+@contextmanager
+def _exclusive(lock_path: Path) -> Iterator[None]:
+    """Serialize index maintenance between server processes sharing a directory."""
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(lock_path, "w") as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def index_lock(index_dir: Path):
+    """Held while an index directory is refreshed or ingested into."""
+    return _exclusive(index_dir.with_name(f".{index_dir.name}.lock"))
+
+
+def open_index(index_dir: str | Path, docs_dir: str | Path | None = None, shard: Shard | None = None) -> BM25Index:
+    """Open the index at `index_dir`, building or refreshing it from `docs_dir` when given.
+
+    With `shard=(i, n)` the index lives in `index_dir/shard-<i>-of-<n>` and
+    holds only the documents `shard_of` assigns to shard `i`.
+
+    An index built by `ingest.py` (it has a manifest) is refreshed through
+    ingestion instead, so its chunk ids are kept rather than replaced by
+    whole files.
+    """
+    index_dir = shard_index_dir(index_dir, shard)
+    with index_lock(index_dir):
+        index = BM25Index(index_dir)
+        if docs_dir is not None and Path(docs_dir).is_dir():
+            from ingest import Ingestor  # ingest builds on this module
+
+            ingestor = Ingestor.from_manifest(index, docs_dir, shard)
+            if ingestor is not None:
+                report = ingestor.run_once()
+                if report.changes:
+                    logger.info(f"Ingested changes from {docs_dir}: {report.summary()}")
+                return index
+            changes = sync_directory(index, docs_dir, shard)
+            if changes or not (index_dir / "meta.json").exists():
+                logger.info(f"Indexed {changes} changed documents from {docs_dir}")
+                index.save(index_dir)
+    return index
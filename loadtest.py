@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+loadtest.py
+
+Offline load test for one app instance's retrieve-and-answer path.
+
+Simulated users each run a closed loop (ask, wait for the full answer, think,
+ask again) against a `RAGEngine` wired to `stub_mcp_server.py` processes with
+injected latency, errors and payload size, and a `FakeGenerator`. The user
+count is stepped up level by level; each level reports throughput, tail
+latency, error and partial-result rates, and the mean self time of every
+pipeline stage taken from the request traces.
+
+Two conclusions are drawn at the end:
+- saturation: the highest throughput reached and the fewest users that got
+  within `--saturation-margin` of it; more users past that point only queue
+- bottleneck: the stage whose self time per request grew the most between
+  the lightest and the heaviest level, i.e. where the extra load waits; if
+  the load generator's own CPU is pegged, the client process is reported
+  instead, since stage timings then measure the event loop, not the backends
+
+    python loadtest.py --users 1,4,16,64 --duration 10
+    python loadtest.py --stub-latency 0.02 --stub-jitter 0.01 --stub-error-rate 0.01 \\
+        --stub-payload-bytes 4000 --stub-max-concurrency 4 --pool-size 2 --output load.json
+    python loadtest.py --sources-file mcp_sources.json   # your own servers instead of stubs
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any
+
+from benchmark import int_list, summarize
+from generation import FakeGenerator
+from rag_engine import RAGEngine
+from telemetry import Trace, start_trace
+
+STUB_SERVER = Path(__file__).with_name("stub_mcp_server.py")
+TOPICS = ["mcp", "bm25", "retrieval", "caching", "sharding", "streaming", "gemini", "pooling", "fusion", "tokens"]
+
+
+def stub_sources(args: argparse.Namespace) -> list[dict[str, Any]]:
+    """Source entries spawning `args.sources` stub servers with the injected faults."""
+    stub_args = [
+        str(STUB_SERVER),
+        "--results", str(args.stub_results),
+        "--latency", str(args.stub_latency),
+        "--jitter", str(args.stub_jitter),
+        "--slow-rate", str(args.stub_slow_rate),
+        "--slow-latency", str(args.stub_slow_latency),
+        "--error-rate", str(args.stub_error_rate),
+        "--payload-bytes", str(args.stub_payload_bytes),
+        "--max-concurrency", str(args.stub_max_concurrency),
+    ]
+    return [
+        {
+            "name": f"stub{i}",
+            "command": sys.executable,
+            "args": [*stub_args, "--seed", str(args.seed + i)],
+            "timeout": args.timeout,
+            **({"batch_tool": "KnowledgeToolBatch"} if args.batch else {}),
+        }
+        for i in range(args.sources)
+    ]
+
+
+def self_times(trace: Trace) -> dict[str, float]:
+    """Seconds per stage excluding time covered by spans nested inside it."""
+    spans = [(s.name, s.start, s.start + s.duration) for s in trace.spans]
+    totals: dict[str, float] = {}
+    for name, start, end in spans:
+        children = sorted(
+            (s, e) for other, s, e in spans if start <= s and e <= end and (s, e) != (start, end)
+        )
+        covered, reach = 0.0, start
+        for s, e in children:
+            if e > reach:
+                covered += e - max(s, reach)
+                reach = e
+        totals[name] = totals.get(name, 0.0) + max(0.0, end - start - covered)
+    return totals
+
+
+class Level:
+    """Samples collected while a fixed number of users were active."""
+
+    def __init__(self, users: int):
+        self.users = users
+        self.latencies: list[float] = []
+        self.stages: dict[str, float] = {}
+        self.errors: dict[str, int] = {}
+        self.partial = 0
+        self.elapsed = 0.0
+        self.cpu = 0.0
+        self.loop_lag: list[float] = []
+
+    def add(self, seconds: float, trace: Trace, error: BaseException | None, partial: bool) -> None:
+        self.latencies.append(seconds)
+        for stage, spent in self_times(trace).items():
+            self.stages[stage] = self.stages.get(stage, 0.0) + spent
+        if error is not None:
+            self.errors[type(error).__name__] = self.errors.get(type(error).__name__, 0) + 1
+        self.partial += partial
+
+    def report(self) -> dict[str, Any]:
+        count = len(self.latencies)
+        return {
+            "users": self.users,
+            "requests": count,
+            "throughput_rps": count / self.elapsed if self.elapsed else 0.0,
+            "latency": summarize(self.latencies),
+            "error_rate": sum(self.errors.values()) / count if count else 0.0,
+            "errors": self.errors,
+            "partial_rate": self.partial / count if count else 0.0,
+            "stage_self_ms": {stage: 1000 * spent / count for stage, spent in sorted(self.stages.items())} if count else {},
+            "client_cpu": self.cpu / self.elapsed if self.elapsed else 0.0,
+            "loop_lag": summarize(self.loop_lag),
+        }
+
+
+async def user_loop(
+    engine: RAGEngine, level: Level, queries: itertools.count, stop_at: float, think: float, use_cache: bool, rng: random.Random
+) -> None:
+    while time.perf_counter() < stop_at:
+        # Unique questions, so caches only help when --use-cache repeats topics on purpose
+        n = next(queries)
+        query = f"What is {TOPICS[n % len(TOPICS)]}?" if use_cache else f"What is {TOPICS[n % len(TOPICS)]} #{n}?"
+        error, partial = None, False
+        with start_trace("loadtest") as trace:
+            start = time.perf_counter()
+            try:
+                answer = await engine.answer(query, use_cache=use_cache)
+                partial = answer.retrieval.partial
+            except Exception as e:
+                error = e
+            seconds = time.perf_counter() - start
+        level.add(seconds, trace, error, partial)
+        if think:
+            await asyncio.sleep(rng.expovariate(1 / think))
+
+
+async def probe_loop_lag(level: Level, stop_at: float, interval: float = 0.01) -> None:
+    """Record how late short sleeps wake up: time the event loop spent busy with other work."""
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        level.loop_lag.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def run_level(engine: RAGEngine, users: int, args: argparse.Namespace, queries: itertools.count) -> Level:
+    level = Level(users)
+    rng = random.Random(args.seed + users)
+    if args.warmup:
+        await asyncio.gather(*(
+            user_loop(engine, Level(users), queries, time.perf_counter() + args.warmup, args.think_time, args.use_cache, rng)
+            for _ in range(users)
+        ))
+    cpu, start = time.process_time(), time.perf_counter()
+    await asyncio.gather(
+        probe_loop_lag(level, start + args.duration),
+        *(user_loop(engine, level, queries, start + args.duration, args.think_time, args.use_cache, rng) for _ in range(users)),
+    )
+    level.elapsed = time.perf_counter() - start
+    level.cpu = time.process_time() - cpu
+    return level
+
+
+def saturation(levels: list[dict[str, Any]], margin: float) -> dict[str, Any]:
+    best = max(levels, key=lambda level: level["throughput_rps"])
+    knee = next(level for level in levels if level["throughput_rps"] >= best["throughput_rps"] * (1 - margin))
+    return {
+        "throughput_rps": best["throughput_rps"],
+        "users": knee["users"],
+        "p95_ms_at_saturation": knee["latency"].get("p95", 0.0),
+        "p99_ms_at_peak_load": levels[-1]["latency"].get("p99", 0.0),
+    }
+
+
+def bottleneck(levels: list[dict[str, Any]], cpu_limit: float) -> dict[str, Any]:
+    first, last = levels[0], levels[-1]
+    if last["client_cpu"] >= cpu_limit:
+        return {"stage": "client", "reason": f"load generator CPU at {last['client_cpu']:.0%} of one core"}
+    growth = {
+        stage: ms - first["stage_self_ms"].get(stage, 0.0)
+        for stage, ms in last["stage_self_ms"].items()
+    }
+    if not growth:
+        return {"stage": None, "reason": "no stage timings recorded"}
+    stage = max(growth, key=growth.get)
+    share = last["stage_self_ms"][stage] / (last["latency"].get("mean") or 1.0)
+    reason = (
+        f"{stage} self time grew {growth[stage]:.1f} ms per request from "
+        f"{first['users']} to {last['users']} users and is {share:.0%} of latency at peak"
+    )
+    # Sessions are held for the whole call, so a slow server shows up as pool waits too
+    call_before = first["stage_self_ms"].get("tool_call", 0.0)
+    if stage == "session_acquire" and call_before and growth.get("tool_call", 0.0) > 0.5 * call_before:
+        reason += f"; tool_call also grew {growth['tool_call']:.1f} ms, so the servers are saturated, not just the pool"
+    lag = last["loop_lag"].get("p95", 0.0)
+    if lag >= 5.0:
+        reason += f"; the client event loop lags {lag:.1f} ms at p95, which awaited stages such as generation absorb"
+        if last["client_cpu"] < cpu_limit / 2:
+            reason += " (the client itself is mostly idle, so the host's CPUs are busy with the servers or other processes)"
+    return {
+        "stage": stage,
+        "growth_ms": growth[stage],
+        "share_at_peak": share,
+        "stage_growth_ms": dict(sorted(growth.items(), key=lambda item: item[1], reverse=True)),
+        "reason": reason,
+    }
+
+
+def print_level(level: dict[str, Any]) -> None:
+    latency = level["latency"]
+    top = sorted(level["stage_self_ms"].items(), key=lambda item: item[1], reverse=True)[:3]
+    print(
+        f"users={level['users']:>4}  {level['throughput_rps']:8.1f} req/s  "
+        f"p50={latency.get('p50', 0):8.1f}ms p95={latency.get('p95', 0):8.1f}ms p99={latency.get('p99', 0):8.1f}ms  "
+        f"errors={level['error_rate']:6.1%} partial={level['partial_rate']:6.1%} cpu={level['client_cpu']:5.0%} "
+        f"lag95={level['loop_lag'].get('p95', 0):5.1f}ms  "
+        + " ".join(f"{stage}={ms:.1f}ms" for stage, ms in top),
+        file=sys.stderr,
+    )
+
+
+async def load_test(args: argparse.Namespace, sources_file: str) -> dict[str, Any]:
+    settings = {
+        "MCP_SOURCES_FILE": sources_file,
+        "MCP_POOL_SIZE": args.pool_size,
+        "MCP_POOL_MIN_IDLE": args.pool_size,
+        "RETRIEVAL_CACHE_SIZE": args.cache_size,
+        "ANSWER_CACHE_SIZE": args.cache_size,
+        "CONTEXT_RERANKER": args.reranker,
+    }
+    generator = FakeGenerator(first_chunk_delay=args.gen_first_chunk_delay, chunk_delay=args.gen_chunk_delay)
+    engine = RAGEngine.from_settings(lambda key, default=None: settings.get(key, default), generator=generator)
+    queries = itertools.count()
+    levels = []
+    try:
+        # Spawn every pooled server before the first measurement
+        await asyncio.gather(*(engine.answer(f"warm-up {i}", use_cache=False) for i in range(args.pool_size)), return_exceptions=True)
+        for users in args.users:
+            level = (await run_level(engine, users, args, queries)).report()
+            print_level(level)
+            levels.append(level)
+    finally:
+        engine.close()
+    return {
+        "levels": levels,
+        "saturation": saturation(levels, args.saturation_margin),
+        "bottleneck": bottleneck(levels, args.cpu_limit),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int_list, default=[1, 2, 4, 8, 16, 32, 64], help="concurrent users per level")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per level")
+    parser.add_argument("--warmup", type=float, default=1.0, help="unmeasured seconds before each level")
+    parser.add_argument("--think-time", type=float, default=0.0, help="mean seconds a user waits between questions")
+    parser.add_argument("--use-cache", action="store_true", help="repeat a few questions and let the caches answer")
+    parser.add_argument("--sources-file", help="sources JSON to load-test instead of stub servers")
+    parser.add_argument("--sources", type=int, default=1, help="stub servers to fan out to")
+    parser.add_argument("--batch", action="store_true", help="coalesce concurrent queries into KnowledgeToolBatch")
+    parser.add_argument("--pool-size", type=int, default=2, help="sessions per source")
+    parser.add_argument("--timeout", type=float, default=5.0, help="per-source retrieval deadline")
+    parser.add_argument("--stub-results", type=int, default=3)
+    parser.add_argument("--stub-latency", type=float, default=0.01)
+    parser.add_argument("--stub-jitter", type=float, default=0.0)
+    parser.add_argument("--stub-slow-rate", type=float, default=0.0)
+    parser.add_argument("--stub-slow-latency", type=float, default=0.0)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0)
+    parser.add_argument("--stub-payload-bytes", type=int, default=500)
+    parser.add_argument("--stub-max-concurrency", type=int, default=0)
+    parser.add_argument("--gen-first-chunk-delay", type=float, default=0.05)
+    parser.add_argument("--gen-chunk-delay", type=float, default=0.005)
+    parser.add_argument("--reranker", default="lexical", help="context reranker: lexical, cross-encoder or none")
+    parser.add_argument("--cache-size", type=int, default=1024)
+    parser.add_argument("--saturation-margin", type=float, default=0.05,
+                        help="throughput within this fraction of the peak counts as saturated")
+    parser.add_argument("--cpu-limit", type=float, default=0.9,
+                        help="client CPU share of one core above which the client is the bottleneck")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report JSON here")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    if args.sources_file:
+        report = asyncio.run(load_test(args, args.sources_file))
+    else:
+        with tempfile.TemporaryDirectory(prefix="noencode-load-") as tmp:
+            sources_file = Path(tmp) / "sources.json"
+            sources_file.write_text(json.dumps(stub_sources(args)), encoding="utf-8")
+            report = asyncio.run(load_test(args, str(sources_file)))
+    report["args"] = {k: v for k, v in vars(args).items() if k != "output"}
+    report["cpu_count"] = os.cpu_count()
+
+    sat, neck = report["saturation"], report["bottleneck"]
+    print(
+        f"Saturation: {sat['throughput_rps']:.1f} req/s from {sat['users']} users "
+        f"(p95 {sat['p95_ms_at_saturation']:.1f} ms; p99 at {args.users[-1]} users {sat['p99_ms_at_peak_load']:.1f} ms)",
+        file=sys.stderr,
+    )
+    print(f"Bottleneck: {neck['stage']} — {neck['reason']}", file=sys.stderr)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+        print(f"Report written to {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,487 @@
+"""
+mcp_pool.py
+
+A pool of long-lived MCP client sessions.
+
+Spawning `python my_awesome_mcp_server.py` and running the JSON-RPC handshake
+costs far more than the tool call itself, so the pool keeps a few initialized
+server processes warm and hands them out per call:
+- Sessions live on a private event loop thread, so any caller loop
+  (Streamlit reruns, FastAPI, scripts) can share one pool.
+- Idle sessions are pinged periodically and evicted after `idle_timeout`.
+- A session whose process crashed or hung is discarded and respawned.
+- `wait_ready()` lets a server hold its first request until `min_idle`
+  sessions are warm, so no user pays for spawning them.
+
+Servers are reached over stdio (`StdioServerParameters`, one process per
+session) or streamable HTTP (`HttpServerParameters`, one connection per
+session to a shared, already-running server).
+"""
+
+import asyncio
+import atexit
+import itertools
+import json
+import logging
+import threading
+import time
+from contextlib import AsyncExitStack
+from dataclasses import dataclass
+from typing import Any
+
+from mcp import ClientSession, StdioServerParameters
+from mcp.client.stdio import stdio_client
+from mcp.client.streamable_http import streamablehttp_client
+from mcp.types import CallToolResult, TextContent
+from pydantic import Field
+
+from fed_rag.knowledge_stores.no_encode import MCPStdioKnowledgeSource, MCPStreamableHttpKnowledgeSource
+
+from telemetry import Trace, current_trace, metrics, span
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PoolConfig:
+    """Tuning knobs for an `MCPSessionPool`."""
+
+    size: int = 2                        # max server processes
+    min_idle: int = 1                    # warm sessions kept ready
+    idle_timeout: float = 300.0          # seconds before an idle extra session is closed
+    health_check_interval: float = 30.0  # seconds between pings of idle sessions
+    startup_timeout: float = 30.0        # spawn + initialize handshake
+    call_timeout: float = 30.0           # default per tool call
+
+
+@dataclass
+class HttpServerParameters:
+    """Where to reach a streamable-HTTP MCP server."""
+
+    url: str
+    headers: dict[str, str] | None = None
+
+
+ServerParameters = StdioServerParameters | HttpServerParameters
+
+
+class PoolClosedError(RuntimeError):
+    """Raised when a call is made on a pool that has been closed."""
+
+
+class _PooledSession:
+    """One server process (or HTTP connection) and its initialized `ClientSession`.
+
+    Transports must be entered and exited by the same task, so each session
+    is owned by a task that keeps it open until `stop` is set.
+    """
+
+    def __init__(self, session_id: int):
+        self.id = session_id
+        self.session: ClientSession | None = None
+        self.ready = asyncio.Event()
+        self.stop = asyncio.Event()
+        self.healthy = False
+        self.error: BaseException | None = None
+        self.last_used = time.monotonic()
+        self.task: asyncio.Task | None = None
+
+    async def run(self, params: ServerParameters) -> None:
+        try:
+            async with AsyncExitStack() as stack:
+                if isinstance(params, HttpServerParameters):
+                    read, write, _ = await stack.enter_async_context(streamablehttp_client(params.url, headers=params.headers))
+                else:
+                    read, write = await stack.enter_async_context(stdio_client(params))
+                self.session = await stack.enter_async_context(ClientSession(read, write))
+                await self.session.initialize()
+                self.healthy = True
+                self.ready.set()
+                await self.stop.wait()
+        except Exception as e:
+            # Server failed to start, crashed mid-session, or closed the pipe
+            self.error = e
+            logger.warning(f"MCP session {self.id} ended: {e!r}")
+        finally:
+            self.healthy = False
+            self.ready.set()
+
+
+class MCPSessionPool:
+    """A bounded pool of warm MCP sessions for one server command or URL."""
+
+    def __init__(self, server_params: ServerParameters, config: PoolConfig | None = None, name: str = "mcp"):
+        self.server_params = server_params
+        self.config = config or PoolConfig()
+        self.name = name
+
+        self._ids = itertools.count(1)
+        self._idle: list[_PooledSession] = []
+        self._sessions: set[_PooledSession] = set()
+        self._starting = 0
+        self._closed = False
+        self._counters = {"spawned": 0, "respawned": 0, "evicted": 0, "calls": 0, "failures": 0}
+
+        # 1) Private loop thread that owns every session
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name=f"mcp-pool-{name}", daemon=True)
+        self._thread.start()
+
+        # 2) Bound concurrent checkouts to the pool size and warm up
+        self._slots: asyncio.Semaphore = self._submit(self._make_semaphore()).result()
+        self._idle_changed = asyncio.Event()
+        self._maintainer = self._submit(self._maintain())
+        atexit.register(self.close)
+
+    # ------------------------------------------------------------------
+    # Public API (callable from any event loop)
+    # ------------------------------------------------------------------
+    async def call_tool(self, tool_name: str, arguments: dict[str, Any], timeout: float | None = None) -> CallToolResult:
+        """Run one tool call on a pooled session."""
+        if self._closed:
+            raise PoolClosedError(f"MCP pool '{self.name}' is closed.")
+        # Hand the caller's trace over explicitly rather than rely on context
+        # copying across the thread hop
+        future = self._submit(self._call_tool(tool_name, arguments, timeout or self.config.call_timeout, current_trace()))
+        return await asyncio.wrap_future(future)
+
+    async def wait_ready(self, min_idle: int | None = None, timeout: float | None = None) -> bool:
+        """Wait until `min_idle` sessions (default `config.min_idle`) are warm; False if that fails or times out."""
+        count = min(self.config.min_idle if min_idle is None else min_idle, self.config.size)
+        future = self._submit(asyncio.wait_for(self._warm(count), timeout or self.config.startup_timeout))
+        try:
+            await asyncio.wrap_future(future)
+        except Exception as e:
+            logger.warning(f"MCP pool '{self.name}': {len(self._idle)}/{count} sessions warm after warm-up: {e!r}")
+            return False
+        return True
+
+    def stats(self) -> dict[str, int]:
+        """Snapshot of pool occupancy and lifetime counters."""
+        idle = len(self._idle)
+        return {
+            "size": self.config.size,
+            "open": len(self._sessions),
+            "idle": idle,
+            "in_use": len(self._sessions) - idle,
+            **self._counters,
+        }
+
+    def close(self) -> None:
+        """Terminate every server process and stop the loop thread."""
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._submit(self._shutdown()).result(timeout=10)
+        except Exception as e:
+            logger.warning(f"MCP pool '{self.name}' shutdown: {e!r}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+
+    # ------------------------------------------------------------------
+    # Internals (run on the pool loop)
+    # ------------------------------------------------------------------
+    def _submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    async def _make_semaphore(self) -> asyncio.Semaphore:
+        return asyncio.Semaphore(self.config.size)
+
+    async def _spawn(self) -> _PooledSession:
+        pooled = _PooledSession(next(self._ids))
+        self._sessions.add(pooled)
+        self._counters["spawned"] += 1
+        pooled.task = asyncio.create_task(pooled.run(self.server_params))
+        self._starting += 1
+        try:
+            await asyncio.wait_for(pooled.ready.wait(), self.config.startup_timeout)
+        except BaseException:
+            self._discard(pooled)
+            raise
+        finally:
+            self._starting -= 1
+        if not pooled.healthy:
+            self._discard(pooled)
+            raise RuntimeError(f"MCP server failed to start: {pooled.error!r}")
+        logger.info(f"MCP pool '{self.name}': session {pooled.id} ready")
+        return pooled
+
+    def _discard(self, pooled: _PooledSession) -> None:
+        pooled.healthy = False
+        pooled.stop.set()
+        self._sessions.discard(pooled)
+        if pooled in self._idle:
+            self._idle.remove(pooled)
+        self._idle_changed.set()
+
+    def _park(self, pooled: _PooledSession) -> None:
+        self._idle.append(pooled)
+        self._idle_changed.set()
+
+    async def _acquire(self) -> _PooledSession:
+        await self._slots.acquire()
+        try:
+            while True:
+                # Most recently used first: it is the warmest
+                while self._idle:
+                    pooled = self._idle.pop()
+                    if pooled.healthy:
+                        return pooled
+                    self._discard(pooled)
+                    self._counters["respawned"] += 1
+                if len(self._sessions) < self.config.size:
+                    return await self._spawn()
+                # Every other process is still warming up in `_top_up` or being
+                # health-checked; wait for one rather than exceed the pool size
+                self._idle_changed.clear()
+                await asyncio.wait_for(self._idle_changed.wait(), self.config.startup_timeout)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _release(self, pooled: _PooledSession, broken: bool) -> None:
+        if broken or self._closed or not pooled.healthy:
+            self._discard(pooled)
+        else:
+            pooled.last_used = time.monotonic()
+            self._park(pooled)
+        self._slots.release()
+
+    async def _call_tool(
+        self, tool_name: str, arguments: dict[str, Any], timeout: float, trace: Trace | None = None
+    ) -> CallToolResult:
+        with span("session_acquire", trace, pool=self.name):
+            pooled = await self._acquire()
+        broken = False
+        try:
+            self._counters["calls"] += 1
+            with span("tool_call", trace, pool=self.name, tool=tool_name):
+                return await asyncio.wait_for(pooled.session.call_tool(tool_name, arguments=arguments), timeout)
+        except BaseException as e:
+            # Tool-level errors come back as `isError` results, so anything
+            # raised here means the transport is dead or hung.
+            broken = True
+            self._counters["failures"] += 1
+            if isinstance(e, asyncio.TimeoutError):
+                metrics.inc("noencode_timeouts_total", stage="tool_call", pool=self.name)
+            raise
+        finally:
+            self._release(pooled, broken)
+            if broken and not self._closed:
+                # Warm a replacement now rather than on the next caller's clock
+                asyncio.create_task(self._top_up())
+
+    async def _check_idle(self) -> None:
+        now = time.monotonic()
+        for pooled in list(self._idle):
+            if pooled not in self._idle:
+                continue
+            if not pooled.healthy:
+                self._discard(pooled)
+                self._counters["respawned"] += 1
+            elif now - pooled.last_used > self.config.idle_timeout and len(self._idle) > self.config.min_idle:
+                self._discard(pooled)
+                self._counters["evicted"] += 1
+            else:
+                # Take it out of rotation while pinging
+                self._idle.remove(pooled)
+                try:
+                    await asyncio.wait_for(pooled.session.send_ping(), self.config.startup_timeout)
+                except Exception as e:
+                    logger.warning(f"MCP pool '{self.name}': session {pooled.id} failed health check: {e!r}")
+                    self._discard(pooled)
+                    self._counters["respawned"] += 1
+                else:
+                    self._park(pooled)
+
+    async def _top_up(self) -> None:
+        # Sessions still starting count as warm, or concurrent warm-ups would overshoot `min_idle`
+        while (
+            not self._closed
+            and len(self._idle) + self._starting < self.config.min_idle
+            and len(self._sessions) < self.config.size
+        ):
+            try:
+                pooled = await self._spawn()
+            except Exception as e:
+                logger.warning(f"MCP pool '{self.name}': warm-up failed: {e!r}")
+                return
+            self._park(pooled)
+
+    async def _warm(self, count: int) -> None:
+        # Unlike `_top_up`, a failed spawn is raised to the caller waiting for it
+        while not self._closed and len(self._idle) < count:
+            if len(self._idle) + self._starting < count and len(self._sessions) < self.config.size:
+                self._park(await self._spawn())
+            else:
+                # Sessions are starting in `_top_up`, or callers hold the rest
+                self._idle_changed.clear()
+                await self._idle_changed.wait()
+
+    async def _maintain(self) -> None:
+        while not self._closed:
+            await self._top_up()
+            await asyncio.sleep(self.config.health_check_interval)
+            await self._check_idle()
+
+    async def _shutdown(self) -> None:
+        self._maintainer.cancel()
+        tasks = [p.task for p in self._sessions if p.task]
+        for pooled in list(self._sessions):
+            self._discard(pooled)
+        if tasks:
+            await asyncio.wait(tasks, timeout=5)
+
+
+class QueryCoalescer:
+    """Merges concurrent single queries into one call of a batch tool.
+
+    The first query to arrive opens a `window`-second batch (or one loop
+    tick when `window` is 0); every query arriving before it closes, up to
+    `max_batch`, rides the same `KnowledgeToolBatch` round trip. The batch
+    tool takes a list of queries and returns a JSON list of per-query
+    result lists; each caller gets back a `CallToolResult` shaped like the
+    single-query tool's, so node conversion is unchanged.
+    """
+
+    def __init__(
+        self,
+        pool: MCPSessionPool,
+        tool_name: str = "KnowledgeToolBatch",
+        query_param_name: str = "queries",
+        window: float = 0.002,
+        max_batch: int = 32,
+        tool_call_kwargs: dict[str, Any] | None = None,
+    ):
+        self.pool = pool
+        self.tool_name = tool_name
+        self.query_param_name = query_param_name
+        self.window = window
+        self.max_batch = max_batch
+        self.tool_call_kwargs = tool_call_kwargs or {}
+        # Touched only on the pool loop
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._counters = {"queries": 0, "batches": 0, "largest_batch": 0}
+
+    async def query(self, query: str) -> CallToolResult:
+        """Result of one query, possibly fetched together with others."""
+        with span("coalesced_call", pool=self.pool.name, tool=self.tool_name):
+            future = self.pool._submit(self._enqueue(query))
+            return await asyncio.wrap_future(future)
+
+    async def query_many(self, queries: list[str], timeout: float | None = None) -> list[CallToolResult]:
+        """Results of several queries in one batch call, in order."""
+        future = self.pool._submit(self._call_batch(list(queries), timeout, current_trace()))
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict[str, float]:
+        batches = self._counters["batches"]
+        return {**self._counters, "avg_batch": self._counters["queries"] / batches if batches else 0.0}
+
+    async def _enqueue(self, query: str) -> CallToolResult:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((query, future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush) if self.window > 0 else loop.call_soon(self._flush)
+        return await future
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.create_task(self._dispatch(batch))
+
+    async def _dispatch(self, batch: list[tuple[str, asyncio.Future]]) -> None:
+        # Identical queries in one window share a slot in the request
+        queries = list(dict.fromkeys(query for query, _ in batch))
+        try:
+            results = dict(zip(queries, await self._call_batch(queries)))
+        except BaseException as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        for query, future in batch:
+            # A caller whose deadline passed has already cancelled its future
+            if not future.done():
+                future.set_result(results[query])
+
+    async def _call_batch(self, queries: list[str], timeout: float | None = None, trace: Trace | None = None) -> list[CallToolResult]:
+        self._counters["queries"] += len(queries)
+        self._counters["batches"] += 1
+        self._counters["largest_batch"] = max(self._counters["largest_batch"], len(queries))
+        arguments = {self.query_param_name: queries, **self.tool_call_kwargs}
+        result = await self.pool._call_tool(self.tool_name, arguments, timeout or self.pool.config.call_timeout, trace)
+        text = "".join(c.text for c in result.content if isinstance(c, TextContent))
+        if result.isError:
+            raise RuntimeError(f"{self.tool_name} failed: {text}")
+        per_query = json.loads(text)
+        if len(per_query) != len(queries):
+            raise RuntimeError(f"{self.tool_name} returned {len(per_query)} results for {len(queries)} queries")
+        return [
+            CallToolResult(content=[TextContent(type="text", text=passage) for passage in passages])
+            for passages in per_query
+        ]
+
+
+class _PooledRetrieval:
+    pool: MCPSessionPool | None
+    coalescer: QueryCoalescer | None
+
+    async def retrieve(self, query: str) -> CallToolResult:
+        if self.coalescer is not None:
+            return await self.coalescer.query(query)
+        tool_arguments = {self.query_param_name: query, **self.tool_call_kwargs}
+        return await self.pool.call_tool(self.tool_name, tool_arguments)
+
+
+class MCPPooledKnowledgeSource(_PooledRetrieval, MCPStdioKnowledgeSource):
+    """`MCPStdioKnowledgeSource` that reuses sessions from an `MCPSessionPool`.
+
+    Drop-in for `MCPKnowledgeStore().add_source(...)`; the pool's server
+    params are used and no process is spawned per retrieval. With a
+    `QueryCoalescer`, concurrent retrievals share batch tool calls.
+    """
+
+    pool: MCPSessionPool | None = Field(default=None, exclude=True)
+    coalescer: QueryCoalescer | None = Field(default=None, exclude=True)
+
+    def __init__(
+        self, pool: MCPSessionPool, tool_name: str, query_param_name: str,
+        coalescer: QueryCoalescer | None = None, **kwargs: Any,
+    ):
+        super().__init__(server_params=pool.server_params, tool_name=tool_name, query_param_name=query_param_name, **kwargs)
+        self.pool = pool
+        self.coalescer = coalescer
+
+
+class MCPPooledHttpKnowledgeSource(_PooledRetrieval, MCPStreamableHttpKnowledgeSource):
+    """`MCPStreamableHttpKnowledgeSource` that reuses connections from an `MCPSessionPool`."""
+
+    pool: MCPSessionPool | None = Field(default=None, exclude=True)
+    coalescer: QueryCoalescer | None = Field(default=None, exclude=True)
+
+    def __init__(
+        self, pool: MCPSessionPool, tool_name: str, query_param_name: str,
+        coalescer: QueryCoalescer | None = None, **kwargs: Any,
+    ):
+        super().__init__(url=pool.server_params.url, tool_name=tool_name, query_param_name=query_param_name, **kwargs)
+        self.pool = pool
+        self.coalescer = coalescer
+
+
+def pooled_source(
+    pool: MCPSessionPool, tool_name: str, query_param_name: str, **kwargs: Any
+) -> MCPPooledKnowledgeSource | MCPPooledHttpKnowledgeSource:
+    """The pooled knowledge source matching the pool's transport."""
+    cls = MCPPooledHttpKnowledgeSource if isinstance(pool.server_params, HttpServerParameters) else MCPPooledKnowledgeSource
+    return cls(pool, tool_name=tool_name, query_param_name=query_param_name, **kwargs)
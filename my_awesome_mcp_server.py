@@ -2,35 +2,259 @@
 """
 my_awesome_mcp_server.py
 
-A minimal MCP stdio server powered by the MCP Python SDK (FastMCP).
-It implements a single tool, "KnowledgeTool", that returns:
-- A real definition when you ask "what is mcp"
-- Otherwise an echo of your query
+A minimal MCP server powered by the MCP Python SDK (FastMCP).
+It implements "KnowledgeTool", which answers arbitrary queries from a local
+document directory using a BM25 inverted index
+(see `knowledge_index.py`):
+- The index is built once, persisted to `--index-dir` and memory-mapped on start-up
+- Files added, changed or removed in `--docs-dir` since the last run are
+  applied incrementally before serving
+- The tool is async: lookups run on a thread pool (or, with
+  `--executor process`, a process pool that maps the same index files), so
+  one slow query does not hold up the others on the same server
+- "KnowledgeToolBatch" answers a list of queries in one round trip; clients
+  coalesce concurrent lookups into it (see `mcp_pool.QueryCoalescer`)
+- "KnowledgeToolScored" returns doc ids and BM25 scores alongside the text,
+  so results from several shards can be merged (see `shard_router.py`)
+- "KnowledgeToolRefs" returns byte offsets into the index's docs.bin instead
+  of text, for clients on the same machine (see `compact_results.py`)
+- `--shard I --num-shards N` serves only the documents hashed to shard I,
+  with its own index under `--index-dir`/shard-I-of-N
+- `--ingest-interval S` indexes `--docs-dir` in chunks on a background
+  thread instead, re-checking it every S seconds while queries are served
+  (see `ingest.py`)
+
+    python my_awesome_mcp_server.py --docs-dir docs --index-dir .index --top-k 3
+
+    # Shared by many app instances over HTTP, 4 worker processes
+    python my_awesome_mcp_server.py --transport streamable-http --port 8765 --workers 4
+
+    # Shard 0 of 4
+    python my_awesome_mcp_server.py --shard 0 --num-shards 4
+
+    # Pick up added, changed and removed documents every 10 seconds
+    python my_awesome_mcp_server.py --ingest-interval 10
+
+The same options can be set with KNOWLEDGE_DOCS_DIR, KNOWLEDGE_INDEX_DIR,
+KNOWLEDGE_TOP_K, KNOWLEDGE_EXECUTOR, KNOWLEDGE_POOL_SIZE, KNOWLEDGE_SHARD,
+KNOWLEDGE_NUM_SHARDS, KNOWLEDGE_INGEST_INTERVAL and KNOWLEDGE_CHUNK_CHARS, which is handy when the server is spawned by the app.
 """
 
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
 from mcp.server.fastmcp import FastMCP
 
-# 1) Create your server host
-mcp = FastMCP(server_name="DemoMCP")
+from ingest import Ingestor
+from knowledge_index import BM25Index, Shard, open_index, shard_index_dir
+
+# 1) Create your server host (stateless HTTP lets any worker serve any request)
+mcp = FastMCP(name="DemoMCP", stateless_http=True)
+index: BM25Index | None = None
+top_k = 3
+shard: Shard | None = None
+executor: Executor | None = None
+ingestor: Ingestor | None = None
+
+
+def search_texts(query: str, k: int) -> list[str]:
+    """Blocking BM25 lookup; runs on the executor, in-process or in a worker process."""
+    hits = index.search(query, k) if index is not None else []
+    if not hits:
+        return [f"No documents matched: {query}"]
+    return [hit.text for hit in hits]
+
+
+def search_scored(query: str, k: int) -> list[dict]:
+    """Blocking BM25 lookup returning id, score and text per hit."""
+    hits = index.search(query, k) if index is not None else []
+    return [{"doc_id": hit.doc_id, "score": hit.score, "text": hit.text} for hit in hits]
 
-# 2) Register your tool
+
+def search_refs(query: str, k: int) -> dict:
+    """Blocking BM25 lookup returning docs.bin offsets instead of text where possible."""
+    if index is None:
+        return {"store": None, "hits": []}
+    while True:
+        # Offsets are only valid for the docs.bin they were read from; background
+        # ingestion can swap in a new one mid-search
+        store = index.document_store()
+        found = index.search(query, k, with_text=False)
+        if index.document_store() == store:
+            break
+    hits = [
+        {"doc_id": hit.doc_id, "score": hit.score, "offset": hit.offset, "length": hit.length}
+        if hit.offset is not None else {"doc_id": hit.doc_id, "score": hit.score, "text": hit.text}
+        for hit in found
+    ]
+    return {"store": store, "hits": hits}
+
+
+def _init_process_worker(index_dir: str) -> None:
+    # Worker processes map the index files the parent already built
+    global index
+    index = BM25Index(index_dir)
+
+
+# 2) Register your tools
 @mcp.tool(name="KnowledgeTool")
-def knowledge_tool(query: str) -> list[str]:
-    """
-    If the user asks 'what is mcp', return a hard-coded definition.
-    Otherwise, echo back the original query.
-    """
-    q = query.strip().lower()
-    if "what is mcp" in q:
-        return [
-            "MCP (Model Context Protocol) is Anthropic’s open standard "
-            "for invoking external tools via JSON-RPC over stdin/stdout or HTTP. "
-            "It defines how an LLM can call out to “tools” (e.g. knowledge stores) "
-            "and receive structured responses."
-        ]
-    # Fallback for any other query
-    return ["Error: Unsupported query. Only 'what is mcp' is currently handled."]
-
-# 3) Run the server loop (handles JSON-RPC, TaskGroups, etc.)
+async def knowledge_tool(query: str) -> list[str]:
+    """
+    Return the text of the best-matching documents for the query, best first.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, search_texts, query, top_k)
+
+
+@mcp.tool(name="KnowledgeToolBatch")
+async def knowledge_tool_batch(queries: list[str]) -> str:
+    """
+    Look up several queries in one call. Returns a JSON list holding, for each
+    query in order, the list of passages KnowledgeTool would have returned.
+    """
+    loop = asyncio.get_running_loop()
+    results = await asyncio.gather(*(loop.run_in_executor(executor, search_texts, q, top_k) for q in queries))
+    # A JSON string, because FastMCP flattens nested lists into one content list
+    return json.dumps(results)
+
+
+@mcp.tool(name="KnowledgeToolScored")
+async def knowledge_tool_scored(query: str, limit: int | None = None) -> str:
+    """
+    Return a JSON object {"shard": [i, n] or null, "hits": [{"doc_id", "score", "text"}, ...]}
+    with up to `limit` hits, best first. Documents matching no query term are
+    left out, so the list may be empty.
+    """
+    loop = asyncio.get_running_loop()
+    hits = await loop.run_in_executor(executor, search_scored, query, limit or top_k)
+    return json.dumps({"shard": list(shard) if shard else None, "hits": hits})
+
+
+@mcp.tool(name="KnowledgeToolRefs")
+async def knowledge_tool_refs(query: str, limit: int | None = None) -> str:
+    """
+    Like KnowledgeToolScored, but hits on saved documents carry "offset" and
+    "length" into the index's docs.bin instead of "text". Returns a JSON
+    object {"store": {"path", "inode", "size"} or null, "hits": [...]}; a
+    client on the same machine reads passages from its own mapping of "path".
+    Documents changed since the index was last saved carry "text".
+    """
+    loop = asyncio.get_running_loop()
+    return json.dumps(await loop.run_in_executor(executor, search_refs, query, limit or top_k))
+
+
+def configure(
+    docs_dir: str, index_dir: str, k: int, executor_kind: str = "thread", pool_size: int = 4,
+    this_shard: Shard | None = None, ingest_interval: float = 0, chunk_chars: int = 1500,
+) -> None:
+    """Open (building or refreshing) the index and start the lookup executor.
+
+    With `ingest_interval`, the index is opened as saved and `docs_dir` is
+    ingested on a background thread instead, so serving starts at once.
+    """
+    global index, top_k, shard, executor, ingestor
+    if ingest_interval > 0 and executor_kind == "process":
+        # Worker processes keep the segment they mapped at start-up
+        raise ValueError("Background ingestion needs the thread executor")
+    index = open_index(index_dir, None if ingest_interval > 0 else docs_dir, this_shard)
+    if ingest_interval > 0:
+        ingestor = Ingestor(index, docs_dir, this_shard, chunk_chars=chunk_chars)
+        ingestor.start(ingest_interval)
+    top_k = k
+    shard = this_shard
+    if executor_kind == "process":
+        executor = ProcessPoolExecutor(
+            max_workers=pool_size,
+            # Forking a process that already runs an event loop and threads is unsafe
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_process_worker,
+            initargs=(str(shard_index_dir(index_dir, this_shard)),),
+        )
+    else:
+        executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="knowledge")
+
+
+def create_http_app():
+    """ASGI app for each uvicorn worker; settings arrive through KNOWLEDGE_* variables."""
+    configure(
+        os.environ.get("KNOWLEDGE_DOCS_DIR", "docs"),
+        os.environ.get("KNOWLEDGE_INDEX_DIR", ".index"),
+        int(os.environ.get("KNOWLEDGE_TOP_K", 3)),
+        os.environ.get("KNOWLEDGE_EXECUTOR", "thread"),
+        int(os.environ.get("KNOWLEDGE_POOL_SIZE", 4)),
+        parse_shard(os.environ.get("KNOWLEDGE_SHARD"), os.environ.get("KNOWLEDGE_NUM_SHARDS")),
+        float(os.environ.get("KNOWLEDGE_INGEST_INTERVAL", 0)),
+        int(os.environ.get("KNOWLEDGE_CHUNK_CHARS", 1500)),
+    )
+    return mcp.streamable_http_app()
+
+
+def parse_shard(number: str | int | None, count: str | int | None) -> Shard | None:
+    if number is None or count is None or int(count) <= 1:
+        return None
+    if not 0 <= int(number) < int(count):
+        raise ValueError(f"Shard {number} is out of range for {count} shards")
+    return int(number), int(count)
+
+
+# 3) Load the index and run the server loop (handles JSON-RPC, TaskGroups, etc.)
 if __name__ == "__main__":
-    mcp.run()
+    parser = argparse.ArgumentParser(description="BM25-backed MCP knowledge server")
+    parser.add_argument("--docs-dir", default=os.environ.get("KNOWLEDGE_DOCS_DIR", "docs"))
+    parser.add_argument("--index-dir", default=os.environ.get("KNOWLEDGE_INDEX_DIR", ".index"))
+    parser.add_argument("--top-k", type=int, default=int(os.environ.get("KNOWLEDGE_TOP_K", 3)))
+    parser.add_argument("--executor", choices=["thread", "process"], default=os.environ.get("KNOWLEDGE_EXECUTOR", "thread"))
+    parser.add_argument("--pool-size", type=int, default=int(os.environ.get("KNOWLEDGE_POOL_SIZE", 4)),
+                        help="lookup threads or processes per server process")
+    parser.add_argument("--transport", choices=["stdio", "streamable-http"], default="stdio")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--workers", type=int, default=1, help="server processes (streamable-http only)")
+    parser.add_argument("--shard", type=int, default=os.environ.get("KNOWLEDGE_SHARD"))
+    parser.add_argument("--num-shards", type=int, default=os.environ.get("KNOWLEDGE_NUM_SHARDS"))
+    parser.add_argument("--ingest-interval", type=float, default=float(os.environ.get("KNOWLEDGE_INGEST_INTERVAL", 0)),
+                        help="ingest --docs-dir in chunks on a background thread every N seconds")
+    parser.add_argument("--chunk-chars", type=int, default=int(os.environ.get("KNOWLEDGE_CHUNK_CHARS", 1500)),
+                        help="chunk size for --ingest-interval")
+    args = parser.parse_args()
+    this_shard = parse_shard(args.shard, args.num_shards)
+    if args.ingest_interval > 0 and args.executor == "process":
+        parser.error("--ingest-interval needs --executor thread")
+    if args.ingest_interval > 0 and args.workers > 1:
+        # Each worker would keep its own copy of the index up to date
+        parser.error("--ingest-interval needs a single worker")
+
+    # stdout carries JSON-RPC over stdio, so logs go to stderr
+    logging.basicConfig(level=logging.INFO)
+    if args.transport == "stdio":
+        configure(
+            args.docs_dir, args.index_dir, args.top_k, args.executor, args.pool_size, this_shard,
+            args.ingest_interval, args.chunk_chars,
+        )
+        mcp.run()
+    else:
+        import uvicorn
+
+        # Build or refresh the index once, before workers race to open it
+        if args.ingest_interval <= 0:
+            open_index(args.index_dir, args.docs_dir, this_shard)
+        if this_shard is not None:
+            os.environ.update(KNOWLEDGE_SHARD=str(this_shard[0]), KNOWLEDGE_NUM_SHARDS=str(this_shard[1]))
+        os.environ.update(
+            KNOWLEDGE_DOCS_DIR=args.docs_dir,
+            KNOWLEDGE_INDEX_DIR=args.index_dir,
+            KNOWLEDGE_TOP_K=str(args.top_k),
+            KNOWLEDGE_EXECUTOR=args.executor,
+            KNOWLEDGE_POOL_SIZE=str(args.pool_size),
+            KNOWLEDGE_INGEST_INTERVAL=str(args.ingest_interval),
+            KNOWLEDGE_CHUNK_CHARS=str(args.chunk_chars),
+        )
+        uvicorn.run(
+            "my_awesome_mcp_server:create_http_app", factory=True,
+            host=args.host, port=args.port, workers=args.workers,
+        )
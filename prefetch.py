@@ -0,0 +1,157 @@
+"""
+prefetch.py
+
+Speculative retrieval for the Streamlit app: start fetching contexts for the
+question in the input box before the user clicks "Retrieve", so the click
+only has to wait for generation.
+
+`st.text_input` reports a new value when the user presses Enter or leaves the
+field, not per keystroke, so that is when `Prefetcher.submit()` is called.
+Per browser session (`key`):
+- a submit waits `debounce` seconds before retrieving, and a newer submit in
+  that window cancels it, so quick successive edits cost nothing
+- a newer question also drops a retrieval already under way: its result is
+  never served, but it is left to finish rather than cancelled, because
+  cancelling a pooled MCP call discards the server session it ran on
+- `take()` hands over the result for the same question (and cache setting),
+  waiting for it if it is still in flight; stale or mismatched entries give
+  None and the caller retrieves as usual
+
+Retrievals run on a private event loop thread, like `mcp_pool.MCPSessionPool`.
+"""
+
+import asyncio
+import logging
+import re
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any
+
+from rag_engine import RAGEngine, Settings
+from retrieval import RetrievalResult
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Prefetch:
+    query: str
+    use_cache: bool
+    future: Future
+    submitted: float = field(default_factory=time.monotonic)
+    finished: float | None = None
+
+
+class Prefetcher:
+    """Debounced, per-session speculative `RAGEngine.retrieve()` calls."""
+
+    def __init__(self, engine: RAGEngine, debounce: float = 0.3, ttl: float = 60.0, max_sessions: int = 1000):
+        self.engine = engine
+        self.debounce = debounce
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._pending: dict[str, _Prefetch] = {}
+        self._lock = threading.Lock()
+        self._counters = {"submitted": 0, "debounced": 0, "dropped": 0, "hits": 0, "waited": 0, "misses": 0}
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="prefetch", daemon=True)
+        self._thread.start()
+
+    @classmethod
+    def from_settings(cls, engine: RAGEngine, get: Settings) -> "Prefetcher":
+        return cls(engine, debounce=float(get("PREFETCH_DEBOUNCE", 0.3)), ttl=float(get("PREFETCH_TTL", 60)))
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return re.sub(r"\s+", " ", query).strip().lower()
+
+    def submit(self, key: str, query: str, use_cache: bool = True) -> None:
+        """Start retrieving `query` for session `key` after the debounce delay, superseding its previous one."""
+        normalized = self.normalize(query)
+        if not normalized:
+            return
+        with self._lock:
+            previous = self._pending.pop(key, None)
+            if previous is not None and previous.query == normalized and previous.use_cache == use_cache:
+                if not self._expired(previous):
+                    self._pending[key] = previous
+                    return
+            if previous is not None:
+                self._supersede(previous)
+            future = asyncio.run_coroutine_threadsafe(self._fetch(query, use_cache), self._loop)
+            entry = self._pending[key] = _Prefetch(normalized, use_cache, future)
+            future.add_done_callback(lambda _: setattr(entry, "finished", time.monotonic()))
+            self._counters["submitted"] += 1
+            while len(self._pending) > self.max_sessions:
+                self._supersede(self._pending.pop(next(iter(self._pending))))
+
+    async def _fetch(self, query: str, use_cache: bool) -> RetrievalResult:
+        # Cancelled here, during the debounce, a superseded prefetch costs nothing
+        await asyncio.sleep(self.debounce)
+        # Shielded: from here on it only stops by finishing (see module docstring)
+        retrieval = asyncio.ensure_future(self.engine.retrieve(query, use_cache=use_cache))
+        retrieval.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return await asyncio.shield(retrieval)
+
+    def _supersede(self, entry: _Prefetch) -> None:
+        if entry.future.done():
+            return
+        entry.future.cancel()
+        self._counters["debounced" if self._debouncing(entry) else "dropped"] += 1
+
+    def _debouncing(self, entry: _Prefetch) -> bool:
+        return time.monotonic() - entry.submitted < self.debounce
+
+    def _expired(self, entry: _Prefetch) -> bool:
+        return entry.finished is not None and time.monotonic() - entry.finished > self.ttl
+
+    async def take(self, key: str, query: str, use_cache: bool = True) -> tuple[RetrievalResult | None, float]:
+        """The prefetched retrieval of `query` for `key` and how many seconds it was ready early (negative if waited for).
+
+        Returns `(None, 0.0)` when there is none to use; the caller then
+        retrieves itself.
+        """
+        with self._lock:
+            entry = self._pending.pop(key, None)
+        usable = (
+            entry is not None
+            and entry.query == self.normalize(query)
+            and entry.use_cache == use_cache
+            and not entry.future.cancelled()
+            and not self._expired(entry)
+        )
+        if not usable:
+            self._counters["misses"] += 1
+            return None, 0.0
+        start = time.monotonic()
+        if not entry.future.done():
+            # Submitted with this very click: the debounce would only add delay
+            if self._debouncing(entry):
+                entry.future.cancel()
+                self._counters["misses"] += 1
+                return None, 0.0
+            self._counters["waited"] += 1
+        try:
+            result = await asyncio.wrap_future(entry.future)
+        except Exception as e:
+            logger.warning(f"Prefetch of {query!r} failed: {e!r}")
+            self._counters["misses"] += 1
+            return None, 0.0
+        self._counters["hits"] += 1
+        return result, start - entry.finished if entry.finished is not None else 0.0
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            in_flight = sum(not entry.future.done() for entry in self._pending.values())
+        return {**self._counters, "sessions": len(self._pending), "in_flight": in_flight}
+
+    def close(self) -> None:
+        with self._lock:
+            for entry in self._pending.values():
+                entry.future.cancel()
+            self._pending.clear()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
@@ -0,0 +1,194 @@
+"""
+query_planner.py
+
+Optional pre-retrieval stage for compound questions.
+
+A planner splits a question into focused sub-queries; every sub-query is
+retrieved concurrently (so coalescing sources batch them into one tool call)
+and the per-sub-query rankings are merged with reciprocal rank fusion before
+the prompt is built.
+
+- `RuleBasedPlanner` splits on question marks, semicolons and clause-level
+  conjunctions, with no model call.
+- `LLMPlanner` asks a `BaseGenerator` for sub-questions, one per line, and
+  falls back to the rules when the reply is unusable; pass a
+  `FakeGenerator(chunks=[...])` to script it offline.
+"""
+
+import asyncio
+import logging
+import re
+
+from fed_rag.data_structures import KnowledgeNode
+
+from generation import BaseGenerator
+from knowledge_index import tokenize
+from retrieval import MultiSourceRetriever, RetrievalResult, text_fingerprint
+from telemetry import span
+
+logger = logging.getLogger(__name__)
+
+RRF_K = 60
+
+SENTENCE_SPLIT_RE = re.compile(r"(?<=\?)\s+|;\s*|\n+")
+CLAUSE_SPLIT_RE = re.compile(r",?\s+\b(?:and also|as well as|and then|and|also|versus|vs\.?)\b\s+", re.IGNORECASE)
+
+PLANNER_PROMPT = """Split the question below into at most {max_subqueries} short, self-contained search queries, one per line, with no numbering or commentary. If it asks only one thing, repeat it unchanged.
+
+Question: {query}"""
+
+
+class BaseQueryPlanner:
+    """Turns one question into the queries to retrieve for."""
+
+    async def plan(self, query: str) -> list[str]:
+        raise NotImplementedError
+
+
+class RuleBasedPlanner(BaseQueryPlanner):
+    """Split compound questions on punctuation and conjunctions.
+
+    A conjunction only splits when every side has at least `min_clause_words`
+    words including a content word, so "salt and pepper" stays whole.
+    With `include_original`, the full question is kept as the first query so
+    fusion can only add to what a plain retrieval would have found.
+    """
+
+    def __init__(self, max_subqueries: int = 4, min_clause_words: int = 3, include_original: bool = True):
+        self.max_subqueries = max_subqueries
+        self.min_clause_words = min_clause_words
+        self.include_original = include_original
+
+    def split(self, query: str) -> list[str]:
+        parts: list[str] = []
+        for sentence in SENTENCE_SPLIT_RE.split(query.strip()):
+            sentence = sentence.strip(" ,.")
+            if not sentence:
+                continue
+            clauses = [c.strip(" ,.") for c in CLAUSE_SPLIT_RE.split(sentence)]
+            if len(clauses) > 1 and all(len(c.split()) >= self.min_clause_words and tokenize(c) for c in clauses):
+                parts.extend(clauses)
+            else:
+                parts.append(sentence)
+        return parts
+
+    async def plan(self, query: str) -> list[str]:
+        parts = self.split(query)
+        if len(parts) <= 1:
+            return [query]
+        queries = [query, *parts] if self.include_original else parts
+        return list(dict.fromkeys(queries))[: self.max_subqueries + int(self.include_original)]
+
+
+class LLMPlanner(BaseQueryPlanner):
+    """Ask the generator for sub-queries; fall back to `fallback` on errors or empty replies."""
+
+    def __init__(
+        self,
+        generator: BaseGenerator,
+        max_subqueries: int = 4,
+        include_original: bool = True,
+        fallback: BaseQueryPlanner | None = None,
+        prompt_template: str = PLANNER_PROMPT,
+    ):
+        self.generator = generator
+        self.max_subqueries = max_subqueries
+        self.include_original = include_original
+        self.fallback = fallback or RuleBasedPlanner(max_subqueries, include_original=include_original)
+        self.prompt_template = prompt_template
+
+    @staticmethod
+    def parse(reply: str) -> list[str]:
+        lines = []
+        for line in reply.splitlines():
+            line = re.sub(r"^\s*(?:[-*•]|\d+[.)])\s*", "", line).strip()
+            if line and not line.lower().startswith(("question:", "queries:", "here are")):
+                lines.append(line)
+        return lines
+
+    async def plan(self, query: str) -> list[str]:
+        prompt = self.prompt_template.format(query=query, max_subqueries=self.max_subqueries)
+        try:
+            parts = self.parse(await self.generator.generate(prompt))
+        except Exception as e:
+            logger.warning(f"LLM query planner failed, using rules: {e!r}")
+            return await self.fallback.plan(query)
+        parts = parts[: self.max_subqueries]
+        if not parts:
+            return await self.fallback.plan(query)
+        if len(parts) == 1:
+            return [query]
+        queries = [query, *parts] if self.include_original else parts
+        return list(dict.fromkeys(queries))
+
+
+def make_planner(name: str | None, generator: BaseGenerator | None = None, max_subqueries: int = 4) -> BaseQueryPlanner | None:
+    """"rules", "llm" (needs `generator`) or ""/"none"."""
+    if not name or name == "none":
+        return None
+    if name == "rules":
+        return RuleBasedPlanner(max_subqueries)
+    if name == "llm":
+        if generator is None:
+            raise ValueError("The LLM query planner needs a generator.")
+        return LLMPlanner(generator, max_subqueries)
+    raise ValueError(f"Unknown query planner: {name!r}")
+
+
+def reciprocal_rank_fusion(
+    rankings: list[list[tuple[float, KnowledgeNode]]], k: int = RRF_K, top_k: int | None = None
+) -> list[tuple[float, KnowledgeNode]]:
+    """Fuse ranked lists: each node scores `sum(1 / (k + rank))` over the lists it appears in (rank from 1).
+
+    Nodes are matched on normalized text; the fused node lists every source
+    that returned it under `metadata["sources"]`.
+    """
+    scores: dict[str, float] = {}
+    nodes: dict[str, KnowledgeNode] = {}
+    sources: dict[str, list[str]] = {}
+    for ranking in rankings:
+        for rank, (_, node) in enumerate(ranking, start=1):
+            key = text_fingerprint(node.text_content or "")
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+            nodes.setdefault(key, node)
+            merged = sources.setdefault(key, [])
+            for name in (node.metadata or {}).get("sources", []):
+                if name not in merged:
+                    merged.append(name)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:top_k]
+    return [
+        (scores[key], nodes[key].model_copy(update={"metadata": {**(nodes[key].metadata or {}), "sources": sources[key]}}))
+        for key in ranked
+    ]
+
+
+async def retrieve_decomposed(
+    retriever: MultiSourceRetriever,
+    planner: BaseQueryPlanner,
+    query: str,
+    top_k: int | None = None,
+    use_cache: bool = True,
+) -> RetrievalResult:
+    """Plan, retrieve every sub-query concurrently and fuse; a single-query plan is a plain retrieval."""
+    with span("query_plan") as attrs:
+        queries = await planner.plan(query)
+        attrs["subqueries"] = len(queries)
+    if len(queries) <= 1:
+        result = await retriever.retrieve(query, top_k=top_k, use_cache=use_cache)
+        result.subqueries = [query]
+        return result
+
+    results = await asyncio.gather(*(retriever.retrieve(q, use_cache=use_cache) for q in queries))
+    fused = RetrievalResult(nodes=[], subqueries=queries)
+    for result in results:
+        for name, seconds in result.latencies.items():
+            fused.latencies[name] = max(seconds, fused.latencies.get(name, 0.0))
+        fused.cached.extend(name for name in result.cached if name not in fused.cached)
+        fused.timed_out.extend(name for name in result.timed_out if name not in fused.timed_out)
+        fused.failed.update(result.failed)
+        fused.stale.extend(name for name in result.stale if name not in fused.stale)
+    with span("fusion", lists=len(results)):
+        fused.nodes = reciprocal_rank_fusion(
+            [result.nodes for result in results], top_k=top_k if top_k is not None else retriever.top_k
+        )
+    return fused
@@ -0,0 +1,355 @@
+"""
+rag_engine.py
+
+The retrieve-then-generate pipeline as an importable, UI-free async engine.
+
+`RAGEngine` owns the long-lived pieces (MCP session pools, retrieval and
+answer caches, the generator client) so they survive across requests, and is
+shared by the Streamlit app (`app.py`) and the HTTP service (`service.py`).
+
+Settings are read through a `get(key, default)` callable, so the app passes
+`st.secrets.get` and the service passes `os.environ.get`.
+"""
+
+import asyncio
+import logging
+from collections.abc import AsyncIterator, Callable
+from dataclasses import dataclass
+from typing import Any
+
+from fed_rag.data_structures import KnowledgeNode
+from fed_rag.knowledge_stores.no_encode.mcp.sources.base import BaseMCPKnowledgeSource
+from mcp import StdioServerParameters
+
+from answer_cache import AnswerCache
+from cache import RetrievalCache
+from compact_results import REFS_TOOL, doc_refs_converter
+from context_builder import CONTEXT_SEPARATOR, AssembledContext, ContextBuilder, make_reranker
+from generation import BaseGenerator, FakeGenerator, GeminiGenerator, GenerationStats
+from mcp_pool import HttpServerParameters, MCPSessionPool, PoolConfig, QueryCoalescer, pooled_source
+from query_planner import BaseQueryPlanner, make_planner, retrieve_decomposed
+from resilience import ResiliencePolicy, ResilientKnowledgeSource
+from retrieval import MultiSourceRetriever, RetrievalResult, SourceConfig, load_source_configs
+from shard_router import ShardedKnowledgeSource, ShardRouter
+from telemetry import metrics, span
+
+logger = logging.getLogger(__name__)
+
+Settings = Callable[[str, Any], Any]
+
+# Extra seconds the retriever waits past a resilient source's own deadline
+STALE_GRACE = 0.5
+
+def build_prompt(query: str, nodes: list[tuple[float, KnowledgeNode]]) -> tuple[str, str]:
+    """Join node texts into the context block and the final prompt."""
+    contexts = CONTEXT_SEPARATOR.join(node.text_content or "" for _, node in nodes)
+    return contexts, f"Context:\n{contexts}\n\nQuestion: {query}"
+
+
+@dataclass
+class Answer:
+    """Everything one pipeline run produced."""
+
+    query: str
+    answer: str
+    retrieval: RetrievalResult
+    stats: GenerationStats
+    cached: bool = False
+    similarity: float | None = None
+    context: AssembledContext | None = None
+
+    @property
+    def nodes(self) -> list[tuple[float, KnowledgeNode]]:
+        """The nodes the prompt was built from (after dedupe, rerank and packing)."""
+        return self.context.nodes if self.context is not None else self.retrieval.nodes
+
+
+@dataclass
+class PipelineEvent:
+    """One step of `RAGEngine.answer_stream()` or `chat.chat_stream()`.
+
+    `type` is "plan" (chat only: the retrieval query, empty when the
+    session's context is reused), "retrieval" (contexts are ready),
+    "chunk" (answer text), or "done" (carries the final `Answer`).
+    """
+
+    type: str
+    text: str = ""
+    retrieval: RetrievalResult | None = None
+    answer: Answer | None = None
+
+
+class RAGEngine:
+    """Retrieve from MCP sources, then generate an answer."""
+
+    def __init__(
+        self,
+        retriever: MultiSourceRetriever,
+        generator: BaseGenerator,
+        answer_cache: AnswerCache | None = None,
+        pools: list[MCPSessionPool] | None = None,
+        context_builder: ContextBuilder | None = None,
+        planner: BaseQueryPlanner | None = None,
+    ):
+        self.retriever = retriever
+        self.generator = generator
+        self.answer_cache = answer_cache
+        self.pools = pools or []
+        self.context_builder = context_builder or ContextBuilder()
+        self.planner = planner
+
+    # ------------------------------------------------------------------
+    # Construction
+    # ------------------------------------------------------------------
+    @classmethod
+    def from_settings(cls, get: Settings, generator: BaseGenerator | None = None) -> "RAGEngine":
+        """Build pools, caches and generator from settings (secrets or environment)."""
+        pool_config = PoolConfig(
+            size=int(get("MCP_POOL_SIZE", 2)),
+            min_idle=int(get("MCP_POOL_MIN_IDLE", 1)),
+            idle_timeout=float(get("MCP_POOL_IDLE_TIMEOUT", 300)),
+            health_check_interval=float(get("MCP_POOL_HEALTH_CHECK_INTERVAL", 30)),
+        )
+        configs = load_source_configs(get("MCP_SOURCES_FILE", "mcp_sources.json"))
+        retrieval_cache = RetrievalCache(
+            max_entries=int(get("RETRIEVAL_CACHE_SIZE", 1024)),
+            ttl=float(get("RETRIEVAL_CACHE_TTL", 300)),
+            disk_path=get("RETRIEVAL_CACHE_DB", "") or None,
+            disk_ttl=float(get("RETRIEVAL_CACHE_DISK_TTL", 86400)),
+        )
+        retriever, pools = build_retriever(configs, pool_config, retrieval_cache)
+
+        threshold = get("ANSWER_CACHE_SEMANTIC_THRESHOLD", "")
+        answer_cache = AnswerCache(
+            max_entries=int(get("ANSWER_CACHE_SIZE", 512)),
+            ttl=float(get("ANSWER_CACHE_TTL", 3600)),
+            semantic_threshold=float(threshold) if threshold not in ("", None) else None,
+        )
+        max_tokens = int(get("CONTEXT_MAX_TOKENS", 2000))
+        dedupe_threshold = get("CONTEXT_DEDUPE_THRESHOLD", 0.85)
+        context_builder = ContextBuilder(
+            max_tokens=max_tokens if max_tokens > 0 else None,
+            reranker=make_reranker(get("CONTEXT_RERANKER", "lexical"), get("CONTEXT_CROSS_ENCODER_MODEL", "") or None),
+            dedupe_threshold=float(dedupe_threshold) if dedupe_threshold not in ("", None) else None,
+        )
+        generator = generator or make_generator(get)
+        planner = make_planner(get("QUERY_PLANNER", "none"), generator, int(get("QUERY_PLANNER_MAX_SUBQUERIES", 4)))
+        return cls(retriever, generator, answer_cache, pools, context_builder, planner)
+
+    async def warm_up(self, timeout: float | None = None) -> bool:
+        """Wait for every pool's `min_idle` sessions, so the first request does not spawn servers."""
+        with span("warm_up", pools=len(self.pools)):
+            ready = await asyncio.gather(*(pool.wait_ready(timeout=timeout) for pool in self.pools))
+        return all(ready)
+
+    def close(self) -> None:
+        """Terminate every MCP server process owned by this engine."""
+        for pool in self.pools:
+            pool.close()
+
+    # ------------------------------------------------------------------
+    # Pipeline
+    # ------------------------------------------------------------------
+    async def retrieve(self, query: str, use_cache: bool = True, top_k: int | None = None) -> RetrievalResult:
+        if self.planner is not None:
+            return await retrieve_decomposed(self.retriever, self.planner, query, top_k=top_k, use_cache=use_cache)
+        return await self.retriever.retrieve(query, top_k=top_k, use_cache=use_cache)
+
+    async def answer(
+        self, query: str, use_cache: bool = True, top_k: int | None = None, retrieval: RetrievalResult | None = None
+    ) -> Answer:
+        final = None
+        async for event in self.answer_stream(query, use_cache=use_cache, top_k=top_k, retrieval=retrieval):
+            if event.type == "done":
+                final = event.answer
+        return final
+
+    async def answer_stream(
+        self, query: str, use_cache: bool = True, top_k: int | None = None, retrieval: RetrievalResult | None = None
+    ) -> AsyncIterator[PipelineEvent]:
+        """Retrieve (unless `retrieval` was fetched already, e.g. by `prefetch.Prefetcher`), then stream the answer.
+
+        Ends with a "done" event.
+        """
+        if retrieval is None:
+            retrieval = await self.retrieve(query, use_cache=use_cache, top_k=top_k)
+        yield PipelineEvent("retrieval", retrieval=retrieval)
+
+        with span("prompt_build", contexts=len(retrieval.nodes)) as attrs:
+            context = self.context_builder.build(query, retrieval.nodes)
+            contexts, prompt = build_prompt(query, context.nodes)
+            attrs.update(context.as_dict())
+        if context.dropped_tokens:
+            metrics.inc("noencode_context_dropped_tokens_total", context.dropped_tokens)
+        model_name = self.generator.model_name
+        stats = GenerationStats()
+
+        cached = None
+        if use_cache and self.answer_cache is not None:
+            with span("answer_cache_lookup") as attrs:
+                cached = self.answer_cache.lookup(query, contexts, model_name)
+                attrs["hit"] = cached is not None
+            metrics.inc("noencode_cache_hits_total" if cached else "noencode_cache_misses_total", cache="answer")
+        if cached is not None:
+            stats.add_chunk(cached.answer)
+            stats.finish()
+            yield PipelineEvent("chunk", text=cached.answer)
+            answer = Answer(query, cached.answer, retrieval, stats, cached=True, similarity=cached.similarity, context=context)
+            yield PipelineEvent("done", answer=answer)
+            return
+
+        parts = []
+        with span("generation", model=model_name) as attrs:
+            async for chunk in self.generator.stream(prompt, stats):
+                parts.append(chunk)
+                yield PipelineEvent("chunk", text=chunk)
+            attrs.update(tokens=stats.tokens, ttft_ms=round(1000 * (stats.time_to_first_token or 0), 2))
+        text = "".join(parts)
+        if self.answer_cache is not None:
+            self.answer_cache.store(query, contexts, model_name, text, stats.total_time)
+        yield PipelineEvent("done", answer=Answer(query, text, retrieval, stats, context=context))
+
+    def publish_metrics(self) -> None:
+        """Copy pool occupancy and cache sizes into gauges, ahead of a scrape."""
+        for pool in self.pools:
+            for key, value in pool.stats().items():
+                metrics.set_gauge("noencode_pool", value, pool=pool.name, field=key)
+        if self.retriever.cache is not None:
+            for tier, tier_stats in self.retriever.cache.stats().items():
+                for key, value in tier_stats.items():
+                    metrics.set_gauge("noencode_retrieval_cache", value, tier=tier, field=key)
+
+    def stats(self) -> dict[str, Any]:
+        """Pool and cache counters for dashboards and the `/stats` endpoint."""
+        stats: dict[str, Any] = {"pools": {pool.name: pool.stats() for pool in self.pools}}
+        coalescers = {
+            name: source.coalescer.stats()
+            for name, source in self.retriever.sources.items()
+            if getattr(source, "coalescer", None) is not None
+        }
+        if coalescers:
+            stats["coalescers"] = coalescers
+        routers = {
+            name: source.router.stats()
+            for name, source in self.retriever.sources.items()
+            if getattr(source, "router", None) is not None
+        }
+        if routers:
+            stats["shard_routers"] = routers
+        resilience = {
+            name: source.stats()
+            for name, source in self.retriever.sources.items()
+            if isinstance(source, ResilientKnowledgeSource)
+        }
+        if resilience:
+            stats["resilience"] = resilience
+        if self.retriever.cache is not None:
+            stats["retrieval_cache"] = self.retriever.cache.stats()
+        if self.answer_cache is not None:
+            stats["answer_cache"] = self.answer_cache.stats.as_dict()
+        return stats
+
+
+def build_retriever(
+    configs: list[SourceConfig],
+    pool_config: PoolConfig,
+    cache: RetrievalCache | None = None,
+) -> tuple[MultiSourceRetriever, list[MCPSessionPool]]:
+    """One warm pool per distinct server command or URL; sources on the same server share it."""
+    pools: dict[tuple[str, ...], MCPSessionPool] = {}
+
+    def pool_for(url: str | None, command: str, args: list[str], replica: int = 0) -> MCPSessionPool:
+        key = (url,) if url else (command, *args, f"#{replica}")
+        if key not in pools:
+            if url:
+                params, name = HttpServerParameters(url), url
+            else:
+                params, name = StdioServerParameters(command=command, args=list(args)), " ".join(args)
+                name += f" #{replica}" if replica else ""
+            pools[key] = MCPSessionPool(params, pool_config, name=name)
+        return pools[key]
+
+    sources = []
+    timeouts = {}
+    for cfg in configs:
+        timeouts[cfg.name] = cfg.timeout
+        if cfg.sharded:
+            source = build_sharded_source(cfg, pool_for)
+        else:
+            source = build_pooled_source(cfg, pool_for(cfg.url, cfg.command, cfg.args))
+        policy = ResiliencePolicy.from_dict(cfg.resilience)
+        if policy.enabled:
+            policy.deadline = policy.deadline or cfg.timeout
+            # The wrapper enforces the deadline itself so it can still serve a
+            # stale result; the retriever's timeout is only a backstop
+            timeouts[cfg.name] = policy.deadline + STALE_GRACE
+            source = ResilientKnowledgeSource(source, policy)
+        sources.append(source)
+    retriever = MultiSourceRetriever(
+        sources,
+        timeouts=timeouts,
+        weights={cfg.name: cfg.weight for cfg in configs},
+        cache=cache,
+    )
+    return retriever, list(pools.values())
+
+
+def build_pooled_source(cfg: SourceConfig, pool: MCPSessionPool) -> BaseMCPKnowledgeSource:
+    """Single-server source on `pool`, coalescing into `cfg.batch_tool` or reading `compact` results when set."""
+    if cfg.compact:
+        if cfg.batch_tool:
+            raise ValueError(f"Source '{cfg.name}': compact results cannot be coalesced into a batch tool.")
+        source = pooled_source(
+            pool, name=cfg.name, tool_name=REFS_TOOL, query_param_name=cfg.query_param,
+            tool_call_kwargs=cfg.tool_call_kwargs,
+        )
+        return source.with_converter(doc_refs_converter)
+    coalescer = None
+    if cfg.batch_tool:
+        coalescer = QueryCoalescer(
+            pool, tool_name=cfg.batch_tool, query_param_name=cfg.batch_query_param,
+            window=cfg.batch_window, max_batch=cfg.max_batch, tool_call_kwargs=cfg.tool_call_kwargs,
+        )
+    return pooled_source(
+        pool, name=cfg.name,
+        tool_name=cfg.tool_name, query_param_name=cfg.query_param,
+        tool_call_kwargs=cfg.tool_call_kwargs, coalescer=coalescer,
+    )
+
+
+def build_sharded_source(cfg: SourceConfig, pool_for: Callable[..., MCPSessionPool]) -> ShardedKnowledgeSource:
+    """Router over `cfg.shard_urls`, or over `cfg.num_shards` local shards with `cfg.replicas` pools each."""
+    if cfg.shard_urls:
+        shards = [[pool_for(url, cfg.command, cfg.args) for url in replicas] for replicas in cfg.shard_urls]
+    else:
+        shards = [
+            [
+                pool_for(None, cfg.command, [*cfg.args, "--shard", str(i), "--num-shards", str(cfg.num_shards)], replica)
+                for replica in range(cfg.replicas)
+            ]
+            for i in range(cfg.num_shards)
+        ]
+    # The whole deadline on one replica would leave none for failing over
+    replica_timeout = cfg.replica_timeout or cfg.timeout / max(len(replicas) for replicas in shards)
+    router = ShardRouter(
+        shards, query_param_name=cfg.query_param, top_k=cfg.limit,
+        timeout=replica_timeout, tool_call_kwargs=cfg.tool_call_kwargs,
+    )
+    return ShardedKnowledgeSource(router, name=cfg.name)
+
+
+def make_generator(get: Settings) -> BaseGenerator:
+    """`GENERATOR=fake` selects the offline generator; otherwise Gemini."""
+    if get("GENERATOR", "gemini") == "fake":
+        return FakeGenerator(
+            first_chunk_delay=float(get("FAKE_GENERATOR_FIRST_CHUNK_DELAY", 0.0)),
+            chunk_delay=float(get("FAKE_GENERATOR_CHUNK_DELAY", 0.0)),
+        )
+
+    import google.generativeai as genai
+
+    api_key = get("GEMINI_API_KEY", "")
+    if not api_key:
+        raise RuntimeError("GEMINI_API_KEY is not set.")
+    genai.configure(api_key=api_key)
+    return GeminiGenerator(genai.GenerativeModel(get("GEMINI_MODEL", "gemini-2.0-flash")))
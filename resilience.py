@@ -0,0 +1,352 @@
+"""
+resilience.py
+
+Keeps retrieval latency bounded when an MCP source is slow, flaky or down.
+
+`ResilientKnowledgeSource` wraps any knowledge source and adds, per call:
+- a deadline for the whole call and an optional timeout per attempt,
+- retries with full-jitter exponential backoff inside that deadline,
+- a hedged duplicate request once an attempt runs past the source's recent
+  p95 latency (the pool hands it a second session), but no later than
+  `max_hedge_fraction` of the deadline; the first success wins,
+- a `CircuitBreaker` that fails fast after repeated failures and lets a
+  single probe through once `reset_timeout` has passed.
+
+When a call fails, times out or is refused by an open breaker, the last
+successful result for the same query is served instead, marked stale in the
+result's `meta`, so `MultiSourceRetriever` can report it.
+"""
+
+import asyncio
+import logging
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, fields
+from typing import Any
+
+from fed_rag.knowledge_stores.no_encode.mcp.sources.base import BaseMCPKnowledgeSource
+from mcp.types import CallToolResult, TextContent
+from pydantic import Field
+
+from telemetry import metrics
+
+logger = logging.getLogger(__name__)
+
+STALE_META_KEY = "noencode_stale"
+
+metrics.describe("noencode_retries_total", "Retrieval attempts retried after a failure.")
+metrics.describe("noencode_hedges_total", "Duplicate requests sent after an attempt passed the source's p95 latency.")
+metrics.describe("noencode_stale_results_total", "Last known-good results served in place of a failed call.")
+metrics.describe("noencode_circuit_open", "1 while a source's circuit breaker refuses calls.")
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a source whose breaker is open."""
+
+
+class ToolCallError(RuntimeError):
+    """The tool ran but reported an error (`isError`)."""
+
+
+@dataclass
+class ResiliencePolicy:
+    """Per-source settings; `SourceConfig.resilience` overrides any of them.
+
+    `deadline=None` uses the source's retrieval timeout. Hedging needs
+    `min_samples` successful calls before it has a p95 to go by, and a pool
+    with more than one session to be any faster. The first `warmup_calls`
+    are left out of the p95: they pay for starting the server and opening
+    sessions, and would hold hedging off for the whole window.
+    """
+
+    enabled: bool = True
+    deadline: float | None = None
+    attempt_timeout: float | None = None
+    retries: int = 1
+    backoff_base: float = 0.05
+    backoff_max: float = 1.0
+    hedge: bool = True
+    hedge_quantile: float = 0.95
+    min_hedge_delay: float = 0.01
+    min_samples: int = 20
+    warmup_calls: int = 1
+    max_hedge_fraction: float = 0.5
+    breaker_failures: int = 5
+    breaker_reset: float = 30.0
+    serve_stale: bool = True
+    stale_entries: int = 256
+
+    @classmethod
+    def from_dict(cls, overrides: dict[str, Any] | None) -> "ResiliencePolicy":
+        known = {f.name for f in fields(cls)}
+        unknown = set(overrides or {}) - known
+        if unknown:
+            raise ValueError(f"Unknown resilience settings: {sorted(unknown)}")
+        return cls(**(overrides or {}))
+
+    def backoff(self, attempt: int) -> float:
+        """Full jitter: uniform in [0, min(max, base * 2**attempt)]."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class LatencyTracker:
+    """Rolling window of recent successful call latencies, ignoring the first `warmup` ones."""
+
+    def __init__(self, window: int = 200, warmup: int = 0):
+        self._samples: deque[float] = deque(maxlen=window)
+        self._warmup = warmup
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            if self._warmup > 0:
+                self._warmup -= 1
+                return
+            self._samples.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def quantile(self, q: float) -> float | None:
+        with self._lock:
+            ordered = sorted(self._samples)
+        if not ordered:
+            return None
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class CircuitBreaker:
+    """Closed → open after `failure_threshold` consecutive failures → half-open after `reset_timeout`.
+
+    While half-open a single probe call is allowed; its success closes the
+    breaker and its failure opens it for another `reset_timeout`.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: float | None = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        return "half_open" if time.monotonic() - self.opened_at >= self.reset_timeout else "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.opened_at is not None:
+                logger.info(f"Circuit for '{self.name}' closed")
+            self.failures = 0
+            self.opened_at = None
+            self._probing = False
+        metrics.set_gauge("noencode_circuit_open", 0, source=self.name)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self._probing:
+                    logger.warning(f"Circuit for '{self.name}' opened after {self.failures} failures")
+                self.opened_at = time.monotonic()
+            self._probing = False
+        if self.opened_at is not None:
+            metrics.set_gauge("noencode_circuit_open", 1, source=self.name)
+
+    def release_probe(self) -> None:
+        """Let another caller probe when this one's call ended without an outcome."""
+        with self._lock:
+            self._probing = False
+
+    def stats(self) -> dict[str, Any]:
+        return {"state": self.state, "consecutive_failures": self.failures}
+
+
+class LastKnownGood:
+    """LRU of the latest successful result per normalized query."""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, CallToolResult]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(query: str) -> str:
+        return re.sub(r"\s+", " ", query).strip().lower()
+
+    def put(self, query: str, result: CallToolResult) -> None:
+        with self._lock:
+            self._entries[self.key(query)] = (time.time(), result)
+            self._entries.move_to_end(self.key(query))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get(self, query: str) -> tuple[float, CallToolResult] | None:
+        with self._lock:
+            return self._entries.get(self.key(query))
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def stale_info(result: CallToolResult) -> dict[str, Any] | None:
+    """The staleness note a `ResilientKnowledgeSource` attached, if any."""
+    return (result.meta or {}).get(STALE_META_KEY)
+
+
+class ResilientKnowledgeSource(BaseMCPKnowledgeSource):
+    """Deadlines, retries, hedging, a circuit breaker and stale fallback around `inner`."""
+
+    inner: BaseMCPKnowledgeSource | None = Field(default=None, exclude=True)
+    policy: ResiliencePolicy | None = Field(default=None, exclude=True)
+
+    def __init__(self, inner: BaseMCPKnowledgeSource, policy: ResiliencePolicy | None = None, **kwargs: Any):
+        super().__init__(
+            name=inner.name, tool_name=inner.tool_name, query_param_name=inner.query_param_name,
+            tool_call_kwargs=inner.tool_call_kwargs, **kwargs,
+        )
+        self.inner = inner
+        self.policy = policy or ResiliencePolicy()
+        self._converter_fn = inner._converter_fn
+        self._breaker = CircuitBreaker(inner.name, self.policy.breaker_failures, self.policy.breaker_reset)
+        self._latencies = LatencyTracker(warmup=self.policy.warmup_calls)
+        self._last_good = LastKnownGood(self.policy.stale_entries)
+        self._counters = {"calls": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "stale": 0, "rejected": 0}
+
+    @property
+    def coalescer(self):
+        return getattr(self.inner, "coalescer", None)
+
+    @property
+    def router(self):
+        return getattr(self.inner, "router", None)
+
+    def stats(self) -> dict[str, Any]:
+        p95 = self._latencies.quantile(self.policy.hedge_quantile)
+        return {
+            **self._counters,
+            "breaker": self._breaker.stats(),
+            "p95_ms": round(1000 * p95, 2) if p95 is not None else None,
+            "known_good": len(self._last_good),
+        }
+
+    async def retrieve(self, query: str) -> CallToolResult:
+        self._counters["calls"] += 1
+        if not self._breaker.allow():
+            self._counters["rejected"] += 1
+            return self._fallback(query, CircuitOpenError(f"Circuit for '{self.name}' is open"))
+        try:
+            call = self._with_retries(query, time.monotonic() + self.policy.deadline if self.policy.deadline else None)
+            result = await (asyncio.wait_for(call, self.policy.deadline) if self.policy.deadline else call)
+        except asyncio.CancelledError:
+            # The caller gave up; that says nothing about the source
+            self._breaker.release_probe()
+            raise
+        except Exception as e:
+            self._breaker.record_failure()
+            return self._fallback(query, e)
+        self._breaker.record_success()
+        self._last_good.put(query, result)
+        return result
+
+    def _fallback(self, query: str, error: Exception) -> CallToolResult:
+        cached = self._last_good.get(query) if self.policy.serve_stale else None
+        if cached is None:
+            raise error
+        stored_at, result = cached
+        self._counters["stale"] += 1
+        metrics.inc("noencode_stale_results_total", source=self.name)
+        logger.warning(f"Serving last known-good result from '{self.name}' after {error!r}")
+        note = {"age": round(time.time() - stored_at, 1), "reason": str(error) or type(error).__name__}
+        return result.model_copy(update={"meta": {**(result.meta or {}), STALE_META_KEY: note}})
+
+    async def _with_retries(self, query: str, deadline: float | None) -> CallToolResult:
+        attempt = 0
+        while True:
+            try:
+                return await self._hedged(query)
+            except Exception as e:
+                delay = self.policy.backoff(attempt)
+                out_of_time = deadline is not None and time.monotonic() + delay >= deadline
+                if attempt >= self.policy.retries or out_of_time:
+                    raise
+                logger.info(f"Retrying '{self.name}' in {delay * 1000:.0f} ms after {e!r}")
+                self._counters["retries"] += 1
+                metrics.inc("noencode_retries_total", source=self.name)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def _attempt(self, query: str) -> CallToolResult:
+        call = self.inner.retrieve(query)
+        result = await (asyncio.wait_for(call, self.policy.attempt_timeout) if self.policy.attempt_timeout else call)
+        if result.isError:
+            text = "".join(c.text for c in result.content if isinstance(c, TextContent))
+            raise ToolCallError(f"{self.tool_name} failed: {text}")
+        return result
+
+    def _hedge_delay(self) -> float | None:
+        if not self.policy.hedge or len(self._latencies) < self.policy.min_samples:
+            return None
+        delay = max(self.policy.min_hedge_delay, self._latencies.quantile(self.policy.hedge_quantile))
+        if self.policy.deadline:
+            # A slow spell in the window must not push the hedge past the deadline
+            delay = min(delay, self.policy.max_hedge_fraction * self.policy.deadline)
+        return delay
+
+    async def _hedged(self, query: str) -> CallToolResult:
+        # Latency is what the caller saw, so a losing copy never skews the p95
+        start = time.perf_counter()
+        delay = self._hedge_delay()
+        if delay is None:
+            result = await self._attempt(query)
+            self._latencies.add(time.perf_counter() - start)
+            return result
+
+        first = asyncio.ensure_future(self._attempt(query))
+        tasks = {first}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                logger.debug(f"Hedging '{self.name}' after {delay * 1000:.0f} ms")
+                self._counters["hedges"] += 1
+                metrics.inc("noencode_hedges_total", source=self.name)
+                tasks.add(asyncio.ensure_future(self._attempt(query)))
+            pending = set(tasks)
+            error: BaseException | None = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._counters["hedge_wins"] += 1
+                        self._latencies.add(time.perf_counter() - start)
+                        return task.result()
+                    error = task.exception()
+            raise error
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            # The losing copy is left to finish: cancelling a call mid-flight
+            # makes the pool discard its session. Its outcome is ignored.
+            for task in tasks:
+                if not task.done():
+                    task.add_done_callback(lambda t: t.cancelled() or t.exception())
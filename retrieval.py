@@ -0,0 +1,244 @@
+"""
+retrieval.py
+
+Fan-out retrieval across several MCP knowledge sources.
+
+Every source is queried concurrently with its own deadline. Sources that time
+out or fail are reported but do not sink the request: whatever arrived in
+time is merged, deduplicated on normalized text and returned as one ranked
+list of `(score, KnowledgeNode)` tuples.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from fed_rag.data_structures import KnowledgeNode
+from fed_rag.knowledge_stores.no_encode.mcp.sources.base import BaseMCPKnowledgeSource
+
+from cache import RetrievalCache
+from resilience import stale_info
+from shard_router import shard_failures
+from telemetry import metrics, span
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 10.0
+
+
+@dataclass
+class SourceConfig:
+    """One MCP backend as declared in `mcp_sources.json`.
+
+    With `url` set the source talks streamable HTTP to a running server and
+    `command`/`args` are ignored. With `batch_tool` set, concurrent queries
+    to this source are coalesced into calls of that tool for up to
+    `batch_window` seconds.
+
+    A sharded source is either `num_shards` local server processes (the
+    command plus `--shard I --num-shards N`, `replicas` pools per shard) or
+    remote replicas listed per shard in `shard_urls`; its top `limit` hits
+    are merged by score (see `shard_router.py`). Each replica call gets
+    `replica_timeout` seconds, by default an equal share of `timeout` per
+    replica, so a hung replica leaves time to fail over to the next one.
+
+    With `compact`, the source calls `KnowledgeToolRefs` instead of
+    `tool_name` and reads passages from the server's memory-mapped docs.bin
+    (see `compact_results.py`); the server must be on the same machine.
+
+    `resilience` overrides `resilience.ResiliencePolicy` defaults (retries,
+    hedging, circuit breaker, stale fallback); `{"enabled": false}` turns
+    the layer off for this source.
+    """
+
+    name: str
+    command: str = "python"
+    args: list[str] = field(default_factory=lambda: ["my_awesome_mcp_server.py"])
+    tool_name: str = "KnowledgeTool"
+    query_param: str = "query"
+    timeout: float = DEFAULT_TIMEOUT
+    weight: float = 1.0
+    tool_call_kwargs: dict[str, Any] = field(default_factory=dict)
+    url: str | None = None
+    batch_tool: str | None = None
+    batch_query_param: str = "queries"
+    batch_window: float = 0.002
+    max_batch: int = 32
+    num_shards: int = 1
+    replicas: int = 1
+    shard_urls: list[list[str]] | None = None
+    replica_timeout: float | None = None
+    limit: int = 5
+    compact: bool = False
+    resilience: dict[str, Any] = field(default_factory=dict)
+
+    @property
+    def sharded(self) -> bool:
+        return self.num_shards > 1 or bool(self.shard_urls)
+
+
+DEFAULT_SOURCES = [SourceConfig(name="mcp", batch_tool="KnowledgeToolBatch")]
+
+
+def load_source_configs(path: str | Path | None) -> list[SourceConfig]:
+    """Read source declarations from a JSON list; fall back to the demo server."""
+    if not path or not Path(path).exists():
+        return list(DEFAULT_SOURCES)
+    with open(path, encoding="utf-8") as f:
+        entries = json.load(f)
+    return [SourceConfig(**entry) for entry in entries]
+
+
+def text_fingerprint(text: str) -> str:
+    """Hash of case- and whitespace-normalized text, used for deduplication."""
+    normalized = re.sub(r"\s+", " ", text).strip().lower()
+    return hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class RetrievalResult:
+    """Merged nodes plus per-source outcome for one query."""
+
+    nodes: list[tuple[float, KnowledgeNode]]
+    latencies: dict[str, float] = field(default_factory=dict)
+    cached: list[str] = field(default_factory=list)
+    timed_out: list[str] = field(default_factory=list)
+    failed: dict[str, str] = field(default_factory=dict)
+    subqueries: list[str] = field(default_factory=list)
+    stale: list[str] = field(default_factory=list)
+
+    @property
+    def partial(self) -> bool:
+        return bool(self.timed_out or self.failed)
+
+
+def reported_score(node: KnowledgeNode) -> float | None:
+    """The numeric `score` a source put in the node's metadata, if any."""
+    score = node.metadata.get("score") if node.metadata else None
+    return float(score) if isinstance(score, (int, float)) and not isinstance(score, bool) else None
+
+
+class MultiSourceRetriever:
+    """Query many `BaseMCPKnowledgeSource`s at once and merge their nodes.
+
+    Sources return plain text without scores, so each node is scored by its
+    position within its source (`weight / (rank + 1)`) unless the node carries
+    a numeric `score` in its metadata. Reported scores (BM25 from sharded and
+    compact sources) are divided by the source's best one, so they share the
+    0-1 range of positional scores and `weight` still decides between sources.
+    Duplicates across sources keep the best score and list every contributing
+    source under `metadata["sources"]`.
+
+    With a `RetrievalCache`, each source's nodes are cached separately so a
+    slow or failing source never evicts the others' entries.
+    """
+
+    def __init__(
+        self,
+        sources: list[BaseMCPKnowledgeSource],
+        timeouts: dict[str, float] | None = None,
+        weights: dict[str, float] | None = None,
+        default_timeout: float = DEFAULT_TIMEOUT,
+        top_k: int | None = None,
+        cache: RetrievalCache | None = None,
+    ):
+        self.sources = {s.name: s for s in sources}
+        self.timeouts = timeouts or {}
+        self.weights = weights or {}
+        self.default_timeout = default_timeout
+        self.top_k = top_k
+        self.cache = cache
+
+    async def _retrieve_from_source(self, name: str, query: str, outcome: RetrievalResult | None = None) -> list[KnowledgeNode]:
+        source = self.sources[name]
+        timeout = self.timeouts.get(name, self.default_timeout)
+        result = await asyncio.wait_for(source.retrieve(query), timeout)
+        if outcome is not None:
+            if stale_info(result) is not None:
+                outcome.stale.append(name)
+            # A sharded source answers without the shards that failed: partial, not failed outright
+            for shard, error in shard_failures(result).items():
+                outcome.failed[f"{name}/shard-{shard}"] = error
+        with span("node_parse", source=name):
+            return source.call_tool_result_to_knowledge_nodes_list(result)
+
+    async def _timed(self, name: str, query: str, result: RetrievalResult, use_cache: bool) -> list[KnowledgeNode]:
+        start = time.perf_counter()
+        source = self.sources[name]
+        tool_name, tool_call_kwargs = source.tool_name, source.tool_call_kwargs
+        try:
+            if self.cache is not None and use_cache:
+                nodes = self.cache.get(query, name, tool_name, tool_call_kwargs)
+                if nodes is not None:
+                    metrics.inc("noencode_cache_hits_total", cache="retrieval", source=name)
+                    result.cached.append(name)
+                    return nodes
+                metrics.inc("noencode_cache_misses_total", cache="retrieval", source=name)
+            nodes = await self._retrieve_from_source(name, query, result)
+            missing_shards = any(key.startswith(f"{name}/") for key in result.failed)
+            if self.cache is not None and name not in result.stale and not missing_shards:
+                self.cache.set(query, name, tool_name, nodes, tool_call_kwargs)
+            return nodes
+        finally:
+            result.latencies[name] = time.perf_counter() - start
+
+    async def retrieve(self, query: str, top_k: int | None = None, use_cache: bool = True) -> RetrievalResult:
+        """Retrieve from every source; `use_cache=False` skips cache reads but still refreshes entries."""
+        result = RetrievalResult(nodes=[])
+        names = list(self.sources)
+        with span("retrieval", sources=len(names)):
+            outcomes = await asyncio.gather(
+                *(self._timed(name, query, result, use_cache) for name in names), return_exceptions=True
+            )
+
+        per_source: dict[str, list[KnowledgeNode]] = {}
+        for name, outcome in zip(names, outcomes):
+            if isinstance(outcome, asyncio.TimeoutError):
+                logger.warning(f"Source '{name}' missed its deadline")
+                metrics.inc("noencode_timeouts_total", stage="retrieval", source=name)
+                result.timed_out.append(name)
+            elif isinstance(outcome, BaseException):
+                logger.warning(f"Source '{name}' failed: {outcome!r}")
+                metrics.inc("noencode_errors_total", stage="retrieval", error=type(outcome).__name__, source=name)
+                result.failed[name] = str(outcome) or type(outcome).__name__
+            else:
+                per_source[name] = outcome
+
+        with span("merge"):
+            result.nodes = self.merge(per_source, top_k if top_k is not None else self.top_k)
+        return result
+
+    def merge(self, per_source: dict[str, list[KnowledgeNode]], top_k: int | None = None) -> list[tuple[float, KnowledgeNode]]:
+        """Score, dedupe and rank nodes collected from several sources."""
+        best: dict[str, tuple[float, KnowledgeNode]] = {}
+        contributors: dict[str, list[str]] = {}
+        for name, nodes in per_source.items():
+            weight = self.weights.get(name, 1.0)
+            reported_scores = [reported_score(node) for node in nodes]
+            top = max((score for score in reported_scores if score is not None), default=None)
+            for rank, (node, reported) in enumerate(zip(nodes, reported_scores)):
+                if reported is not None and top and top > 0:
+                    score = weight * reported / top
+                else:
+                    score = weight / (rank + 1)
+                # Passages read from a shared document store are identified by location
+                key = (node.metadata or {}).get("doc_ref") or text_fingerprint(node.text_content or "")
+                contributors.setdefault(key, [])
+                if name not in contributors[key]:
+                    contributors[key].append(name)
+                if key not in best or score > best[key][0]:
+                    best[key] = (score, node)
+
+        ranked = sorted(best.items(), key=lambda kv: kv[1][0], reverse=True)
+        merged = []
+        for key, (score, node) in ranked[:top_k]:
+            # Copy: the original may be shared with the retrieval cache
+            node = node.model_copy(update={"metadata": {**(node.metadata or {}), "sources": contributors[key]}})
+            merged.append((score, node))
+        return merged
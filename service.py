@@ -0,0 +1,208 @@
+"""
+service.py
+
+Headless HTTP API for the NoEncode RAG pipeline.
+
+    uvicorn service:app --host 0.0.0.0 --port 8000
+
+Endpoints:
+- POST /retrieve       contexts only
+- POST /answer         contexts plus the generated answer
+- POST /answer/stream  newline-delimited JSON events as the answer is generated
+- POST /batch          many questions, results streamed as newline-delimited JSON
+- POST /chat           one turn of a multi-turn conversation (see `chat.py`)
+- DELETE /chat/{id}    forget a conversation
+- GET  /stats          pool and cache counters
+- GET  /metrics        Prometheus text format: stage latencies, errors, timeouts, cache hits
+- GET  /health
+
+Single-query responses carry a `timings` list with the per-stage spans of
+that request (see `telemetry.py`).
+
+Configuration comes from environment variables with the same names as the
+Streamlit secrets (GEMINI_API_KEY, MCP_SOURCES_FILE, MCP_POOL_SIZE, ...).
+Set GENERATOR=fake and point MCP_SOURCES_FILE at `stub_mcp_server.py` to run
+fully offline.
+"""
+
+import json
+import logging
+import os
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
+from typing import Any
+
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+
+from batch import answer_questions
+from chat import ChatStore, chat_stream
+from rag_engine import Answer, RAGEngine
+from retrieval import RetrievalResult
+from telemetry import metrics, start_trace
+
+logger = logging.getLogger(__name__)
+
+
+class QueryRequest(BaseModel):
+    query: str
+    use_cache: bool = True
+    top_k: int | None = None
+
+
+class BatchItem(BaseModel):
+    id: str | None = None
+    question: str
+
+
+class BatchRequest(BaseModel):
+    questions: list[BatchItem]
+    concurrency: int = 4
+    rate: float | None = None
+    use_cache: bool = True
+
+
+class ChatRequest(BaseModel):
+    question: str
+    session_id: str | None = None
+    use_cache: bool = True
+
+
+def retrieval_payload(result: RetrievalResult) -> dict[str, Any]:
+    return {
+        "contexts": [
+            {"score": score, "text": node.text_content, "sources": node.metadata.get("sources", [])}
+            for score, node in result.nodes
+        ],
+        "latencies": result.latencies,
+        "cached_sources": result.cached,
+        "timed_out": result.timed_out,
+        "failed": result.failed,
+        "stale": result.stale,
+        "subqueries": result.subqueries,
+    }
+
+
+def answer_payload(answer: Answer) -> dict[str, Any]:
+    return {
+        "answer": answer.answer,
+        "cached": answer.cached,
+        "similarity": answer.similarity,
+        "generation": answer.stats.as_dict(),
+        "context": answer.context.as_dict() if answer.context is not None else None,
+    }
+
+
+def create_app(engine: RAGEngine | None = None) -> FastAPI:
+    """Build the API around `engine`, or one configured from the environment.
+
+    An injected engine is left open on shutdown; one built here is closed.
+    """
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        owned = engine is None
+        app.state.engine = engine or RAGEngine.from_settings(os.environ.get)
+        app.state.chats = ChatStore.from_settings(os.environ.get)
+        # Serve once the pools are warm; a source that cannot start is reported per request
+        if not await app.state.engine.warm_up():
+            logger.warning("Starting with MCP pools that are not fully warm")
+        try:
+            yield
+        finally:
+            if owned:
+                app.state.engine.close()
+
+    app = FastAPI(title="NoEncode RAG", lifespan=lifespan)
+
+    @app.get("/health")
+    async def health() -> dict[str, str]:
+        return {"status": "ok"}
+
+    @app.get("/stats")
+    async def stats(request: Request) -> dict[str, Any]:
+        return {**request.app.state.engine.stats(), "chat": request.app.state.chats.stats()}
+
+    @app.get("/metrics")
+    async def prometheus_metrics(request: Request) -> PlainTextResponse:
+        request.app.state.engine.publish_metrics()
+        return PlainTextResponse(metrics.render_prometheus(), media_type="text/plain; version=0.0.4")
+
+    @app.post("/retrieve")
+    async def retrieve(body: QueryRequest, request: Request) -> dict[str, Any]:
+        with start_trace("retrieve") as trace:
+            result = await request.app.state.engine.retrieve(body.query, use_cache=body.use_cache, top_k=body.top_k)
+        return {"query": body.query, **retrieval_payload(result), "timings": trace.breakdown()}
+
+    @app.post("/answer")
+    async def answer(body: QueryRequest, request: Request) -> dict[str, Any]:
+        with start_trace("answer") as trace:
+            result = await request.app.state.engine.answer(body.query, use_cache=body.use_cache, top_k=body.top_k)
+        return {
+            "query": body.query,
+            **answer_payload(result),
+            **retrieval_payload(result.retrieval),
+            "timings": trace.breakdown(),
+        }
+
+    @app.post("/answer/stream")
+    async def answer_stream(body: QueryRequest, request: Request) -> StreamingResponse:
+        engine: RAGEngine = request.app.state.engine
+
+        async def events() -> AsyncIterator[str]:
+            with start_trace("answer_stream") as trace:
+                async for event in engine.answer_stream(body.query, use_cache=body.use_cache, top_k=body.top_k):
+                    if event.type == "retrieval":
+                        payload = {"type": "retrieval", **retrieval_payload(event.retrieval)}
+                    elif event.type == "chunk":
+                        payload = {"type": "chunk", "text": event.text}
+                    else:
+                        payload = {"type": "done", **answer_payload(event.answer), "timings": trace.breakdown()}
+                    yield json.dumps(payload) + "\n"
+
+        return StreamingResponse(events(), media_type="application/x-ndjson")
+
+    @app.post("/batch")
+    async def batch(body: BatchRequest, request: Request) -> StreamingResponse:
+        engine: RAGEngine = request.app.state.engine
+        questions = ({"id": item.id or str(i), "question": item.question} for i, item in enumerate(body.questions, 1))
+
+        async def results() -> AsyncIterator[str]:
+            async for record in answer_questions(
+                engine, questions, concurrency=max(1, body.concurrency), rate=body.rate, use_cache=body.use_cache
+            ):
+                yield json.dumps(record) + "\n"
+
+        return StreamingResponse(results(), media_type="application/x-ndjson")
+
+    @app.post("/chat")
+    async def chat(body: ChatRequest, request: Request) -> dict[str, Any]:
+        session = request.app.state.chats.get(body.session_id)
+        with start_trace("chat") as trace:
+            async for event in chat_stream(request.app.state.engine, session, body.question, use_cache=body.use_cache):
+                if event.type == "plan":
+                    retrieval_query = event.text or None
+                elif event.type == "done":
+                    result = event.answer
+        return {
+            "session_id": session.id,
+            "query": body.question,
+            "retrieval_query": retrieval_query,
+            "reused_context": retrieval_query is None,
+            **answer_payload(result),
+            **retrieval_payload(result.retrieval),
+            "session": session.as_dict(),
+            "timings": trace.breakdown(),
+        }
+
+    @app.delete("/chat/{session_id}")
+    async def delete_chat(session_id: str, request: Request) -> dict[str, str]:
+        if not request.app.state.chats.delete(session_id):
+            raise HTTPException(status_code=404, detail=f"Unknown chat session '{session_id}'")
+        return {"deleted": session_id}
+
+    return app
+
+
+app = create_app()
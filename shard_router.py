@@ -0,0 +1,182 @@
+"""
+shard_router.py
+
+Client-side routing for a sharded, replicated knowledge server.
+
+The corpus is split by document id hash (`knowledge_index.shard_of`) into
+shards, each served by one or more replicas of `my_awesome_mcp_server.py`
+(`--shard I --num-shards N`). `ShardRouter` sends every query to all shards
+concurrently, picks the least-busy replica of each shard (failing over to the
+next one on error), and merges the shards' `KnowledgeToolScored` hits into one
+top-k list by BM25 score.
+
+Each shard computes IDF over its own documents. Hash partitioning gives every
+shard a similar term distribution, so scores are close enough to merge
+directly on large corpora; on small ones rare terms can rank somewhat
+differently than in a single index.
+
+`ShardedKnowledgeSource` wraps a router as an ordinary knowledge source; its
+nodes carry `score`, `doc_id` and `shard` metadata, so `MultiSourceRetriever`
+ranks them by score. Shards that failed are noted in the result's `meta`, and
+`MultiSourceRetriever` reports each as failed (`"<source>/shard-<i>"`).
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import threading
+from typing import Any
+
+from fed_rag.data_structures import KnowledgeNode
+from fed_rag.knowledge_stores.no_encode.mcp.sources.base import BaseMCPKnowledgeSource
+from mcp.types import CallToolResult, TextContent
+from pydantic import Field
+
+from mcp_pool import MCPSessionPool
+from telemetry import metrics, span
+
+logger = logging.getLogger(__name__)
+
+SHARD_FAILURES_META_KEY = "noencode_shard_failures"
+
+
+class ShardUnavailableError(RuntimeError):
+    """Raised when every replica of a shard failed."""
+
+
+class ShardRouter:
+    """Fan a query out to every shard and merge the top hits by score.
+
+    `shards[i]` lists the replicas of shard `i`, each reached through its own
+    `MCPSessionPool`. A shard with no working replica is returned among the
+    search's failures and left out of the merge rather than failing the query.
+    """
+
+    def __init__(
+        self,
+        shards: list[list[MCPSessionPool]],
+        tool_name: str = "KnowledgeToolScored",
+        query_param_name: str = "query",
+        top_k: int = 5,
+        timeout: float | None = None,
+        tool_call_kwargs: dict[str, Any] | None = None,
+    ):
+        if not shards or not all(shards):
+            raise ValueError("Every shard needs at least one replica.")
+        self.shards = shards
+        self.tool_name = tool_name
+        self.query_param_name = query_param_name
+        self.top_k = top_k
+        self.timeout = timeout
+        self.tool_call_kwargs = tool_call_kwargs or {}
+
+        self._lock = threading.Lock()
+        self._in_flight = {id(pool): 0 for replicas in shards for pool in replicas}
+        self._turn = itertools.count()
+        self._counters = {"queries": 0, "failovers": 0, "shard_failures": 0}
+
+    @property
+    def pools(self) -> list[MCPSessionPool]:
+        return [pool for replicas in self.shards for pool in replicas]
+
+    def _replica_order(self, replicas: list[MCPSessionPool]) -> list[MCPSessionPool]:
+        """Least outstanding calls first; ties rotate so idle replicas share the load."""
+        with self._lock:
+            offset = next(self._turn)
+            rotated = replicas[offset % len(replicas):] + replicas[: offset % len(replicas)]
+            return sorted(rotated, key=lambda pool: self._in_flight[id(pool)])
+
+    async def _search_shard(self, shard: int, query: str, limit: int) -> list[dict[str, Any]]:
+        arguments = {self.query_param_name: query, "limit": limit, **self.tool_call_kwargs}
+        error: BaseException | None = None
+        for attempt, pool in enumerate(self._replica_order(self.shards[shard])):
+            if attempt:
+                self._counters["failovers"] += 1
+            with self._lock:
+                self._in_flight[id(pool)] += 1
+            try:
+                with span("shard_call", shard=shard, replica=pool.name):
+                    result = await pool.call_tool(self.tool_name, arguments, timeout=self.timeout)
+                text = "".join(c.text for c in result.content if isinstance(c, TextContent))
+                if result.isError:
+                    raise RuntimeError(f"{self.tool_name} failed: {text}")
+                hits = json.loads(text)["hits"]
+                return [{**hit, "shard": shard} for hit in hits]
+            except Exception as e:
+                logger.warning(f"Shard {shard} replica '{pool.name}' failed: {e!r}")
+                error = e
+            finally:
+                with self._lock:
+                    self._in_flight[id(pool)] -= 1
+        raise ShardUnavailableError(f"All {len(self.shards[shard])} replicas of shard {shard} failed: {error!r}")
+
+    async def search(self, query: str, top_k: int | None = None) -> tuple[list[dict[str, Any]], dict[int, str]]:
+        """Merged hits (`doc_id`, `score`, `text`, `shard`), best first, and the error of each shard left out."""
+        top_k = top_k or self.top_k
+        self._counters["queries"] += 1
+        outcomes = await asyncio.gather(
+            *(self._search_shard(i, query, top_k) for i in range(len(self.shards))), return_exceptions=True
+        )
+        hits: list[dict[str, Any]] = []
+        failures: dict[int, str] = {}
+        for shard, outcome in enumerate(outcomes):
+            if isinstance(outcome, BaseException):
+                failures[shard] = str(outcome)
+                self._counters["shard_failures"] += 1
+                metrics.inc("noencode_errors_total", stage="shard", error=type(outcome).__name__, shard=shard)
+            else:
+                hits.extend(outcome)
+        if failures and len(failures) == len(self.shards):
+            raise ShardUnavailableError(f"No shard answered: {failures}")
+        return heapq.nlargest(top_k, hits, key=lambda hit: hit["score"]), failures
+
+    def stats(self) -> dict[str, Any]:
+        with self._lock:
+            in_flight = {pool.name: self._in_flight[id(pool)] for pool in self.pools}
+        return {"shards": len(self.shards), **self._counters, "in_flight": in_flight}
+
+    def close(self) -> None:
+        for pool in self.pools:
+            pool.close()
+
+
+def shard_failures(result: CallToolResult) -> dict[int, str]:
+    """The shards a `ShardedKnowledgeSource` result is missing, with their errors."""
+    return {int(shard): error for shard, error in ((result.meta or {}).get(SHARD_FAILURES_META_KEY) or {}).items()}
+
+
+def scored_hits_converter(result: CallToolResult, metadata: dict[str, Any] | None = None) -> list[KnowledgeNode]:
+    """Nodes from a `ShardedKnowledgeSource` result, keeping each hit's score, doc id and shard."""
+    hits = (result.structuredContent or {}).get("hits", [])
+    return [
+        KnowledgeNode(
+            node_type="text",
+            text_content=hit["text"],
+            metadata={**(metadata or {}), "score": hit["score"], "doc_id": hit["doc_id"], "shard": hit["shard"]},
+        )
+        for hit in hits
+    ]
+
+
+class ShardedKnowledgeSource(BaseMCPKnowledgeSource):
+    """A knowledge source backed by a `ShardRouter` instead of a single server."""
+
+    router: ShardRouter | None = Field(default=None, exclude=True)
+
+    def __init__(self, router: ShardRouter, name: str, **kwargs: Any):
+        super().__init__(
+            name=name, tool_name=router.tool_name, query_param_name=router.query_param_name,
+            tool_call_kwargs=router.tool_call_kwargs, **kwargs,
+        )
+        self.router = router
+        self._converter_fn = scored_hits_converter
+
+    async def retrieve(self, query: str) -> CallToolResult:
+        hits, failures = await self.router.search(query)
+        return CallToolResult(
+            content=[TextContent(type="text", text=hit["text"]) for hit in hits],
+            structuredContent={"hits": hits},
+            _meta={SHARD_FAILURES_META_KEY: {str(shard): error for shard, error in failures.items()}} if failures else None,
+        )
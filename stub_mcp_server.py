@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+stub_mcp_server.py
+
+A fast, deterministic MCP stdio server for tests, benchmarks and load tests.
+
+It registers the same "KnowledgeTool" and "KnowledgeToolBatch" as
+`my_awesome_mcp_server.py` but answers every query with canned passages.
+Latency, failures and payload size can be injected to play a slow, flaky or
+chatty backend:
+- `--latency` plus up to `--jitter` seconds of uniform noise per call
+- `--slow-rate` of calls take an extra `--slow-latency` (a latency tail)
+- `--error-rate` of calls fail with a tool error
+- `--payload-bytes` pads each passage to about that size
+- `--max-concurrency` caps the calls served at once, as a CPU-bound backend would
+
+Delays are awaited, so concurrent calls overlap unless capped.
+
+    python stub_mcp_server.py --results 3 --latency 0.05
+    python stub_mcp_server.py --latency 0.02 --jitter 0.01 --slow-rate 0.02 --slow-latency 0.5 \\
+        --error-rate 0.01 --payload-bytes 4000 --max-concurrency 4
+"""
+
+import argparse
+import asyncio
+import json
+import random
+
+from mcp.server.fastmcp import FastMCP
+
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument("--results", type=int, default=2, help="passages returned per query")
+parser.add_argument("--latency", type=float, default=0.0, help="seconds to sleep per tool call")
+parser.add_argument("--jitter", type=float, default=0.0, help="extra uniform random delay, up to this many seconds")
+parser.add_argument("--slow-rate", type=float, default=0.0, help="fraction of calls that also sleep --slow-latency")
+parser.add_argument("--slow-latency", type=float, default=0.0, help="extra seconds for slow calls")
+parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls that fail")
+parser.add_argument("--payload-bytes", type=int, default=0, help="pad each passage to about this many bytes")
+parser.add_argument("--max-concurrency", type=int, default=0, help="calls served at once; 0 for no limit")
+parser.add_argument("--seed", type=int, default=None, help="random seed for jitter, slow calls and errors")
+parser.add_argument("--name", default="StubMCP", help="server name")
+args = parser.parse_args()
+
+mcp = FastMCP(name=args.name, log_level="WARNING")
+rng = random.Random(args.seed)
+limit = asyncio.Semaphore(args.max_concurrency) if args.max_concurrency > 0 else None
+
+FILLER = "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+
+
+def passages(query: str) -> list[str]:
+    texts = [f"Stub passage {i + 1} about: {query}" for i in range(args.results)]
+    if args.payload_bytes:
+        padding = FILLER * (args.payload_bytes // len(FILLER) + 1)
+        texts = [f"{text}. {padding}"[: max(args.payload_bytes, len(text))] for text in texts]
+    return texts
+
+
+async def simulate_call() -> None:
+    """Sleep the injected latency, then maybe fail."""
+    delay = args.latency + rng.uniform(0, args.jitter)
+    if args.slow_rate and rng.random() < args.slow_rate:
+        delay += args.slow_latency
+    if limit is not None:
+        async with limit:
+            await asyncio.sleep(delay)
+    elif delay:
+        await asyncio.sleep(delay)
+    if args.error_rate and rng.random() < args.error_rate:
+        raise RuntimeError("Injected stub failure")
+
+
+@mcp.tool(name="KnowledgeTool")
+async def knowledge_tool(query: str) -> list[str]:
+    """Return `--results` canned passages mentioning the query."""
+    await simulate_call()
+    return passages(query)
+
+
+@mcp.tool(name="KnowledgeToolBatch")
+async def knowledge_tool_batch(queries: list[str]) -> str:
+    """JSON list of `KnowledgeTool` results, one per query; latency and errors apply once per batch."""
+    await simulate_call()
+    return json.dumps([passages(q) for q in queries])
+
+
+if __name__ == "__main__":
+    mcp.run()
@@ -0,0 +1,223 @@
+"""
+telemetry.py
+
+Timing spans and Prometheus-style metrics for the NoEncode pipeline.
+
+- `metrics` is the process-wide registry of counters, gauges and latency
+  histograms; `metrics.render_prometheus()` is served at `/metrics`.
+- `start_trace()` opens a per-request `Trace`; `span(name)` anywhere below it
+  records a timed span into that trace and always feeds the
+  `noencode_stage_seconds` histogram, so stages are measured whether or not a
+  trace is active.
+
+Code on the MCP pool's loop thread may also be handed the `Trace` explicitly.
+"""
+
+import asyncio
+import threading
+import time
+from collections.abc import Iterator
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Any
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+LabelKey = tuple[tuple[str, str], ...]
+
+
+def _labels(labels: dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, **extra: str) -> str:
+    pairs = [*key, *extra.items()]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms with Prometheus text output."""
+
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters: dict[str, dict[LabelKey, float]] = {}
+        self._gauges: dict[str, dict[LabelKey, float]] = {}
+        self._histograms: dict[str, dict[LabelKey, _Histogram]] = {}
+        self._help: dict[str, str] = {}
+
+    def describe(self, name: str, help_text: str) -> None:
+        self._help[name] = help_text
+
+    def inc(self, name: str, value: float = 1.0, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0.0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            if key not in series:
+                series[key] = _Histogram(self.buckets)
+            series[key].observe(value)
+
+    def counter_value(self, name: str, **labels: Any) -> float:
+        with self._lock:
+            return self._counters.get(name, {}).get(_labels(labels), 0.0)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._gauges.clear()
+            self._histograms.clear()
+
+    def render_prometheus(self) -> str:
+        """Text exposition format (version 0.0.4)."""
+        lines: list[str] = []
+        with self._lock:
+            for kind, families in (("counter", self._counters), ("gauge", self._gauges)):
+                for name, series in sorted(families.items()):
+                    if name in self._help:
+                        lines.append(f"# HELP {name} {self._help[name]}")
+                    lines.append(f"# TYPE {name} {kind}")
+                    for key, value in sorted(series.items()):
+                        lines.append(f"{name}{_format_labels(key)} {value:g}")
+            for name, series in sorted(self._histograms.items()):
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} histogram")
+                for key, hist in sorted(series.items()):
+                    for bound, count in zip(hist.buckets, hist.counts):
+                        lines.append(f"{name}_bucket{_format_labels(key, le=f'{bound:g}')} {count}")
+                    lines.append(f"{name}_bucket{_format_labels(key, le='+Inf')} {hist.count}")
+                    lines.append(f"{name}_sum{_format_labels(key)} {hist.total:g}")
+                    lines.append(f"{name}_count{_format_labels(key)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+metrics.describe("noencode_stage_seconds", "Duration of pipeline stages.")
+metrics.describe("noencode_errors_total", "Exceptions raised inside pipeline stages.")
+metrics.describe("noencode_timeouts_total", "Calls that missed their deadline.")
+metrics.describe("noencode_cache_hits_total", "Cache lookups that returned an entry.")
+metrics.describe("noencode_cache_misses_total", "Cache lookups that found nothing.")
+metrics.describe("noencode_context_dropped_tokens_total", "Retrieved tokens left out of prompts by the context budget.")
+
+
+@dataclass
+class Span:
+    name: str
+    start: float
+    duration: float
+    attrs: dict[str, Any] = field(default_factory=dict)
+    error: str | None = None
+
+
+class Trace:
+    """Spans recorded for one request, in completion order."""
+
+    def __init__(self, name: str = "request"):
+        self.name = name
+        self.start = time.perf_counter()
+        self.spans: list[Span] = []
+        self._lock = threading.Lock()
+
+    def record(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def breakdown(self) -> list[dict[str, Any]]:
+        """Spans as rows of stage, start offset and duration in milliseconds."""
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        return [
+            {
+                "stage": s.name,
+                "offset_ms": round(1000 * (s.start - self.start), 2),
+                "duration_ms": round(1000 * s.duration, 2),
+                **s.attrs,
+                **({"error": s.error} if s.error else {}),
+            }
+            for s in spans
+        ]
+
+    def totals(self) -> dict[str, float]:
+        """Milliseconds spent per stage name, summed across repeated spans."""
+        totals: dict[str, float] = {}
+        with self._lock:
+            for s in self.spans:
+                totals[s.name] = totals.get(s.name, 0.0) + 1000 * s.duration
+        return totals
+
+
+_current_trace: ContextVar[Trace | None] = ContextVar("noencode_trace", default=None)
+
+
+def current_trace() -> Trace | None:
+    return _current_trace.get()
+
+
+@contextmanager
+def start_trace(name: str = "request") -> Iterator[Trace]:
+    """Make a fresh `Trace` current for the enclosed code (and tasks it starts)."""
+    trace = Trace(name)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextmanager
+def span(name: str, trace: Trace | None = None, **attrs: Any) -> Iterator[dict[str, Any]]:
+    """Time a stage into the stage histogram and into `trace` (default: the current one).
+
+    Yields the span's attribute dict so results known only at the end
+    (token counts, hit/miss) can be attached.
+    """
+    trace = trace or current_trace()
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except (asyncio.CancelledError, GeneratorExit):
+        # Deadlines and abandoned streams are counted by their owners, not as errors
+        error = "cancelled"
+        raise
+    except BaseException as e:
+        error = type(e).__name__
+        metrics.inc("noencode_errors_total", stage=name, error=error)
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        metrics.observe("noencode_stage_seconds", duration, stage=name)
+        if trace is not None:
+            trace.record(Span(name, start, duration, attrs, error))